@@ -0,0 +1,130 @@
+"""
+Memory held by a chain of confirmed blocks once decoded, per transaction.
+
+The chain is synthetic: every block has the same number of regular transactions, each spending two
+outputs of the previous block and paying two of a small set of addresses, with keys and signatures of
+the sizes of the 1024 bits RSA keys of the wallets. Blocks go through JSON like when they are read from
+a peer, so every string is a separate object unless the domain classes share them.
+
+The same chain is also decoded into plain copies of the domain classes as they were before __slots__
+and string interning (attributes in a __dict__, every string its own object), so both are measured
+side by side in one run.
+
+    python benchmarks/memory.py --blocks 200 --transactions 50
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from coin.domain import Block, Transaction, InputInfo, OutputInfo
+
+
+class PlainInputInfo:
+    def __init__(self, tx_hash, index, amount, address, signature=None):
+        self.tx_hash = tx_hash
+        self.index = index
+        self.amount = amount
+        self.address = address
+        self.signature = signature
+
+    @classmethod
+    def from_json(cls, data):
+        return PlainInputInfo(data['transaction'], data['index'], data['amount'], data['address'], data['signature'])
+
+
+class PlainOutputInfo:
+    def __init__(self, amount, address):
+        self.amount = amount
+        self.address = address
+
+    @classmethod
+    def from_json(cls, data):
+        return PlainOutputInfo(data['amount'], data['address'])
+
+
+class PlainTransaction:
+    def __init__(self, id_, type_=None, hash_=None, inputs=None, outputs=None):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.type = type_
+        self.id = id_
+        self.hash = hash_
+
+    @classmethod
+    def from_json(cls, data):
+        return PlainTransaction(id_=data['id'], hash_=data['hash'], type_=data['type'],
+                                inputs=[PlainInputInfo.from_json(x) for x in data['inputs']],
+                                outputs=[PlainOutputInfo.from_json(x) for x in data['outputs']])
+
+
+class PlainBlock:
+    def __init__(self, index, transactions, timestamp, previous_hash, hash_=None, nonce=None):
+        self.index = index
+        self.transactions = transactions
+        self.timestamp = timestamp
+        self.previous_hash = previous_hash
+        self.nonce = nonce
+        self.hash = hash_
+
+    @classmethod
+    def from_json(cls, data):
+        return PlainBlock(data['index'], [PlainTransaction.from_json(x) for x in data['transactions']],
+                          data['timestamp'], data['previous_hash'], data.get('hash'), data['nonce'])
+
+
+def random_hex(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+def synthetic_chain(blocks: int, transactions: int, wallets: int) -> list:
+    addresses = [random_hex(162) for _ in range(wallets)]
+    chain, previous = [], [random_hex(32) for _ in range(transactions)]
+    for height in range(blocks):
+        txs = []
+        for i in range(transactions):
+            inputs = [InputInfo(previous[(i + k) % transactions], k, 1000, addresses[(height + i + k) % wallets],
+                                random_hex(128)) for k in range(2)]
+            outputs = [OutputInfo(999 - k, addresses[(height + i + k + 1) % wallets]) for k in range(2)]
+            txs.append(Transaction(random_hex(16), Transaction.REGULAR, random_hex(32), inputs, outputs))
+        previous = [x.hash for x in txs]
+        chain.append(Block(height, txs, 1.5e9 + height, random_hex(32), random_hex(32), height).to_json())
+    return chain
+
+
+def measure(payload: str, block_class=Block) -> int:
+    gc.collect()
+    tracemalloc.start()
+    blocks = [block_class.from_json(x) for x in json.loads(payload)]
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del blocks
+    return size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--blocks', type=int, default=200)
+    parser.add_argument('--transactions', type=int, default=50, help='Transactions per block')
+    parser.add_argument('--wallets', type=int, default=100, help='Distinct addresses')
+    args = parser.parse_args()
+
+    payload = json.dumps(synthetic_chain(args.blocks, args.transactions, args.wallets))
+    size = measure(payload)
+    plain_size = measure(payload, PlainBlock)
+    count = args.blocks * args.transactions
+    print(json.dumps({
+        'blocks': args.blocks,
+        'transactions': count,
+        'bytes': size,
+        'bytes_per_transaction': round(size / count),
+        'plain_bytes': plain_size,
+        'plain_bytes_per_transaction': round(plain_size / count),
+        'ratio': round(plain_size / size, 2),
+        'json_bytes_per_transaction': round(len(payload) / count)
+    }, indent=2))
@@ -0,0 +1,323 @@
+"""
+Timings of the hot paths of a node on synthetic chains, written as JSON so two runs can be compared.
+
+Every chain starts from the configured genesis block and only moves coins between the two test wallets
+(Config.TEST_WALLET_1 and Config.TEST_WALLET_2), with real signatures and proofs of work, so it is
+valid for the node. Each block holds up to --transactions payments spending outputs of earlier blocks,
+a fee transaction and a reward transaction. Ids come from a seeded generator and the timestamps are
+Config.BLOCK_TIME apart, so the same arguments always give the same chain (its tip is in the results).
+Generating the large chains is dominated by signing; --cache keeps them on disk in the binary encoding.
+
+Nothing is sent over the network: no Redis, no peers.
+
+    python benchmarks/suite.py --blocks 1000 10000 100000 --transactions 2 --output results.json
+    python benchmarks/suite.py --blocks 1000 --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from collections import deque
+from typing import List, Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from coin import codec, signatures
+from coin.blockchain import Blockchain
+from coin.chainindex import ChainIndex
+from coin.config import Config
+from coin.difficulty import TargetSchedule
+from coin.domain import Block, Transaction, InputInfo, OutputInfo, Wallet
+from coin.miner import Miner
+from coin.pow import ProofOfWorkEngine
+from coin.utxo import unspent_for_address
+
+# outputs smaller than this are left alone instead of being split again
+MIN_SPENDABLE = 1000
+# blocks whose payments are signed together, they only spend outputs of the blocks before them
+SIGNING_ROUND = 100
+
+
+def payment(rng: random.Random, utxo: InputInfo, to: str) -> Transaction:
+    # half of the output to `to`, the rest minus the fee back to its owner
+    inputs = [InputInfo(utxo.tx_hash, utxo.index, utxo.amount, utxo.address)]
+    outputs = [OutputInfo(utxo.amount // 2, to),
+               OutputInfo(utxo.amount - utxo.amount // 2 - Config.FEE_PER_TRANSACTION, utxo.address)]
+    return Transaction(random_id(rng), Transaction.REGULAR, None, inputs, outputs)
+
+
+def random_id(rng: random.Random) -> str:
+    return f'{rng.getrandbits(128):032x}'
+
+
+def sign(wallets: List[Wallet], transactions: List[Transaction]):
+    for wallet in wallets:
+        wallet.sign_transactions([x for x in transactions if x.inputs[0].address == wallet.identity])
+
+
+def coinbase(rng: random.Random, type_: str, amount: int, address: str) -> Transaction:
+    tx = Transaction(random_id(rng), type_, None, [], [OutputInfo(amount, address)])
+    tx.hash = tx.compute_hash()
+    return tx
+
+
+def synthetic_chain(genesis: Block, blocks: int, transactions: int, rng: random.Random) -> List[Block]:
+    wallets = [Wallet.from_json(Config.TEST_WALLET_1), Wallet.from_json(Config.TEST_WALLET_2)]
+    other = {wallets[0].identity: wallets[1].identity, wallets[1].identity: wallets[0].identity}
+    engine = ProofOfWorkEngine(workers=1)
+    targets = TargetSchedule(ChainIndex.from_blocks([genesis]), 1)
+    genesis_tx = genesis.transactions[0]
+    spendable = deque([InputInfo(genesis_tx.hash, 0, genesis_tx.outputs[0].amount, genesis_tx.outputs[0].address)])
+
+    chain = [genesis]
+    while len(chain) < blocks:
+        size = min(SIGNING_ROUND, blocks - len(chain), max(1, len(spendable) // max(transactions, 1)))
+        payments = []
+        for _ in range(size):
+            count = min(transactions, len(spendable))
+            payments.append([payment(rng, utxo, other[utxo.address])
+                             for utxo in (spendable.popleft() for _ in range(count))])
+        sign(wallets, [x for txs in payments for x in txs])
+
+        created = []
+        for txs in payments:
+            height = len(chain)
+            if txs:
+                txs.append(coinbase(rng, Transaction.FEE, Config.FEE_PER_TRANSACTION * len(txs), wallets[1].identity))
+            txs.append(coinbase(rng, Transaction.REWARD, Config.MINING_REWARD, wallets[0].identity))
+            block = Block(height, txs, genesis.timestamp + height * Config.BLOCK_TIME, chain[-1].hash)
+            block.nonce, block.hash = engine.search(block.header_prefix, targets.add(block.timestamp))
+            chain.append(block)
+            created.extend(InputInfo(tx.hash, i, x.amount, x.address)
+                           for tx in txs for i, x in enumerate(tx.outputs) if x.amount >= MIN_SPENDABLE)
+        spendable.extend(created)
+    return chain
+
+
+def load_chain(genesis: Block, blocks: int, transactions: int, seed: int, cache: str = None) -> List[Block]:
+    path = cache and os.path.join(cache, f'chain-{blocks}-{transactions}-{seed}.bin')
+    if path and os.path.exists(path):
+        with open(path, 'rb') as f:
+            return codec.decode_blocks(f.read())
+    chain = synthetic_chain(genesis, blocks, transactions, random.Random(seed))
+    if path:
+        os.makedirs(cache, exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(codec.encode_blocks(chain))
+    return chain
+
+
+def clear_signature_cache():
+    # so every signature is verified again, like a node that never saw the transactions
+    signatures.cache = signatures.SignatureCache(Config.SIGNATURE_CACHE_SIZE)
+
+
+def timed(function: Callable, repeat: int, before: Callable = None) -> dict:
+    durations = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return {'best': min(durations), 'median': statistics.median(durations)}
+
+
+def per_second(count: int, seconds: float) -> float:
+    return round(count / seconds, 1) if seconds > 0 else None
+
+
+def bench_serialization(chain: List[Block], repeat: int) -> dict:
+    binary = codec.encode_blocks(chain)
+    payload = json.dumps([x.to_json() for x in chain])
+    results = {}
+    for name, size, encode, decode in [
+        ('binary', len(binary), lambda: codec.encode_blocks(chain), lambda: codec.decode_blocks(binary)),
+        ('json', len(payload), lambda: json.dumps([x.to_json() for x in chain]),
+         lambda: [Block.from_json(x) for x in json.loads(payload)])
+    ]:
+        encoding, decoding = timed(encode, repeat), timed(decode, repeat)
+        results[name] = {
+            'bytes': size,
+            'encode_seconds': encoding['best'],
+            'encode_mb_per_second': per_second(size / 1e6, encoding['best']),
+            'decode_seconds': decoding['best'],
+            'decode_mb_per_second': per_second(size / 1e6, decoding['best']),
+            'decode_blocks_per_second': per_second(len(chain), decoding['best'])
+        }
+    return results
+
+
+def bench_valid_chain(blockchain: Blockchain, chain: List[Block]) -> dict:
+    data = [x.to_json() for x in chain]
+    transactions = sum(len(x.transactions) for x in chain)
+    results = {}
+    # the first run verifies every signature, the second one finds them in the signature cache
+    for name in ['cold', 'cached']:
+        if name == 'cold':
+            clear_signature_cache()
+        start = time.perf_counter()
+        if not blockchain.valid_chain(data):
+            raise Exception("The synthetic chain is not valid")
+        seconds = time.perf_counter() - start
+        results[name] = {
+            'seconds': seconds,
+            'blocks_per_second': per_second(len(chain), seconds),
+            'transactions_per_second': per_second(transactions, seconds)
+        }
+    return results
+
+
+def fresh_payments(blockchain: Blockchain, count: int, rng: random.Random) -> List[Transaction]:
+    # signed payments spending outputs of the tip, valid for the pool
+    wallets = [Wallet.from_json(Config.TEST_WALLET_1), Wallet.from_json(Config.TEST_WALLET_2)]
+    utxos = [x for wallet in wallets
+             for x in unspent_for_address(wallet.identity, blockchain.utxos, blockchain.database.get_pending_utxos())
+             if x.amount >= MIN_SPENDABLE]
+    rng.shuffle(utxos)
+    transactions = [payment(rng, utxo, wallets[0].identity if utxo.address == wallets[1].identity
+                            else wallets[1].identity) for utxo in utxos[:count]]
+    sign(wallets, transactions)
+    return transactions
+
+
+def bench_check_transaction(blockchain: Blockchain, transactions: List[Transaction]) -> dict:
+    def check_all():
+        if not all(blockchain.check_transaction(x) for x in transactions):
+            raise Exception("A synthetic transaction is not valid")
+
+    results = {'transactions': len(transactions)}
+    for name, before in [('cold', clear_signature_cache), ('cached', None)]:
+        seconds = timed(check_all, 1, before)['best']
+        results[name] = {
+            'seconds': seconds,
+            'transactions_per_second': per_second(len(transactions), seconds)
+        }
+    return results
+
+
+def bench_unspent(blockchain: Blockchain, repeat: int) -> dict:
+    results = {}
+    for name, wallet in [('wallet_1', Config.TEST_WALLET_1), ('wallet_2', Config.TEST_WALLET_2)]:
+        address = wallet['public_key']
+        results[name] = dict(timed(lambda: blockchain.get_unspent_transactions_for_address(address), repeat),
+                             outputs=len(blockchain.get_unspent_transactions_for_address(address)))
+    return results
+
+
+def bench_generate_block(blockchain: Blockchain, transactions: List[Transaction], repeat: int) -> dict:
+    added = sum(blockchain.add_new_transactions(transactions))
+    miner = Miner(blockchain, ProofOfWorkEngine(workers=1))
+    address = Config.TEST_WALLET_1['public_key']
+    return dict(timed(lambda: miner.generate_block(address, address), repeat), pool=added)
+
+
+def bench_proof_of_work(blockchain: Blockchain, bits: int, searches: int, workers: int) -> dict:
+    engine = ProofOfWorkEngine(workers=workers)
+    miner = Miner(blockchain, engine)
+    # a fixed target, hard enough for the hashing to dominate the setup of a search
+    blockchain.next_target = lambda: (1 << (256 - bits)) - 1
+    address = Config.TEST_WALLET_1['public_key']
+    block = miner.generate_block(address, address)
+    try:
+        start = time.perf_counter()
+        for i in range(searches):
+            block.timestamp = blockchain.last_block.timestamp + i + 1
+            miner.proof_of_work(block)
+        seconds = time.perf_counter() - start
+    finally:
+        del blockchain.next_target
+        engine.close()
+    return {
+        'bits': bits,
+        'workers': engine.workers,
+        'searches': searches,
+        'hashes': engine.hashes,
+        'seconds': seconds,
+        'hashes_per_second': per_second(engine.hashes, seconds)
+    }
+
+
+def run(blocks: int, args) -> dict:
+    # not the generator of the chain, whose ids the payments would repeat
+    rng = random.Random(f'{args.seed}-payments')
+    blockchain = Blockchain()
+    start = time.perf_counter()
+    chain = load_chain(blockchain.genesis, blocks, args.transactions, args.seed, args.cache)
+    loaded = time.perf_counter() - start
+    blockchain.chain = chain
+    payments = fresh_payments(blockchain, args.samples, rng)
+    return {
+        'blocks': blocks,
+        'transactions_per_block': args.transactions,
+        'transactions': sum(len(x.transactions) for x in chain),
+        'tip': chain[-1].hash,
+        'load_seconds': loaded,
+        'serialization': bench_serialization(chain, args.repeat),
+        'valid_chain': bench_valid_chain(blockchain, chain),
+        'check_transaction': bench_check_transaction(blockchain, payments),
+        'get_unspent_transactions_for_address': bench_unspent(blockchain, args.repeat),
+        'generate_block': bench_generate_block(blockchain, payments, args.repeat),
+        'proof_of_work': bench_proof_of_work(blockchain, args.pow_bits, args.pow_searches, args.workers)
+    }
+
+
+def flatten(value, prefix='') -> dict:
+    if isinstance(value, dict):
+        return {k: v for key, item in value.items() for k, v in flatten(item, f'{prefix}{key}.').items()}
+    return {prefix[:-1]: value} if isinstance(value, (int, float)) and not isinstance(value, bool) else {}
+
+
+def compare(previous: dict, current: dict) -> List[str]:
+    # change of every number of the runs with the same sizes, in percent of the previous value
+    lines = []
+    before = {(x['blocks'], x['transactions_per_block']): flatten(x) for x in previous['runs']}
+    for run_ in current['runs']:
+        old = before.get((run_['blocks'], run_['transactions_per_block']))
+        if old is None:
+            continue
+        for key, value in flatten(run_).items():
+            if old.get(key) and key not in ('blocks', 'transactions_per_block'):
+                lines.append(f"{run_['blocks']} blocks  {key}: {old[key]:.6g} -> {value:.6g} "
+                             f"({(value - old[key]) / old[key] * 100:+.1f}%)")
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--blocks', type=int, nargs='+', default=[1000, 10_000, 100_000],
+                        help='Chain lengths, genesis included')
+    parser.add_argument('--transactions', type=int, default=Config.TRANSACTIONS_PER_BLOCK,
+                        help='Payments per block')
+    parser.add_argument('--samples', type=int, default=200,
+                        help='Payments checked by check_transaction and put in the pool for generate_block')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--pow_bits', type=int, default=16, help='Leading zero bits of the proof of work target')
+    parser.add_argument('--pow_searches', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=Config.MINING_WORKERS, help='Proof of work processes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', help='Directory keeping the generated chains')
+    parser.add_argument('--output', help='JSON file for the results, printed when missing')
+    parser.add_argument('--compare', help='Results of a previous run to compare with')
+    args = parser.parse_args()
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'verify_workers': Config.VERIFY_WORKERS,
+        'seed': args.seed,
+        'runs': [run(x, args) for x in args.blocks]
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n'.join(compare(json.load(f), results)))
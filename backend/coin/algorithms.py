@@ -1,33 +1,17 @@
 from typing import List, Tuple
 
+from coin import coinselection
 from coin.domain import InputInfo
 
 
-def select_outputs_greedy(unspent: List[InputInfo], min_value) -> Tuple[List[InputInfo], float]:
+def select_outputs_greedy(unspent: List[InputInfo], min_value) -> Tuple[List[InputInfo], int]:
     """
     Select optimal outputs for a send from unspent outputs list.
     Returns output list and remaining change to be sent to a change address.
+    To select many times from the same outputs, sort them once with coinselection.SortedUtxos instead.
     """
-    # Partition into 2 lists.
-    lessers = [utxo for utxo in unspent if utxo.amount < min_value]
-    greaters = [utxo for utxo in unspent if utxo.amount >= min_value]
-    key_func = lambda utxo: utxo.value
-    if greaters:
-        # Not-empty. Find the smallest greater.
-        min_greater = min(greaters)
-        change = min_greater.amount - min_value
-        return [min_greater], change
-    # Not found in greaters. Try several lessers instead.
-    # Rearrange them from biggest to smallest. We want to use the least
-    # amount of inputs as possible.
-    lessers.sort(key=key_func, reverse=True)
-    result = []
-    accum = 0
-    for utxo in lessers:
-        result.append(utxo)
-        accum += utxo.amount
-        if accum >= min_value:
-            change = accum - min_value
-            return result, change
-    # No results found.
-    return [], 0
+    selection = coinselection.select_greedy(coinselection.SortedUtxos(unspent), min_value, coinselection.FeeModel(0, 0))
+    if selection is None:
+        # No results found.
+        return [], 0
+    return selection.inputs, selection.total - min_value
@@ -1,14 +1,21 @@
 import argparse
+import atexit
+import json
+import logging
 
 import rq
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 
-from coin import tasks
+from coin import tasks, codec, metrics, logs
 from coin.blockchain import Blockchain
 from coin.config import Config
-from coin.domain import Wallet
+from coin.database import FileDatabase
+from coin.domain import Wallet, Transaction
+from coin.ingestion import TransactionPipeline
 from coin.miner import Miner
+from coin.miningservice import MiningService
 from coin.node import Node
+from coin.profiler import SamplingProfiler
 from coin.transactionbuilder import NewTransactionViewModel
 from worker import conn
 
@@ -17,49 +24,200 @@ app = Flask(__name__)
 app.redis = conn
 app.task_queue = rq.Queue(connection=app.redis)
 
+log = logging.getLogger(__name__)
+profiler = SamplingProfiler()
+
+# read from the node's objects when /metrics is requested
+metrics.Gauge('coin_chain_height', 'Height of the last block of the main chain', callback=lambda: blockchain.length - 1)
+metrics.Gauge('coin_chain_work', 'Cumulative work of the main chain', callback=lambda: blockchain.chain_work())
+metrics.Gauge('coin_mempool_transactions', 'Unconfirmed transactions in the pool', callback=lambda: len(blockchain.mempool))
+metrics.Gauge('coin_ingestion_queue', 'Submitted transactions waiting for validation', callback=lambda: len(ingestion))
+metrics.Gauge('coin_mining_hashrate', 'Hashes per second of the last proof of work search',
+              callback=lambda: mining_service.status()['hashrate'])
+metrics.Gauge('coin_peers', 'Known peers', callback=lambda: len(node.peers))
+
+
+def wants_binary() -> bool:
+    # JSON stays the default, binary is only sent to clients asking for it
+    return request.accept_mimetypes.best_match(['application/json', codec.CONTENT_TYPE]) == codec.CONTENT_TYPE
+
+
+def binary_response(data: bytes, status=200):
+    return Response(data, status=status, mimetype=codec.CONTENT_TYPE)
+
+
+def stream_blocks(start: int, limit: int = None):
+    """
+    Streams up to `limit` blocks from height `start`, a block at a time, as a JSON object
+    {'chain', 'length', 'next'}, as JSON lines or in the binary encoding depending on the Accept header.
+    `next` is the cursor of the following page, None after the last block.
+    """
+    length = blockchain.length
+    start = min(max(start, 0), length)
+    end = length if limit is None else min(start + limit, length)
+    next_ = end if end < length else None
+    blocks = blockchain.iter_blocks(start, end - start)
+    mimetype = request.accept_mimetypes.best_match(
+        ['application/json', codec.JSON_LINES_CONTENT_TYPE, codec.CONTENT_TYPE])
+
+    if mimetype == codec.CONTENT_TYPE:
+        body = codec.iter_encode_blocks(blocks, end - start)
+    elif mimetype == codec.JSON_LINES_CONTENT_TYPE:
+        body = (json.dumps(x.to_json()) + '\n' for x in blocks)
+    else:
+        mimetype = 'application/json'
+
+        def generate():
+            yield '{"chain": ['
+            for i, block in enumerate(blocks):
+                yield (', ' if i else '') + json.dumps(block.to_json())
+            yield f'], "length": {length}, "next": {json.dumps(next_)}}}'
+        body = generate()
+    headers = {'X-Chain-Length': str(length)}
+    if next_ is not None:
+        headers['X-Next-From'] = str(next_)
+    return Response(stream_with_context(body), mimetype=mimetype, headers=headers)
+
 
 @app.route('/blockchain/transactions/', methods=['POST'])
 def new_transaction():
-    values = request.json
-    required = ['transaction']
-    if values is None or not all(k in values for k in required):
-        return f'One or more missing values: {required}', 400
-    try:
-        tx = NewTransactionViewModel.from_json_request(values['transaction']).build()
-    except Exception as e:
-        return str(e), 400
-    is_added = blockchain.add_new_transaction(tx)
-    if is_added:
-        tasks.launch_task(tasks.mine_and_consensus, 'mine blockchain', peer=f'http://{Config.SERVER_HOST}:{port}')
-        response = {'message': 'Transaction will be added to Block '}
-        return jsonify(response), 201
+    if request.mimetype == codec.CONTENT_TYPE:
+        # an already built and signed transaction
+        try:
+            tx = codec.decode_transaction(request.get_data())
+        except Exception as e:
+            return str(e), 400
     else:
-        response = {'message': 'Invalid Transaction!'}
+        values = request.json
+        required = ['transaction']
+        if values is None or not all(k in values for k in required):
+            return f'One or more missing values: {required}', 400
+        try:
+            tx = NewTransactionViewModel.from_json_request(values['transaction']).build()
+        except Exception as e:
+            return str(e), 400
+    # validated in the background, /blockchain/transactions/<hash>/status/ tells when it is in the pool
+    status = ingestion.submit(tx)
+    if status == TransactionPipeline.BUSY:
+        response = {'message': 'Too many transactions waiting, try again later', 'hash': tx.hash}
+        return jsonify(response), 503
+    if status == TransactionPipeline.REJECTED:
+        response = {'message': 'Invalid Transaction!', 'hash': tx.hash}
         return jsonify(response), 406
+    response = {'message': 'Transaction will be added to Block ', 'hash': tx.hash, 'status': status}
+    return jsonify(response), 202
+
+
+@app.route('/blockchain/transactions/bulk/', methods=['POST'])
+def new_transactions():
+    # a binary list of signed transactions, or {'transactions': [...]} like the 'transaction' of a single one
+    if request.mimetype == codec.CONTENT_TYPE:
+        try:
+            items = codec.decode_transactions(request.get_data())
+        except Exception as e:
+            return str(e), 400
+    else:
+        values = request.json
+        if not isinstance(values, dict) or not isinstance(values.get('transactions'), list):
+            return 'Missing value: transactions', 400
+        items = values['transactions']
+    if len(items) > Config.INGEST_BULK_LIMIT:
+        return f'At most {Config.INGEST_BULK_LIMIT} transactions per request', 413
+
+    results = []
+    for item in items:
+        try:
+            tx = item if isinstance(item, Transaction) else NewTransactionViewModel.from_json_request(item).build()
+        except Exception as e:
+            results.append({'hash': None, 'status': TransactionPipeline.REJECTED, 'error': str(e)})
+            continue
+        results.append({'hash': tx.hash, 'status': ingestion.submit(tx)})
+    return jsonify({'transactions': results}), 202
+
+
+@app.route('/blockchain/transactions/<tx_hash>/status/', methods=['GET'])
+def get_transaction_status(tx_hash):
+    if blockchain.database.get_transaction(tx_hash) is not None:
+        return jsonify({'hash': tx_hash, 'status': 'confirmed'}), 200
+    status = ingestion.status(tx_hash)
+    if status is None:
+        return 'Transaction not found', 404
+    return jsonify({'hash': tx_hash, 'status': status}), 200
 
 
 @app.route('/blockchain/transactions/', methods=['GET'])
 def get_transactions():
     # Get transactions from transactions pool
-    transactions = blockchain.unconfirmed_transactions
+    transactions = [x.to_json() for x in blockchain.unconfirmed_transactions]
     response = {'transactions': transactions}
     return jsonify(response), 200
 
 
+@app.route('/blockchain/transactions/<tx_hash>', methods=['GET'])
+def get_transaction(tx_hash):
+    transaction = blockchain.get_transaction(tx_hash)
+    if transaction is None:
+        return 'Transaction not found', 404
+    if wants_binary():
+        return binary_response(codec.encode_transaction(blockchain.find_transaction(tx_hash)))
+    return jsonify(transaction), 200
+
+
+@app.route('/blockchain/blocks/<block_hash>', methods=['GET'])
+def get_block(block_hash):
+    block = blockchain.get_block(block_hash)
+    if block is None:
+        return 'Block not found', 404
+    if wants_binary():
+        return binary_response(codec.encode_block(blockchain.database.get_block_by_hash(block_hash)))
+    return jsonify(block), 200
+
+
 @app.route('/blockchain/blocks/tail/', methods=['GET'])
 def part_chain():
+    if wants_binary():
+        return binary_response(codec.encode_blocks(list(blockchain.iter_blocks(max(blockchain.length - 10, 0), 10))))
     return jsonify(blockchain.part_chain()), 200
 
 
 @app.route('/blockchain/blocks/', methods=['GET'])
 def full_chain():
-    return jsonify(blockchain.full_chain), 200
+    # ?from=<height>&limit=<count> to page through the chain, following `next`
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        # an empty page would point `next` back at its own cursor
+        return 'Parameter limit must be at least 1', 400
+    return stream_blocks(request.args.get('from', 0, type=int), limit)
+
+
+@app.route('/blockchain/headers/', methods=['GET'])
+def headers_since():
+    since = request.args.get('since')
+    if not since:
+        return 'Missing parameter: since', 400
+    limit = min(request.args.get('limit', Config.SYNC_HEADERS_LIMIT, type=int), Config.SYNC_HEADERS_LIMIT)
+    headers = blockchain.headers_since(since.split(','), limit)
+    if headers is None:
+        return 'No common block found', 404
+    return jsonify(headers), 200
+
+
+@app.route('/blockchain/blocks/range/', methods=['GET'])
+def blocks_range():
+    start = request.args.get('start', type=int)
+    end = request.args.get('end', type=int)
+    if start is None or end is None:
+        return 'Missing parameters: start, end', 400
+    end = min(end, start + Config.SYNC_BLOCKS_BATCH)
+    if wants_binary():
+        return binary_response(codec.encode_blocks(list(blockchain.iter_blocks(start, end - start))))
+    return jsonify(blockchain.blocks_range(start, end)), 200
 
 
 @app.route('/node/peers/', methods=['GET'])
 def get_nodes():
     nodes = list(node.peers)
-    response = {'nodes': nodes}
+    response = {'nodes': nodes, 'health': node.client.health_report()}
     return jsonify(response), 200
 
 
@@ -98,6 +256,72 @@ def mine():
     return "Error occurred during mining", 400
 
 
+@app.route('/miner/start/', methods=['POST'])
+def start_mining():
+    started = mining_service.start()
+    return jsonify({'message': 'Mining started' if started else 'Already mining'}), 200
+
+
+@app.route('/miner/stop/', methods=['POST'])
+def stop_mining():
+    stopped = mining_service.stop()
+    return jsonify({'message': 'Mining stopped' if stopped else 'Not mining'}), 200
+
+
+@app.route('/miner/status/', methods=['GET'])
+def mining_status():
+    return jsonify(mining_service.status()), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/debug/profiler/', methods=['GET'])
+def profiler_report():
+    # collapsed stacks, most sampled first, e.g. for flamegraph.pl
+    report = profiler.report(request.args.get('limit', type=int))
+    return Response(report, mimetype='text/plain', headers={'X-Samples': str(profiler.samples)})
+
+
+@app.route('/debug/profiler/start/', methods=['POST'])
+def start_profiler():
+    if not Config.PROFILER_CONTROL:
+        return 'Profiler control is disabled', 403
+    if request.args.get('reset'):
+        profiler.reset()
+    started = profiler.start()
+    return jsonify({'message': 'Profiler started' if started else 'Already profiling'}), 200
+
+
+@app.route('/debug/profiler/stop/', methods=['POST'])
+def stop_profiler():
+    if not Config.PROFILER_CONTROL:
+        return 'Profiler control is disabled', 403
+    stopped = profiler.stop()
+    return jsonify({'message': 'Profiler stopped' if stopped else 'Not profiling', 'samples': profiler.samples}), 200
+
+
+def broadcast_block(block):
+    tasks.launch_task(tasks.consensus_requests, 'synchronize blockchain', peers=node.peers)
+
+
+mining_job = None
+
+
+def mine_transactions(transactions):
+    # called once per batch of transactions accepted, a running mining service picks them up by itself
+    global mining_job
+    if mining_service.running:
+        return
+    # a mining task still waiting in the queue will mine these transactions too
+    if mining_job is not None and mining_job.get_status() == 'queued':
+        return
+    mining_job = tasks.launch_task(tasks.mine_and_consensus, 'mine blockchain',
+                                   peer=f'http://{Config.SERVER_HOST}:{port}')
+
+
 @app.route('/wallet/<address>/utxos/')
 def get_utxos(address):
     return jsonify(blockchain.get_unspent_transactions_for_address(address)), 200
@@ -118,21 +342,39 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--port', type=int, help='Port number e.g. 3000')
     parser.add_argument('--peers', type=str, nargs='*', help='Peers e.g http://localhost:5000/')
     parser.add_argument('--use_test_miner', action='store_true')
+    parser.add_argument('--data_dir', type=str, help='Directory of the persistent block store e.g. data/5000')
+    parser.add_argument('--mine', action='store_true', help='Start the background mining service')
+    parser.add_argument('--profile', action='store_true', help='Start the sampling profiler, see /debug/profiler/')
+    parser.add_argument('--log_level', type=str, help='e.g. DEBUG, defaults to Config.LOG_LEVEL')
     args = parser.parse_args()
+    logs.configure(args.log_level)
+    if args.profile:
+        profiler.start()
 
     port = str(args.port)
     peers = set(args.peers) if args.peers else set()
     use_test_miner = args.use_test_miner
 
     myWallet = Wallet.from_json(Config.TEST_WALLET_1) if use_test_miner else Wallet.generate()
-    print(myWallet.identity)
-    print(myWallet.identity_private)
-    blockchain = Blockchain()
+    log.info("Wallet %s", myWallet.identity, extra={'wallet': myWallet.id})
+    database = None
+    if args.data_dir:
+        database = FileDatabase(args.data_dir)
+        atexit.register(database.close)
+    blockchain = Blockchain(database)
     node = Node(port, blockchain, peers)
+    atexit.register(node.client.close)
     miner = Miner(blockchain)
+    mining_service = MiningService(miner, myWallet.identity, myWallet.identity, on_block=broadcast_block)
+    if args.mine:
+        mining_service.start()
+    ingestion = TransactionPipeline(blockchain, on_batch=mine_transactions)
+    ingestion.start()
 
     app.blockchain = blockchain
     app.node = node
     app.miner = miner
+    app.mining_service = mining_service
+    app.ingestion = ingestion
     app.wallet = myWallet
     app.run(host=Config.SERVER_HOST, port=port)
@@ -1,31 +1,70 @@
 import datetime
-from functools import reduce
-from typing import Union, List
+import logging
+import threading
+from typing import Union, List, Sequence, Iterator, Callable
 
+from coin import signatures, difficulty, metrics
+from coin.blocktree import BlockTree
+from coin.chainindex import ChainIndex
 from coin.config import Config
 from coin.database import Database
-from coin.domain import Transaction, Block, InputInfo
+from coin.difficulty import TargetSchedule
+from coin.domain import Transaction, Block
+from coin.mempool import Mempool
+from coin.utxo import UtxoSet, unspent_for_address
+from coin.validation import ChainValidator, InvalidChainError, block_validation_seconds, blocks_checked, \
+    transactions_error
+
+log = logging.getLogger(__name__)
+
+transactions_received = metrics.Counter('coin_transactions_received_total',
+                                        'Transactions offered to the pool, by result', ('result',))
 
 
 class Blockchain:
 
     def __init__(self, database=None):
         self.database = database or Database()
+        self.tree = BlockTree()
+        # held while the chain or the pool change, the background miner runs next to the request threads
+        self.lock = threading.RLock()
+        # called with the new last block whenever the main chain changes, and with every transaction
+        # accepted in the pool
+        self.block_listeners: List[Callable[[Block], None]] = []
+        self.transaction_listeners: List[Callable[[Transaction], None]] = []
         if len(self.chain) == 0:
             self.create_genesis_block()
 
     @property
-    def difficulty(self) -> int:
-        return 2
+    def difficulty(self) -> float:
+        # how much harder the next block is than the easiest block allowed
+        return Config.MAX_TARGET / self.next_target()
+
+    def target(self, height: int) -> int:
+        # proof of work target of our block at `height`, kept by the chain index
+        return self.database.get_index().target(height)
+
+    def next_target(self) -> int:
+        return self.database.get_index().next_target()
+
+    def median_time_past(self) -> float:
+        # the next block must be later than this
+        return difficulty.median_time_past(self.length, self.database.get_index().timestamp)
+
+    def target_schedule(self, height: int) -> TargetSchedule:
+        # targets of a branch starting at `height`, on top of our chain below it
+        return TargetSchedule(self.database.get_index(), height)
 
     @property
     def last_block(self) -> Union[Block, None]:
-        if len(self.chain) > 0:
-            return self.chain[-1]
+        chain = self.chain
+        if len(chain) > 0:
+            return chain[-1]
         return None
 
     @property
-    def chain(self) -> List[Block]:
+    def chain(self) -> Sequence[Block]:
+        # With a FileDatabase this is a lazy view: only the blocks that are indexed get decoded
         return self.database.get_blocks()
 
     @property
@@ -37,22 +76,103 @@ class Blockchain:
         self.database.replace_blocks(value)
 
     @property
-    def confirmed_transactions(self) -> List[Transaction]:
-        return self.database.get_transactions()
+    def utxos(self) -> UtxoSet:
+        return self.database.get_utxos()
 
     @property
     def unconfirmed_transactions(self) -> List[Transaction]:
         return self.database.get_unconfirmed_transactions()
 
+    @property
+    def mempool(self) -> Mempool:
+        return self.database.get_mempool()
+
     @property
     def full_chain(self) -> dict:
         return {
             'chain': [x.to_json() for x in self.chain],
-            'length': len(self.chain)
+            'length': self.length
+        }
+
+    def locator(self) -> List[str]:
+        # hashes of our last 10 blocks, then exponentially further apart down to the genesis block
+        heights, step, height = [], 1, self.length - 1
+        while height > 0:
+            heights.append(height)
+            if len(heights) >= 10:
+                step *= 2
+            height -= step
+        heights.append(0)
+        return [self.database.get_block_hash(x) for x in heights]
+
+    def find_fork_height(self, hashes: List[str]) -> Union[int, None]:
+        # height of our most recent block among `hashes`
+        heights = [self.database.get_block_height(x) for x in hashes]
+        return max([x for x in heights if x is not None], default=None)
+
+    def get_block(self, block_hash: str) -> Union[dict, None]:
+        block = self.database.get_block_by_hash(block_hash)
+        if block is None:
+            return None
+        return {
+            'block': block.to_json(),
+            'height': self.database.get_block_height(block_hash),
+            'confirmations': self.length - self.database.get_block_height(block_hash)
+        }
+
+    def find_transaction(self, tx_hash: str) -> Union[Transaction, None]:
+        found = self.database.get_transaction(tx_hash)
+        return found[0] if found is not None else self.mempool.get(tx_hash)
+
+    def get_transaction(self, tx_hash: str) -> Union[dict, None]:
+        found = self.database.get_transaction(tx_hash)
+        if found is not None:
+            tx, height = found
+            return {
+                'transaction': tx.to_json(),
+                'block': {'height': height, 'hash': self.database.get_block_hash(height)},
+                'confirmations': self.length - height
+            }
+        tx = self.mempool.get(tx_hash)
+        if tx is not None:
+            return {'transaction': tx.to_json(), 'block': None, 'confirmations': 0}
+        return None
+
+    def headers_since(self, hashes: List[str], limit: int) -> Union[dict, None]:
+        fork_height = self.find_fork_height(hashes)
+        if fork_height is None:
+            return None
+        chain = self.chain
+        end = min(fork_height + 1 + limit, len(chain))
+        return {
+            'fork_height': fork_height,
+            'headers': [chain[x].header.to_json() for x in range(fork_height + 1, end)],
+            'length': len(chain),
+            'work': self.chain_work()
+        }
+
+    def iter_blocks(self, start: int = 0, limit: int = None) -> Iterator[Block]:
+        """
+        Cursor over the chain: up to `limit` blocks from height `start`, read one at a time from the store.
+        """
+        chain = self.chain
+        end = len(chain) if limit is None else min(start + limit, len(chain))
+        for height in range(max(start, 0), end):
+            try:
+                yield chain[height]
+            except IndexError:
+                # the chain got shorter while we were reading it
+                return
+
+    def blocks_range(self, start: int, end: int) -> dict:
+        blocks = [x.to_json() for x in self.iter_blocks(start, end - start)]
+        return {
+            'chain': blocks,
+            'length': len(blocks)
         }
 
     def part_chain(self, max_size=10):
-        chain = [x.to_json() for x in self.chain[-max_size:]]
+        chain = [x.to_json() for x in self.iter_blocks(max(self.length - max_size, 0), max_size)]
         return {
             'chain': chain,
             'length': len(chain)
@@ -61,47 +181,97 @@ class Blockchain:
     @property
     def genesis(self) -> Block:
         genesis_block = Block.from_json(Config.GENESIS_BLOCK)
-        genesis_block.hash = genesis_block.compute_hash()
+        if genesis_block.compute_hash() != genesis_block.hash:
+            raise Exception("Config.GENESIS_BLOCK doesn't match its hash")
         return genesis_block
 
     def create_genesis_block(self):
         self.database.add_block(self.genesis)
 
     def add_new_transaction(self, transaction: Transaction) -> bool:
-        if transaction.check():
-            self.database.add_unconfirmed_transaction(transaction)
-            return True
-        return False
+        return self.add_new_transactions([transaction])[0]
+
+    def add_new_transactions(self, transactions: List[Transaction]) -> List[bool]:
+        """
+        Adds a batch of transactions to the pool and returns whether each one was added. Their signatures
+        are verified together and the pool is locked once for the whole batch, listeners are called after.
+        """
+        # duplicates are refused before paying for the signature checks
+        fresh = [not self.database.has_unconfirmed_transaction(x) for x in transactions]
+        for tx, is_fresh in zip(transactions, fresh):
+            if not is_fresh:
+                log.debug("Transaction '%s' already in the pool", tx.hash)
+        signatures.verify_signatures([x.signature_job() for tx, is_fresh in zip(transactions, fresh) if is_fresh
+                                      for x in tx.inputs])
+        checked = [is_fresh and self._check_new_transaction(tx) for tx, is_fresh in zip(transactions, fresh)]
+        with self.lock:
+            added = [ok and self.database.add_unconfirmed_transaction(tx) for tx, ok in zip(transactions, checked)]
+        accepted = sum(added)
+        transactions_received.inc(accepted, result='accepted')
+        transactions_received.inc(len(added) - accepted, result='rejected')
+        for tx, is_added in zip(transactions, added):
+            if is_added:
+                for listener in self.transaction_listeners:
+                    listener(tx)
+        return added
+
+    @staticmethod
+    def _check_new_transaction(transaction: Transaction) -> bool:
+        try:
+            return transaction.check()
+        except Exception as e:
+            log.debug("Transaction '%s' is not valid: %s", transaction.hash, e)
+            return False
 
     def add_block(self, block: Block, proof: str) -> Union[Block, None]:
-        if self.check_block(block, proof):
+        with self.lock:
+            if not self.check_block(block, proof):
+                return None
             block.hash = proof
             self.database.add_block(block)
             self.database.remove_transactions_from_unconfirmed_list(block.transactions)
-            return block
-        return None
+        self._notify_block()
+        return block
+
+    def _notify_block(self):
+        last_block = self.last_block
+        for listener in self.block_listeners:
+            listener(last_block)
 
     def check_block(self, block: Block, proof: str) -> bool:
+        with block_validation_seconds.time(source='local'):
+            valid = self._check_block(block, proof)
+        blocks_checked.inc(source='local', result='valid' if valid else 'invalid')
+        return valid
+
+    def _check_block(self, block: Block, proof: str) -> bool:
         previous_hash = self.last_block.hash if self.last_block else None
         if previous_hash and previous_hash != block.previous_hash:
-            print("Hashes don't match")
+            log.info("Block %s doesn't follow our last block", proof)
+            return False
+        error = difficulty.timestamp_error(self.length, block.timestamp, self.database.get_index().timestamp)
+        if error is not None:
+            log.info("Block %s is not valid: %s", proof, error)
             return False
         if not self.is_valid_proof(block, proof):
-            print("Proof is not valid")
+            log.info("Proof of block %s is not valid", proof)
             return False
+        error = transactions_error(block)
+        if error is not None:
+            log.info("Block %s is not valid: %s", proof, error)
+            return False
+        # verify every signature of the block in one batch, the transaction checks below then hit the cache
+        signatures.verify_signatures([x.signature_job() for tx in block.transactions for x in tx.inputs])
+
         # check transactions
         if not all([self.check_transaction(tx) for tx in block.transactions]):
-            print("Transactions matter")
+            log.info("Block %s has transactions that are not valid", proof)
             return False
 
-        # Check if there is only 1 fee transaction and 1 reward transaction
-        tx_rewards = [x for x in block.transactions if x.type == Transaction.REWARD]
-        tx_fees = [x for x in block.transactions if x.type == Transaction.FEE]
-        if len(tx_fees) > 1:
-            print(f"Invalid fee transaction count: Expected '1' Got {len(tx_fees)}")
-            return False
-        if len(tx_rewards) > 1:
-            print(f"Invalid fee transaction count: Expected '1' Got {len(tx_rewards)}")
+        # the UTXO set only knows the chain, so double spends inside the block are checked here
+        outpoints = [(x.tx_hash, x.index) for tx in block.transactions for x in tx.inputs]
+        if len(outpoints) != len(set(outpoints)):
+            log.info("Block %s spends the same output more than once", proof)
             return False
         return True
 
@@ -110,92 +280,153 @@ class Blockchain:
         return datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
 
     def is_valid_proof(self, block: Block, block_hash: str) -> bool:
-        return block_hash.startswith('0' * self.difficulty) and block_hash == block.compute_hash()
+        # `block` goes on top of our last block
+        try:
+            if block_hash != block.compute_hash():
+                return False
+        except ValueError as e:
+            log.info("Block %s is malformed: %s", block_hash, e)
+            return False
+        return difficulty.meets_target(block_hash, self.next_target()) and not block.merkle_mutated
 
     def replace_chain(self, new_chain):
-        self.chain = new_chain
-
-    def valid_chain(self, chain: List[dict]) -> bool:
-        # check if a blockchain is valid
-        first_block = Block.from_json(chain[0])
-        if first_block.hash != self.genesis.compute_hash():
+        with self.lock:
+            self.chain = new_chain
+        self._notify_block()
+
+    def block_work(self, height: int) -> int:
+        # expected number of hashes to find the proof of our block at `height`
+        return difficulty.work(self.target(height))
+
+    def chain_work(self, height: int = None) -> int:
+        # cumulative work of the main chain up to `height`, its tip by default
+        if height is None:
+            height = self.length - 1
+        return self.database.get_index().chain_work(height)
+
+    def replace_chain_from(self, height: int, new_blocks: List[Block]) -> bool:
+        """
+        Offers a branch forking after our block at height - 1, or continuing a branch of the block tree.
+        It becomes the main chain if it has more work, otherwise it is kept in the block tree.
+        Returns whether the main chain changed.
+        """
+        with self.lock:
+            replaced = self._replace_chain_from(height, new_blocks)
+        if replaced:
+            self._notify_block()
+        return replaced
+
+    def _replace_chain_from(self, height: int, new_blocks: List[Block]) -> bool:
+        if not new_blocks:
+            return False
+        if new_blocks[0].previous_hash in self.tree:
+            # the whole side branch is weighed against our chain, from where it forks
+            stored = self.tree.branch(new_blocks[0].previous_hash)
+            height = self.tree.height(stored[0].hash)
+            new_blocks = stored + new_blocks
+        if not 0 < height <= self.length:
+            return False
+        if new_blocks[0].previous_hash != self.database.get_block_hash(height - 1):
+            log.info("Branch doesn't connect to the main chain")
             return False
+        targets = self.target_schedule(height)
+        work = self.chain_work(height - 1)
+        for block in new_blocks:
+            work += difficulty.work(targets.add(block.timestamp))
+        if work > self.chain_work():
+            return self.reorganize(height - 1, new_blocks)
+        for offset, block in enumerate(new_blocks):
+            self.tree.add(block, height + offset)
+        return False
 
-        current_index = 1
-        while current_index < len(chain):
-            current_block = Block.from_json(chain[current_index])
-            if current_block.compute_hash() != current_block.hash:
+    def reorganize(self, fork_height: int, branch: List[Block]) -> bool:
+        """
+        Makes `branch` the continuation of the main chain after the block at `fork_height`.
+        Only the blocks above the fork point are undone, then the branch blocks are connected one by one,
+        each checked against the UTXO set. If one is not valid the previous main chain is restored.
+        """
+        disconnected = self.database.truncate_blocks(fork_height + 1)
+        for position, block in enumerate(branch):
+            try:
+                valid = self.check_block(block, block.hash)
+            except Exception as e:
+                log.info("Block %s of the branch: %s", block.hash, e)
+                valid = False
+            if not valid:
+                log.warning("Block %d of the branch is not valid, keeping our chain", fork_height + 1 + position)
+                for x in branch[position:]:
+                    self.tree.remove(x.hash)
+                self.database.truncate_blocks(fork_height + 1)
+                for x in disconnected:
+                    self.database.add_block(x)
                 return False
+            self.database.add_block(block)
 
-            # check if newBlock's previous_hash field is same as currentBlock's hash
-            if current_index + 1 < len(chain):
-                new_block = Block.from_json(chain[current_index + 1])
-                if current_block.compute_hash() != new_block.previous_hash:
-                    print("Uneven hashes")
-                    return False
-
-            # validate each transaction
-            for transaction in current_block.transactions:
-                if transaction.type == Transaction.REGULAR:
-                    if not transaction.check():
-                        print("Bad transaction")
-                        return False
-            if not self.is_valid_proof(current_block, current_block.hash):
-                print("Is not valid proof")
-                return False
-            current_index += 1
+        for height, block in enumerate(disconnected, fork_height + 1):
+            self.tree.add(block, height)
+        for block in branch:
+            self.tree.remove(block.hash)
+
+        # transactions of the disconnected blocks that the new branch doesn't have go back to the pool
+        self.database.remove_transactions_from_unconfirmed_list([tx for x in branch for tx in x.transactions])
+        self.database.refresh_pending_utxos()
+        for tx in [tx for x in disconnected for tx in x.transactions if tx.type == Transaction.REGULAR]:
+            if not self.database.has_transaction(tx) and self.check_transaction(tx):
+                self.database.add_unconfirmed_transaction(tx)
+        # and the ones spending outputs that only the disconnected blocks had
+        evicted = self.database.remove_unspendable_transactions()
+        if evicted:
+            log.info("Removed %d unconfirmed transactions spending outputs of disconnected blocks", len(evicted))
+        log.info("Switched to a branch of %d blocks after block %d, %d blocks disconnected",
+                 len(branch), fork_height, len(disconnected),
+                 extra={'fork_height': fork_height, 'connected': len(branch), 'disconnected': len(disconnected)})
         return True
 
-    @property
-    def all_inputs(self) -> List[InputInfo]:
-        return reduce(lambda x, y: x + y, map(lambda x: x.inputs, self.confirmed_transactions))
+    def validate_chain(self, chain: List[dict]):
+        """
+        Raises InvalidChainError for the first block of `chain` that is not valid.
+        """
+        if not chain or Block.from_json(chain[0]).hash != self.genesis.hash:
+            raise InvalidChainError(0, "genesis block doesn't match")
+
+        genesis = self.genesis
+        validator = ChainValidator(genesis.hash, TargetSchedule(ChainIndex.from_blocks([genesis]), 1))
+        for data in chain[1:]:
+            validator.add(Block.from_json(data))
+        validator.finish()
+
+    def valid_chain(self, chain: List[dict]) -> bool:
+        try:
+            self.validate_chain(chain)
+        except InvalidChainError as e:
+            log.info("Invalid chain: %s", e)
+            return False
+        return True
 
     def check_transaction(self, tx: Transaction) -> bool:
         if not tx.check():
-            print("Yup")
+            log.debug("Transaction '%s' is not valid", tx.hash)
             return False
 
         # verify if the transaction isn't already in the blockchain
-        if any([tx.hash == x.hash or tx.id == x.id for x in self.confirmed_transactions]):
+        if self.database.has_transaction(tx):
             raise Exception(f"Transaction '{tx.hash}'already in the blockchain")
 
-        # verify all inputs exists in database
+        # verify all inputs exist in database and are unspent
+        utxos = self.utxos
         for input_ in tx.inputs:
-            if not any([x.hash == input_.tx_hash and input_.index in range(len(x.outputs)) and x.outputs[
-                input_.index].amount == input_.amount for x in
-                        self.confirmed_transactions]):
-                print("Input references transaction that is not in database")
+            output = utxos.get(input_.tx_hash, input_.index)
+            if output is None:
+                log.debug("Input references an output that is not in database or already spent for `%s`", tx.hash)
                 return False
-
-        # verify all inputs are unspent
-        for input_ in tx.inputs:
-            if any([x.index == input_.index and x.tx_hash == input_.tx_hash for x in self.all_inputs]):
-                print(f"Not all inputs are unspent for transaction `{tx.hash}`")
+            if output.amount != input_.amount:
+                log.debug("Input amount doesn't match the referenced output for `%s`", tx.hash)
                 return False
         return True
 
     def get_unspent_transactions_for_address(self, address):
-        outputs: List[InputInfo] = []
-        inputs: List[InputInfo] = []
-
-        def prepare(transactions: List[Transaction]):
-            for tx in transactions:
-                for idx, output in enumerate(tx.outputs):
-                    if output.address == address:
-                        outputs.append(InputInfo(tx.hash, idx, output.amount, address, None))
-                for idx, input_ in enumerate(tx.inputs):
-                    if address == input_.address:
-                        inputs.append(input_)
-
-        prepare(self.confirmed_transactions)
-        prepare(self.unconfirmed_transactions)
-
-        unspent = []
-        for output in outputs:
-            if not any([x.tx_hash == output.tx_hash and x.index == output.index for x in inputs]):
-                unspent.append(output.to_json())
-        return unspent
+        utxos = unspent_for_address(address, self.utxos, self.database.get_pending_utxos())
+        return [x.to_json() for x in utxos]
 
     def get_balance_for_address(self, address) -> int:
-        utxos = self.get_unspent_transactions_for_address(address)
-        return sum([x['amount'] for x in utxos])
+        return self.utxos.balance(address) + self.database.get_pending_utxos().balance_delta(address)
@@ -0,0 +1,219 @@
+"""
+Append-only block log.
+
+    blocks.log  sequence of records: [payload length: u32][crc32 of payload: u32][payload]
+    blocks.idx  one fixed-size entry per record: [offset of the record in blocks.log: u64][block hash: 32 bytes]
+
+Records are written to the log first and to the index afterwards, and both files are fsynced in batches.
+On open the index is trusted up to the end of the log: a torn record at the tail is cut off and
+records that made it to the log but not to the index are re-indexed by walking their headers.
+Opening only decodes those re-indexed records, never the blocks already in the index.
+
+Reads go through read-only memory maps of both files, so the chain itself is never loaded in memory.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from collections.abc import Sequence
+from typing import Callable, Optional
+
+from coin.config import Config
+
+log = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct('<II')
+INDEX_ENTRY = struct.Struct('<Q32s')
+
+
+class MappedFile:
+    """
+    Read-only memory map of a file that is only ever appended to or truncated through another handle.
+    The map is extended lazily when a read goes past the mapped size.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self._map = None
+        self._size = 0
+
+    def view(self, end: int) -> mmap.mmap:
+        if end > self._size:
+            self.close()
+            self.file.flush()
+            size = os.fstat(self.file.fileno()).st_size
+            if size:
+                self._map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+                self._size = size
+        return self._map
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._size = 0
+
+
+class BlockLog:
+    def __init__(self, directory: str, hash_of: Callable[[bytes], str], fsync_batch: int = None, name='blocks'):
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, name + '.log')
+        self.index_path = os.path.join(directory, name + '.idx')
+        self.fsync_batch = fsync_batch or Config.FSYNC_BATCH_BLOCKS
+        # only used to re-index records found past the end of the index
+        self.hash_of = hash_of
+        self._lock = threading.RLock()
+        self._unsynced = 0
+        self._log = open(self.log_path, 'a+b')
+        self._index_file = open(self.index_path, 'a+b')
+        self._log_map = MappedFile(self._log)
+        self._index_map = MappedFile(self._index_file)
+        self._count = 0
+        self._recover()
+
+    def _recover(self):
+        self._index_file.seek(0)
+        index = bytearray(self._index_file.read())
+        del index[len(index) - len(index) % INDEX_ENTRY.size:]
+        log_size = os.path.getsize(self.log_path)
+
+        # drop index entries pointing past the end of the log or at a damaged record
+        while index:
+            offset, _ = INDEX_ENTRY.unpack_from(index, len(index) - INDEX_ENTRY.size)
+            if self._read_record(offset, log_size) is not None:
+                break
+            del index[-INDEX_ENTRY.size:]
+
+        end = 0
+        if index:
+            offset, _ = INDEX_ENTRY.unpack_from(index, len(index) - INDEX_ENTRY.size)
+            end = offset + RECORD_HEADER.size + len(self._read_record(offset, log_size))
+
+        # records written to the log but not to the index
+        payload = self._read_record(end, log_size)
+        while payload is not None:
+            index += INDEX_ENTRY.pack(end, bytes.fromhex(self.hash_of(payload)))
+            end += RECORD_HEADER.size + len(payload)
+            payload = self._read_record(end, log_size)
+
+        if end != log_size:
+            log.warning("Block log: discarding %d bytes of incomplete data", log_size - end)
+        self._log.truncate(end)
+        self._index_file.truncate(0)
+        self._index_file.write(index)
+        self._count = len(index) // INDEX_ENTRY.size
+        self.flush(force=True)
+
+    def _read_record(self, offset: int, log_size: int) -> Optional[bytes]:
+        if offset + RECORD_HEADER.size > log_size:
+            return None
+        self._log.seek(offset)
+        length, crc = RECORD_HEADER.unpack(self._log.read(RECORD_HEADER.size))
+        if offset + RECORD_HEADER.size + length > log_size:
+            return None
+        payload = self._log.read(length)
+        if zlib.crc32(payload) != crc:
+            return None
+        return payload
+
+    def __len__(self) -> int:
+        return self._count
+
+    def entry(self, position: int):
+        with self._lock:
+            start = position * INDEX_ENTRY.size
+            return INDEX_ENTRY.unpack_from(self._index_map.view(start + INDEX_ENTRY.size), start)
+
+    def block_hash(self, position: int) -> str:
+        return self.entry(position)[1].hex()
+
+    def read(self, position: int) -> bytes:
+        with self._lock:
+            offset, _ = self.entry(position)
+            view = self._log_map.view(offset + RECORD_HEADER.size)
+            length, _ = RECORD_HEADER.unpack_from(view, offset)
+            start = offset + RECORD_HEADER.size
+            return self._log_map.view(start + length)[start:start + length]
+
+    def append(self, payload: bytes, block_hash: str):
+        with self._lock:
+            self._log.seek(0, os.SEEK_END)
+            offset = self._log.tell()
+            self._log.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self._index_file.write(INDEX_ENTRY.pack(offset, bytes.fromhex(block_hash)))
+            self._count += 1
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_batch:
+                self.flush()
+
+    def truncate(self, length: int):
+        with self._lock:
+            if length >= len(self):
+                return
+            offset, _ = self.entry(length)
+            # a mapped file can't be truncated on every platform
+            self._log_map.close()
+            self._index_map.close()
+            self._count = length
+            self._log.truncate(offset)
+            self._index_file.truncate(length * INDEX_ENTRY.size)
+            self.flush(force=True)
+
+    def flush(self, force=False):
+        with self._lock:
+            if self._unsynced == 0 and not force:
+                return
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._index_file.flush()
+            os.fsync(self._index_file.fileno())
+            self._unsynced = 0
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._log_map.close()
+            self._index_map.close()
+            self._log.close()
+            self._index_file.close()
+
+
+class StoredBlocks(Sequence):
+    """
+    Read-only list of the blocks in a BlockLog, decoded on access.
+    The most recently decoded blocks are kept in a small LRU cache keyed by block hash,
+    which stays correct when the log is truncated and appended to again.
+    """
+
+    def __init__(self, log: BlockLog, decode: Callable[[bytes], object], cache_size: int = None):
+        self.log = log
+        self.decode = decode
+        self.cache_size = cache_size or Config.BLOCK_CACHE_SIZE
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.log)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('block index out of range')
+        block_hash = self.log.block_hash(item)
+        with self._lock:
+            block = self._cache.get(block_hash)
+            if block is not None:
+                self._cache.move_to_end(block_hash)
+                return block
+        block = self.decode(self.log.read(item))
+        with self._lock:
+            self._cache[block_hash] = block
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return block
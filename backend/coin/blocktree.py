@@ -0,0 +1,50 @@
+from typing import Dict, List, Optional
+
+from coin.config import Config
+from coin.domain import Block
+
+
+class BlockTree:
+    """
+    Blocks known to the node that are not on its main chain, by hash, with their height. A branch
+    offered on top of one kept here is joined to it, and when a branch gets more work than the main
+    chain the Blockchain switches to it, keeping the blocks it disconnects here in turn.
+    The oldest blocks are dropped once there are more than `max_blocks`.
+    """
+
+    def __init__(self, max_blocks: int = None):
+        self.max_blocks = max_blocks or Config.MAX_SIDE_BLOCKS
+        self._blocks: Dict[str, Block] = {}
+        self._heights: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._blocks)
+
+    def __contains__(self, block_hash: str) -> bool:
+        return block_hash in self._blocks
+
+    def get(self, block_hash: str) -> Optional[Block]:
+        return self._blocks.get(block_hash)
+
+    def height(self, block_hash: str) -> Optional[int]:
+        return self._heights.get(block_hash)
+
+    def add(self, block: Block, height: int):
+        self._blocks[block.hash] = block
+        self._heights[block.hash] = height
+        while len(self._blocks) > self.max_blocks:
+            self.remove(next(iter(self._blocks)))
+
+    def remove(self, block_hash: str):
+        self._blocks.pop(block_hash, None)
+        self._heights.pop(block_hash, None)
+
+    def branch(self, tip_hash: str) -> List[Block]:
+        # blocks from the first one whose parent is not in the tree up to `tip_hash`, in chain order
+        blocks = []
+        block = self._blocks.get(tip_hash)
+        while block is not None:
+            blocks.append(block)
+            block = self._blocks.get(block.previous_hash)
+        blocks.reverse()
+        return blocks
@@ -0,0 +1,78 @@
+from typing import Dict, Tuple, Optional, Iterable, List
+
+from coin import difficulty
+from coin.domain import Block
+
+
+class ChainIndex:
+    """
+    Secondary indexes of the confirmed chain:
+        transaction hash -> (block height, position in the block)
+        transaction id -> transaction hash
+        block hash -> block height
+    and for every height the block timestamp, the proof of work target and the cumulative work,
+    so targets and work never need the blocks themselves.
+    """
+
+    def __init__(self):
+        self._transactions: Dict[str, Tuple[int, int]] = {}
+        self._ids: Dict[str, str] = {}
+        self._blocks: Dict[str, int] = {}
+        self._timestamps: List[float] = []
+        self._targets: List[int] = []
+        self._work: List[int] = []
+
+    def __len__(self) -> int:
+        # blocks indexed
+        return len(self._targets)
+
+    def add_block(self, height: int, block: Block):
+        target = difficulty.next_target(height, self.timestamp, self.target)
+        self._timestamps.append(block.timestamp)
+        self._targets.append(target)
+        self._work.append((self._work[-1] if self._work else 0) + difficulty.work(target))
+        self._blocks[block.hash] = height
+        for position, tx in enumerate(block.transactions):
+            self._transactions[tx.hash] = (height, position)
+            self._ids[tx.id] = tx.hash
+
+    def remove_block(self, block: Block):
+        # blocks are only ever removed from the tip
+        height = self._blocks.pop(block.hash, None)
+        if height is not None:
+            del self._timestamps[height:]
+            del self._targets[height:]
+            del self._work[height:]
+        for tx in block.transactions:
+            self._transactions.pop(tx.hash, None)
+            if self._ids.get(tx.id) == tx.hash:
+                del self._ids[tx.id]
+
+    def transaction_location(self, tx_hash: str) -> Optional[Tuple[int, int]]:
+        return self._transactions.get(tx_hash)
+
+    def transaction_hash(self, tx_id: str) -> Optional[str]:
+        return self._ids.get(tx_id)
+
+    def block_height(self, block_hash: str) -> Optional[int]:
+        return self._blocks.get(block_hash)
+
+    def timestamp(self, height: int) -> float:
+        return self._timestamps[height]
+
+    def target(self, height: int) -> int:
+        return self._targets[height]
+
+    def next_target(self) -> int:
+        # target of the block following the last one
+        return difficulty.next_target(len(self), self.timestamp, self.target)
+
+    def chain_work(self, height: int) -> int:
+        return self._work[height] if height >= 0 else 0
+
+    @classmethod
+    def from_blocks(cls, blocks: Iterable[Block]) -> 'ChainIndex':
+        index = cls()
+        for height, block in enumerate(blocks):
+            index.add_block(height, block)
+        return index
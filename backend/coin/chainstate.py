@@ -0,0 +1,218 @@
+"""
+Chain state of a FileDatabase kept on disk in SQLite: the UTXO set and the chain index.
+
+    outputs       (tx_hash, idx) -> amount, address        unspent outputs, indexed by address
+    balances      address -> balance, number of outputs
+    transactions  transaction hash -> block height, position in the block
+    ids           transaction id -> transaction hash
+    heights       height -> block hash, timestamp, proof of work target, cumulative work
+    meta          schema version, height and hash of the last block the state includes
+
+Every block changes a few rows, inside one SQLite transaction that is only committed once the block
+and undo logs are durable up to the height recorded with it. So the committed state always describes
+a prefix of the block log, and opening a node only replays the blocks after it instead of loading
+anything. Targets and work don't fit in 64 bits and are stored as hex text.
+"""
+import os
+import sqlite3
+import threading
+from typing import Dict, Tuple, Optional, List
+
+from coin import difficulty
+from coin.chainindex import ChainIndex
+from coin.domain import Block, OutputInfo
+from coin.utxo import UtxoSet, Outpoint
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS outputs (tx_hash TEXT NOT NULL, idx INTEGER NOT NULL, amount INTEGER NOT NULL,
+                                    address TEXT NOT NULL, PRIMARY KEY (tx_hash, idx)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS outputs_address ON outputs (address);
+CREATE TABLE IF NOT EXISTS balances (address TEXT PRIMARY KEY, balance INTEGER NOT NULL,
+                                     outputs INTEGER NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS transactions (hash TEXT PRIMARY KEY, height INTEGER NOT NULL,
+                                         position INTEGER NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ids (id TEXT PRIMARY KEY, hash TEXT NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS heights (height INTEGER PRIMARY KEY, hash TEXT NOT NULL, timestamp REAL NOT NULL,
+                                    target TEXT NOT NULL, work TEXT NOT NULL);
+CREATE UNIQUE INDEX IF NOT EXISTS heights_hash ON heights (hash);
+"""
+TABLES = ['meta', 'outputs', 'balances', 'transactions', 'ids', 'heights']
+
+
+class StateStore:
+    # a database of another version is dropped and the state rebuilt from the block log
+    VERSION = 1
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, 'state.sqlite')
+        # the node's request threads and its miner share the connection, one statement at a time
+        self.lock = threading.RLock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.executescript(SCHEMA)
+        if self.get('version') != str(self.VERSION):
+            self.reset()
+
+    def query(self, sql: str, params=()) -> List[tuple]:
+        with self.lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def execute(self, sql: str, params=()):
+        with self.lock:
+            self._db.execute(sql, params)
+
+    def get(self, key: str) -> Optional[str]:
+        rows = self.query('SELECT value FROM meta WHERE key = ?', (key,))
+        return rows[0][0] if rows else None
+
+    def set(self, key: str, value):
+        self.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    @property
+    def height(self) -> int:
+        # blocks the committed state includes
+        return int(self.get('height') or 0)
+
+    @property
+    def tip(self) -> Optional[str]:
+        return self.get('tip')
+
+    def commit(self, height: int, tip: Optional[str]):
+        # the block and undo logs must already be durable up to `height`
+        with self.lock:
+            self.set('height', height)
+            self.set('tip', tip or '')
+            self._db.commit()
+
+    def reset(self):
+        with self.lock:
+            self._db.rollback()
+            for table in TABLES:
+                self._db.execute(f'DELETE FROM {table}')
+            self.set('version', self.VERSION)
+            self._db.commit()
+
+    def close(self):
+        with self.lock:
+            self._db.close()
+
+
+class StoredUtxoSet(UtxoSet):
+    """
+    UtxoSet whose outputs and balances are rows of a StateStore.
+    """
+
+    def __init__(self, store: StateStore):
+        super().__init__()
+        self.store = store
+
+    def __len__(self) -> int:
+        return self.store.query('SELECT COUNT(*) FROM outputs')[0][0]
+
+    def __contains__(self, outpoint: Outpoint) -> bool:
+        return self.get(*outpoint) is not None
+
+    def get(self, tx_hash: str, index: int) -> Optional[OutputInfo]:
+        rows = self.store.query('SELECT amount, address FROM outputs WHERE tx_hash = ? AND idx = ?', (tx_hash, index))
+        return OutputInfo(*rows[0]) if rows else None
+
+    def outputs_for_address(self, address: str) -> Dict[Outpoint, int]:
+        rows = self.store.query('SELECT tx_hash, idx, amount FROM outputs WHERE address = ?', (address,))
+        return {(tx_hash, index): amount for tx_hash, index, amount in rows}
+
+    def balance(self, address: str) -> int:
+        rows = self.store.query('SELECT balance FROM balances WHERE address = ?', (address,))
+        return rows[0][0] if rows else 0
+
+    def _add(self, outpoint: Outpoint, output: OutputInfo):
+        with self.store.lock:
+            if self.get(*outpoint) is not None:
+                self._remove(outpoint)
+            self.store.execute('INSERT INTO outputs (tx_hash, idx, amount, address) VALUES (?, ?, ?, ?)',
+                               (outpoint[0], outpoint[1], output.amount, output.address))
+            self.store.execute('INSERT INTO balances (address, balance, outputs) VALUES (?, ?, 1) '
+                               'ON CONFLICT (address) DO UPDATE SET balance = balance + excluded.balance, '
+                               'outputs = outputs + 1', (output.address, output.amount))
+
+    def _remove(self, outpoint: Outpoint) -> Optional[OutputInfo]:
+        with self.store.lock:
+            output = self.get(*outpoint)
+            if output is None:
+                return None
+            self.store.execute('DELETE FROM outputs WHERE tx_hash = ? AND idx = ?', outpoint)
+            self.store.execute('UPDATE balances SET balance = balance - ?, outputs = outputs - 1 WHERE address = ?',
+                               (output.amount, output.address))
+            self.store.execute('DELETE FROM balances WHERE address = ? AND outputs = 0', (output.address,))
+            return output
+
+    def clear(self):
+        with self.store.lock:
+            self.store.execute('DELETE FROM outputs')
+            self.store.execute('DELETE FROM balances')
+
+
+class StoredChainIndex(ChainIndex):
+    """
+    ChainIndex whose entries are rows of a StateStore, so it is never loaded in memory.
+    """
+
+    def __init__(self, store: StateStore):
+        super().__init__()
+        self.store = store
+        rows = store.query('SELECT MAX(height) FROM heights')
+        self._length = rows[0][0] + 1 if rows[0][0] is not None else 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def add_block(self, height: int, block: Block):
+        target = difficulty.next_target(height, self.timestamp, self.target)
+        work = self.chain_work(height - 1) + difficulty.work(target)
+        with self.store.lock:
+            self.store.execute('INSERT OR REPLACE INTO heights (height, hash, timestamp, target, work) '
+                               'VALUES (?, ?, ?, ?, ?)', (height, block.hash, block.timestamp, f'{target:x}', f'{work:x}'))
+            for position, tx in enumerate(block.transactions):
+                self.store.execute('INSERT OR REPLACE INTO transactions (hash, height, position) VALUES (?, ?, ?)',
+                                   (tx.hash, height, position))
+                self.store.execute('INSERT OR REPLACE INTO ids (id, hash) VALUES (?, ?)', (tx.id, tx.hash))
+            self._length = height + 1
+
+    def remove_block(self, block: Block):
+        # blocks are only ever removed from the tip
+        with self.store.lock:
+            height = self.block_height(block.hash)
+            if height is not None:
+                self.store.execute('DELETE FROM heights WHERE height >= ?', (height,))
+                self._length = height
+            for tx in block.transactions:
+                self.store.execute('DELETE FROM transactions WHERE hash = ?', (tx.hash,))
+                self.store.execute('DELETE FROM ids WHERE id = ? AND hash = ?', (tx.id, tx.hash))
+
+    def transaction_location(self, tx_hash: str) -> Optional[Tuple[int, int]]:
+        rows = self.store.query('SELECT height, position FROM transactions WHERE hash = ?', (tx_hash,))
+        return rows[0] if rows else None
+
+    def transaction_hash(self, tx_id: str) -> Optional[str]:
+        rows = self.store.query('SELECT hash FROM ids WHERE id = ?', (tx_id,))
+        return rows[0][0] if rows else None
+
+    def block_height(self, block_hash: str) -> Optional[int]:
+        rows = self.store.query('SELECT height FROM heights WHERE hash = ?', (block_hash,))
+        return rows[0][0] if rows else None
+
+    def _column(self, column: str, height: int) -> str:
+        rows = self.store.query(f'SELECT {column} FROM heights WHERE height = ?', (height,))
+        if not rows:
+            raise IndexError('height out of range')
+        return rows[0][0]
+
+    def timestamp(self, height: int) -> float:
+        return self._column('timestamp', height)
+
+    def target(self, height: int) -> int:
+        return int(self._column('target', height), 16)
+
+    def chain_work(self, height: int) -> int:
+        return int(self._column('work', height), 16) if height >= 0 else 0
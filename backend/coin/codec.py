@@ -0,0 +1,334 @@
+"""
+Compact binary encoding of blocks and transactions, used on the wire and by the block store.
+
+    block        version: u8 | index: u64 | timestamp: f64 | nonce: i64 (-1 when not mined) |
+                 previous hash: field | hash: field | transactions: u32 count + transactions
+    transaction  id: field | type: u8 (255 followed by a text field for unknown types) | hash: field |
+                 inputs: u16 count + inputs | outputs: u16 count + outputs
+    input        index: u32 | amount: i64 | 3 field headers | transaction hash, address, signature data
+    output       amount: i64 | field header | address data
+    undo record  block hash: field | spent outputs: u32 count + (transaction hash: field | output index: u32 | output)
+    field        header: u16 (kind in the top 2 bits, length of the data in the others) | data
+
+Hex strings (hashes, ids, addresses which are public keys, signatures) travel as raw bytes, which
+halves their size. Other values keep their exact JSON value: text, None, or 0 for the previous hash
+of the genesis block. A list of blocks or transactions is a u32 count followed by u32 length-prefixed
+encodings of its items.
+
+Transaction hashes and input signatures are still computed over the JSON form, since that is what
+wallets sign.
+"""
+import struct
+from typing import List, Tuple, Iterable, Iterator
+
+from coin.domain import Block, Transaction, InputInfo, OutputInfo
+from coin.utxo import BlockUndo
+
+VERSION = 1
+CONTENT_TYPE = 'application/x-coin-binary'
+# streamed JSON, a block per line
+JSON_LINES_CONTENT_TYPE = 'application/x-ndjson'
+
+_NONE, _HEX, _TEXT, _ZERO = 0, 1, 2, 3
+_KIND_SHIFT = 14
+_MAX_LENGTH = (1 << _KIND_SHIFT) - 1
+_HEX_HEADER = _HEX << _KIND_SHIFT
+_TYPES = [Transaction.REGULAR, Transaction.REWARD, Transaction.FEE]
+_TYPE_CODES = {x: i for i, x in enumerate(_TYPES)}
+_OTHER_TYPE = 255
+
+_U8 = struct.Struct('<B')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_BLOCK = struct.Struct('<BQdq')
+_INPUT = struct.Struct('<IqHHH')
+_OUTPUT = struct.Struct('<qH')
+# type code of a transaction and the header of its hash field
+_TYPE_HEADER = struct.Struct('<BH')
+
+
+def _field(value) -> Tuple[int, bytes]:
+    # header and data of a field
+    if value is None:
+        return _NONE << _KIND_SHIFT, b''
+    if type(value) is int and value == 0:
+        return _ZERO << _KIND_SHIFT, b''
+    if not isinstance(value, str):
+        raise ValueError(f"Field can't be encoded: {value!r}")
+    try:
+        data = bytes.fromhex(value)
+        kind = _HEX if data.hex() == value else _TEXT
+    except ValueError:
+        kind = _TEXT
+    if kind == _TEXT:
+        data = value.encode('utf8')
+    if len(data) > _MAX_LENGTH:
+        raise ValueError(f"Field too long to encode: {len(data)} bytes")
+    return kind << _KIND_SHIFT | len(data), data
+
+
+def _value(data: bytes, offset: int, header: int):
+    # value of the field whose data starts at offset, and the offset following it
+    kind, end = header >> _KIND_SHIFT, offset + (header & _MAX_LENGTH)
+    if kind == _HEX:
+        return data[offset:end].hex(), end
+    if kind == _TEXT:
+        return data[offset:end].decode('utf8'), end
+    return (0 if kind == _ZERO else None), end
+
+
+def _encode_field(value, out: list):
+    header, data = _field(value)
+    out.append(_U16.pack(header))
+    out.append(data)
+
+
+def _decode_field(data: bytes, offset: int):
+    header, = _U16.unpack_from(data, offset)
+    return _value(data, offset + 2, header)
+
+
+def _encode_transaction(tx: Transaction, out: list):
+    _encode_field(tx.id, out)
+    code = _TYPE_CODES.get(tx.type)
+    if code is None:
+        out.append(_U8.pack(_OTHER_TYPE))
+        _encode_field(tx.type, out)
+    else:
+        out.append(_U8.pack(code))
+    _encode_field(tx.hash, out)
+    out.append(_U16.pack(len(tx.inputs)))
+    for x in tx.inputs:
+        (h1, d1), (h2, d2), (h3, d3) = _field(x.tx_hash), _field(x.address), _field(x.signature)
+        out.append(_INPUT.pack(x.index, x.amount, h1, h2, h3))
+        out.append(d1 + d2 + d3)
+    out.append(_U16.pack(len(tx.outputs)))
+    for x in tx.outputs:
+        header, address = _field(x.address)
+        out.append(_OUTPUT.pack(x.amount, header))
+        out.append(address)
+
+
+def _decode_transaction(data: bytes, offset: int, hexed: str) -> Tuple[Transaction, int]:
+    # `hexed` is data.hex(): hex fields are slices of it, the other kinds go through _value
+    header, = _U16.unpack_from(data, offset)
+    offset += 2
+    end = offset + (header & _MAX_LENGTH)
+    id_ = hexed[2 * offset:2 * end] if header >> _KIND_SHIFT == _HEX else _value(data, offset, header)[0]
+    code, header = _TYPE_HEADER.unpack_from(data, end)
+    if code == _OTHER_TYPE:
+        type_, offset = _decode_field(data, end + 1)
+        header, = _U16.unpack_from(data, offset)
+        offset += 2
+    elif code < len(_TYPES):
+        type_ = _TYPES[code]
+        offset = end + _TYPE_HEADER.size
+    else:
+        raise ValueError(f"Unknown transaction type code {code}")
+    end = offset + (header & _MAX_LENGTH)
+    hash_ = hexed[2 * offset:2 * end] if header >> _KIND_SHIFT == _HEX else _value(data, offset, header)[0]
+    count, = _U16.unpack_from(data, end)
+    offset = end + 2
+
+    inputs = []
+    for _ in range(count):
+        index, amount, h1, h2, h3 = _INPUT.unpack_from(data, offset)
+        offset += _INPUT.size
+        if h1 >> _KIND_SHIFT == h2 >> _KIND_SHIFT == h3 >> _KIND_SHIFT == _HEX:
+            # usual case, all three are hex strings
+            a = offset + (h1 - _HEX_HEADER)
+            b = a + (h2 - _HEX_HEADER)
+            c = b + (h3 - _HEX_HEADER)
+            tx_hash, address, signature = hexed[2 * offset:2 * a], hexed[2 * a:2 * b], hexed[2 * b:2 * c]
+            offset = c
+        else:
+            tx_hash, offset = _value(data, offset, h1)
+            address, offset = _value(data, offset, h2)
+            signature, offset = _value(data, offset, h3)
+        inputs.append(InputInfo(tx_hash, index, amount, address, signature))
+
+    outputs = []
+    count, = _U16.unpack_from(data, offset)
+    offset += 2
+    for _ in range(count):
+        amount, header = _OUTPUT.unpack_from(data, offset)
+        offset += _OUTPUT.size
+        if header >> _KIND_SHIFT == _HEX:
+            end = offset + header - _HEX_HEADER
+            address = hexed[2 * offset:2 * end]
+            offset = end
+        else:
+            address, offset = _value(data, offset, header)
+        outputs.append(OutputInfo(amount, address))
+    return Transaction(id_, type_, hash_, inputs, outputs), offset
+
+
+def encode_transaction(tx: Transaction) -> bytes:
+    out = [_U8.pack(VERSION)]
+    _encode_transaction(tx, out)
+    return b''.join(out)
+
+
+def _check_end(data: bytes, offset: int, what: str):
+    # fields claiming more bytes than there are show up as an offset past the end
+    if offset != len(data):
+        raise ValueError(f"Malformed {what}: {len(data) - offset} bytes left after decoding")
+
+
+def decode_transaction(data: bytes) -> Transaction:
+    # malformed data always raises ValueError
+    if not data or data[0] != VERSION:
+        raise ValueError(f"Unsupported encoding version {data[:1].hex()}")
+    try:
+        tx, offset = _decode_transaction(data, 1, data.hex())
+    except struct.error as e:
+        raise ValueError(f"Malformed transaction: {e}")
+    _check_end(data, offset, 'transaction')
+    return tx
+
+
+def encode_block(block: Block) -> bytes:
+    nonce = -1 if block.nonce is None else block.nonce
+    out = [_BLOCK.pack(VERSION, block.index, block.timestamp, nonce)]
+    _encode_field(block.previous_hash, out)
+    _encode_field(block.hash, out)
+    out.append(_U32.pack(len(block.transactions)))
+    for tx in block.transactions:
+        _encode_transaction(tx, out)
+    return b''.join(out)
+
+
+def decode_block(data: bytes) -> Block:
+    # malformed data always raises ValueError
+    try:
+        block, offset = _decode_block(data)
+    except struct.error as e:
+        raise ValueError(f"Malformed block: {e}")
+    _check_end(data, offset, 'block')
+    return block
+
+
+def _decode_block(data: bytes) -> Tuple[Block, int]:
+    version, index, timestamp, nonce = _BLOCK.unpack_from(data, 0)
+    if version != VERSION:
+        raise ValueError(f"Unsupported encoding version {version}")
+    previous_hash, offset = _decode_field(data, _BLOCK.size)
+    hash_, offset = _decode_field(data, offset)
+    count, = _U32.unpack_from(data, offset)
+    offset += 4
+    transactions = []
+    hexed = data.hex()
+    for _ in range(count):
+        tx, offset = _decode_transaction(data, offset, hexed)
+        transactions.append(tx)
+    return Block(index, transactions, timestamp, previous_hash, hash_, None if nonce == -1 else nonce), offset
+
+
+def iter_encode_blocks(blocks: Iterable[Block], count: int) -> Iterator[bytes]:
+    # the encoding of a list of `count` blocks, a block at a time
+    yield _U32.pack(count)
+    for block in blocks:
+        encoded = encode_block(block)
+        yield _U32.pack(len(encoded)) + encoded
+
+
+def encode_blocks(blocks) -> bytes:
+    return b''.join(iter_encode_blocks(blocks, len(blocks)))
+
+
+def _decode_list(data: bytes, decode) -> list:
+    items, offset = [], 4
+    if len(data) < offset:
+        raise ValueError("List ended before its length")
+    count, = _U32.unpack_from(data, 0)
+    for _ in range(count):
+        if offset + 4 > len(data):
+            raise ValueError("List ended before its last item")
+        length, = _U32.unpack_from(data, offset)
+        offset += 4
+        if offset + length > len(data):
+            raise ValueError("List ended before its last item")
+        items.append(decode(data[offset:offset + length]))
+        offset += length
+    _check_end(data, offset, 'list')
+    return items
+
+
+def decode_blocks(data: bytes) -> List[Block]:
+    return _decode_list(data, decode_block)
+
+
+def encode_transactions(transactions: List[Transaction]) -> bytes:
+    out = [_U32.pack(len(transactions))]
+    for tx in transactions:
+        encoded = encode_transaction(tx)
+        out.append(_U32.pack(len(encoded)) + encoded)
+    return b''.join(out)
+
+
+def decode_transactions(data: bytes) -> List[Transaction]:
+    return _decode_list(data, decode_transaction)
+
+
+def encode_undo(block_hash: str, undo: BlockUndo) -> bytes:
+    out = []
+    _encode_field(block_hash, out)
+    out.append(_U32.pack(len(undo)))
+    for (tx_hash, index), output in undo:
+        _encode_field(tx_hash, out)
+        header, address = _field(output.address)
+        out.append(_U32.pack(index) + _OUTPUT.pack(output.amount, header))
+        out.append(address)
+    return b''.join(out)
+
+
+def decode_undo(data: bytes) -> Tuple[str, BlockUndo]:
+    # malformed data always raises ValueError
+    try:
+        block_hash, undo, offset = _decode_undo(data)
+    except struct.error as e:
+        raise ValueError(f"Malformed undo record: {e}")
+    _check_end(data, offset, 'undo record')
+    return block_hash, undo
+
+
+def _decode_undo(data: bytes) -> Tuple[str, BlockUndo, int]:
+    block_hash, offset = _decode_field(data, 0)
+    count, = _U32.unpack_from(data, offset)
+    offset += 4
+    undo = []
+    for _ in range(count):
+        tx_hash, offset = _decode_field(data, offset)
+        index, = _U32.unpack_from(data, offset)
+        amount, header = _OUTPUT.unpack_from(data, offset + 4)
+        address, offset = _value(data, offset + 4 + _OUTPUT.size, header)
+        undo.append(((tx_hash, index), OutputInfo(amount, address)))
+    return block_hash, undo, offset
+
+
+def iter_decode_blocks(chunks: Iterable[bytes]) -> Iterator[Block]:
+    """
+    Decodes a list of blocks arriving in chunks of any size, yielding every block as soon as it is complete.
+    """
+    buffer, count = bytearray(), None
+    chunks = iter(chunks)
+    for chunk in chunks:
+        buffer += chunk
+        if count is None:
+            if len(buffer) < 4:
+                continue
+            count, = _U32.unpack_from(buffer, 0)
+            del buffer[:4]
+        while count and len(buffer) >= 4:
+            length, = _U32.unpack_from(buffer, 0)
+            if len(buffer) < 4 + length:
+                break
+            block = decode_block(bytes(buffer[4:4 + length]))
+            del buffer[:4 + length]
+            count -= 1
+            yield block
+        if count == 0:
+            if buffer or any(chunks):
+                raise ValueError("Block list continues after its last block")
+            return
+    raise ValueError("Block list ended before its last block")
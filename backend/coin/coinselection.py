@@ -0,0 +1,244 @@
+"""
+Coin selection: which unspent outputs of an address pay an amount.
+
+The outputs of the address are sorted by amount once (SortedUtxos) and selections are removed from it,
+so paying many times from the same outputs never sorts or scans the whole list again.
+The fee of a transaction depends on its number of inputs and outputs (FeeModel), so an output is only
+worth its effective value: its amount minus the fee of spending it.
+
+    greedy          the smallest output paying everything by itself, else the largest ones. Binary search,
+                    then as many steps as inputs.
+    branch and bound
+                    depth-first search for a set paying the amount and its fee exactly, up to `tolerance`
+                    more, which then goes to the fee instead of a change output.
+    knapsack        random passes over the outputs smaller than the amount, keeping the set that
+                    overshoots the least, so the change is as small as possible.
+
+Branch and bound and knapsack only look at the Config.COIN_SELECTION_CANDIDATES largest useful outputs
+and stop at a deadline, select() combines the three within Config.COIN_SELECTION_BUDGET seconds.
+"""
+import random
+import time
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import List, Optional, Iterable
+
+from coin.config import Config
+from coin.domain import InputInfo
+from coin.utxo import UtxoSet, PendingUtxos, unspent_for_address
+
+
+class FeeModel:
+    def __init__(self, base: int = None, per_input: int = None, per_output: int = 0):
+        self.base = Config.FEE_PER_TRANSACTION if base is None else base
+        self.per_input = Config.FEE_PER_INPUT if per_input is None else per_input
+        self.per_output = per_output
+
+    def fee(self, inputs: int, outputs: int) -> int:
+        return self.base + self.per_input * inputs + self.per_output * outputs
+
+
+class Selection:
+    def __init__(self, inputs: List[InputInfo], amount: int, fee_model: FeeModel, strategy: str, change=True):
+        self.inputs = inputs
+        self.strategy = strategy
+        self.total = sum([x.amount for x in inputs])
+        # a change output only when what is left pays for it, otherwise the rest goes to the fee
+        self.change = self.total - amount - fee_model.fee(len(inputs), 2)
+        if change and self.change > 0:
+            self.fee = fee_model.fee(len(inputs), 2)
+        else:
+            self.change = 0
+            self.fee = self.total - amount
+
+
+class SortedUtxos:
+    """
+    Unspent outputs of an address sorted by amount, with their total.
+    """
+
+    def __init__(self, utxos: Iterable[InputInfo]):
+        self._items = sorted(utxos, key=lambda x: x.amount)
+        self._amounts = [x.amount for x in self._items]
+        self.total = sum(self._amounts)
+
+    @classmethod
+    def for_address(cls, address: str, utxos: UtxoSet, pending: PendingUtxos) -> 'SortedUtxos':
+        return cls(unspent_for_address(address, utxos, pending))
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __getitem__(self, position: int) -> InputInfo:
+        return self._items[position]
+
+    def amounts(self, start: int, end: int) -> List[int]:
+        return self._amounts[start:end]
+
+    def bisect(self, amount: int) -> int:
+        # position of the smallest output of at least `amount`
+        return bisect_left(self._amounts, amount)
+
+    def remove(self, inputs: List[InputInfo]):
+        # the outputs of a selection, so the next ones don't spend them again
+        for input_ in inputs:
+            position = bisect_left(self._amounts, input_.amount)
+            end = bisect_right(self._amounts, input_.amount)
+            while position < end and self._items[position] is not input_:
+                position += 1
+            if position < end:
+                del self._items[position]
+                del self._amounts[position]
+                self.total -= input_.amount
+
+
+def _candidates(utxos: SortedUtxos, upper: int, fee_model: FeeModel) -> List[InputInfo]:
+    # the largest outputs worth more than the fee of spending them and at most `upper`, largest first
+    end = utxos.bisect(upper + 1)
+    start = max(utxos.bisect(fee_model.per_input + 1), end - Config.COIN_SELECTION_CANDIDATES)
+    return [utxos[x] for x in range(end - 1, start - 1, -1)]
+
+
+def select_greedy(utxos: SortedUtxos, amount: int, fee_model: FeeModel = None) -> Optional[Selection]:
+    fee_model = fee_model or FeeModel()
+    position = utxos.bisect(amount + fee_model.fee(1, 1))
+    if position < len(utxos):
+        return Selection([utxos[position]], amount, fee_model, 'greedy')
+    # else the largest ones: running totals of their effective values, a slice twice as long each time,
+    # so a wallet of many small outputs isn't walked one output at a time
+    target = amount + fee_model.fee(0, 1)
+    low = utxos.bisect(fee_model.per_input + 1)
+    end, total, size = len(utxos), 0, 64
+    while end > low:
+        start = max(end - size, low)
+        totals = list(accumulate([x - fee_model.per_input for x in reversed(utxos.amounts(start, end))],
+                                 initial=total))
+        found = bisect_left(totals, target, 1)
+        if found < len(totals):
+            count = len(utxos) - end + found
+            return Selection([utxos[x] for x in range(len(utxos) - 1, len(utxos) - 1 - count, -1)], amount,
+                             fee_model, 'greedy')
+        end, total, size = start, totals[-1], size * 2
+    return None
+
+
+def select_branch_and_bound(utxos: SortedUtxos, amount: int, fee_model: FeeModel = None, tolerance: int = None,
+                            deadline: float = None, max_tries: int = 100_000) -> Optional[Selection]:
+    """
+    A set of outputs whose effective values add up to between the amount plus the fee without change
+    and `tolerance` more (by default what a change output would cost to create and spend), or None.
+    """
+    fee_model = fee_model or FeeModel()
+    if tolerance is None:
+        tolerance = fee_model.per_output + fee_model.per_input
+    target = amount + fee_model.fee(0, 1)
+    candidates = _candidates(utxos, target + tolerance + fee_model.per_input, fee_model)
+    values = [x.amount - fee_model.per_input for x in candidates]
+    negated = [-x for x in values]
+    # available[i]: what all the candidates from i on could still add
+    available = [0] * (len(values) + 1)
+    for i in range(len(values) - 1, -1, -1):
+        available[i] = available[i + 1] + values[i]
+    if available[0] < target:
+        return None
+
+    best, best_excess = None, None
+    selected, value, i = [], 0, 0
+    for tries in range(max_tries):
+        if tries % 100 == 0 and deadline is not None and time.perf_counter() > deadline:
+            break
+        if value + available[i] < target or value > target + tolerance:
+            backtrack = True
+        elif value >= target:
+            backtrack = True
+            if best is None or value - target < best_excess:
+                best, best_excess = list(selected), value - target
+                if best_excess == 0:
+                    break
+        else:
+            limit = target + tolerance - value
+            if values[i] > limit:
+                # the candidates too large to be added are skipped at once
+                i = bisect_left(negated, -limit, i)
+                continue
+            backtrack = False
+        if backtrack:
+            if not selected:
+                break
+            # leave the last output out and try the next one, skipping the ones of the same value
+            # since leaving them out too gives the same sets
+            i = selected.pop()
+            value -= values[i]
+            i = bisect_right(negated, negated[i], i + 1)
+        else:
+            selected.append(i)
+            value += values[i]
+            i += 1
+    if best is None:
+        return None
+    return Selection([candidates[x] for x in best], amount, fee_model, 'branch and bound', change=False)
+
+
+def select_knapsack(utxos: SortedUtxos, amount: int, fee_model: FeeModel = None, deadline: float = None,
+                    iterations: int = 1000, rng: random.Random = None) -> Optional[Selection]:
+    fee_model = fee_model or FeeModel()
+    rng = rng or random.Random()
+    target = amount + fee_model.fee(0, 1)
+    # the outputs smaller than what is needed, one larger output is greedy's answer
+    candidates = _candidates(utxos, target + fee_model.per_input - 1, fee_model)
+    values = [x.amount - fee_model.per_input for x in candidates]
+    if sum(values) < target:
+        return None
+
+    best, best_value = [True] * len(values), sum(values)
+    # seconds the last pass took: no pass is started that would end past the deadline
+    last = 0.0
+    for _ in range(iterations):
+        started = time.perf_counter()
+        if deadline is not None and started + last > deadline:
+            break
+        included, value = [False] * len(values), 0
+        # first pass: random outputs, second pass: all the others, until the target is overshot
+        for step in range(2):
+            bits = f'{rng.getrandbits(len(values)):0{len(values)}b}' if step == 0 else ''
+            for i, v in enumerate(values):
+                if included[i] or (step == 0 and bits[i] == '0'):
+                    continue
+                value += v
+                included[i] = True
+                if value >= target:
+                    if value < best_value:
+                        best_value, best = value, included.copy()
+                    # and look for a smaller overshoot without it
+                    value -= v
+                    included[i] = False
+            if best_value == target:
+                break
+        if best_value == target:
+            break
+        last = time.perf_counter() - started
+    return Selection([x for x, is_included in zip(candidates, best) if is_included], amount, fee_model, 'knapsack')
+
+
+def select(utxos: SortedUtxos, amount: int, fee_model: FeeModel = None, budget: float = None) -> Optional[Selection]:
+    """
+    Outputs paying `amount` and the fee, or None when there aren't enough. An exact match without change
+    is preferred. When no output pays by itself, the knapsack and greedy sets are compared on their fee,
+    then their change.
+    """
+    fee_model = fee_model or FeeModel()
+    start = time.perf_counter()
+    budget = Config.COIN_SELECTION_BUDGET if budget is None else budget
+    exact = select_branch_and_bound(utxos, amount, fee_model, deadline=start + budget / 2)
+    if exact is not None:
+        return exact
+    greedy = select_greedy(utxos, amount, fee_model)
+    if greedy is None or len(greedy.inputs) == 1:
+        return greedy
+    # knapsack only gets what is left of the budget, and finds nothing when the largest
+    # Config.COIN_SELECTION_CANDIDATES outputs don't pay the amount
+    knapsack = None
+    if time.perf_counter() < start + budget:
+        knapsack = select_knapsack(utxos, amount, fee_model, deadline=start + budget)
+    found = [x for x in (greedy, knapsack) if x is not None]
+    return min(found, key=lambda x: (x.fee, x.total)) if found else None
@@ -1,3 +1,6 @@
+import os
+
+
 class Config:
     # The mining reward could decrease over time like bitcoin
     BITCOIN = 100_000_000  # 100M satoshis
@@ -5,10 +8,15 @@ class Config:
 
     # Usually it's a fee over transaction size (not quantity)
     FEE_PER_TRANSACTION = 1
+    # Extra fee per input wallets pay when selecting the outputs to spend
+    FEE_PER_INPUT = 0
 
     # Usually the limit is determined by block size (not quantity)
     TRANSACTIONS_PER_BLOCK = 2
 
+    # Unconfirmed transactions kept by a node, the lowest fee per byte are evicted first
+    MEMPOOL_MAX_TRANSACTIONS = 50_000
+
     TEST_WALLET_1 = {'id': '912c953c25ce493dad7ace6fec066e28',
                      'public_key': '30819f300d06092a864886f70d010101050003818d0030818902818100b348736807b33cb9c56337db8d2f87be052970eb27178b69512f5cd7a38d0bc9bfc1b92dbc51b2f551b68c9deb51cf12336438fd444ba9d61aa1b07340db32b745c71d25dc9deaed7934c2045f97cdc998af11d42d033fdbff79065b01305e2c15331e9f40942246217fc2c230739faca85ad2ff29d9c3e037fa64c194a3ac590203010001',
                      'private_key': '3082025b02010002818100b348736807b33cb9c56337db8d2f87be052970eb27178b69512f5cd7a38d0bc9bfc1b92dbc51b2f551b68c9deb51cf12336438fd444ba9d61aa1b07340db32b745c71d25dc9deaed7934c2045f97cdc998af11d42d033fdbff79065b01305e2c15331e9f40942246217fc2c230739faca85ad2ff29d9c3e037fa64c194a3ac5902030100010281802437cd34a56594ad74ce4bf0fb0f308d772e7d84cbd36a52fed7221ae00bf4e72f695bd6fcf5c640dfde907eb094c8cfc4f908b8456d41a4a2a1aa6b461d621ba47d2213786f5526e18717e083a0cafd244c4ddf20acc4550e4c9889e86ba094973da3dd367ccf7112bc551a6f563c20ffd84ad36209a1f83378408eff9af799024100cb7cb3547c4b2dbe68d3d29cbf57ab1342dd5442889575ac4d4bd7058cff3d84c039ee5c0dc3362095d752ed5f5af256cdafda7eb4d18fcb5e8e6ac3b6f66a6d024100e18cb72b7b6faa020bce61145ae54fd09df9111a22808baf951027a84565dddf4dbcbb74c27e0ca4a850db70eb084f4cab87d07df72764742fdfd184333d561d02400728f21e6ce93048dce3672bc0c7d2eb30951d1be236701789f8bb2e24d1ee563775525fc6d431995fec5daca08850b2a13628d80080c7307eb9402476d1a0d902407f79b84cab07015f06ad2dd1034e773dc10af3cf81908562472d4a3ca07c6259c2e5d84cb55fe865677bcb8a964bac05f92c5979d8263b702f5ea05bc759f3410240068f66c5df9190664450840c549e9adf6169e87cf336d77e95e1c372df1a7189bfb0bb038f402df7631cf291b6c2cdc59b9277def9538e07ba3087c985054fe2'}
@@ -36,12 +44,82 @@ class Config:
         'previous_hash': 0,
         'nonce': 0,
         'timestamp': 1575888715.074447,
-        'hash': '22ad7015332d64bf0b4508c05d4d0079ad0d0ad01c2ff0843bba0a579d7a976e',
+        'hash': 'b83646c36fe11355457f444b39cf29f95099e4cd7b9e287c30e28944f2088984',
         'transactions': [
             GENESIS_TRANSACTION
         ]
     }
 
+    # Proof of work: target of the first blocks (2 leading zero hex digits) and easiest target allowed.
+    # Every DIFFICULTY_WINDOW blocks the target is adjusted so blocks come every BLOCK_TIME seconds
+    INITIAL_TARGET = (1 << 248) - 1
+    MAX_TARGET = (1 << 248) - 1
+    DIFFICULTY_WINDOW = 20
+    BLOCK_TIME = 10
+    # A block must be later than the median timestamp of the blocks before it and at most
+    # MAX_FUTURE_BLOCK_TIME seconds ahead of our clock, so miners can't choose how long a window took
+    MEDIAN_TIME_BLOCKS = 11
+    MAX_FUTURE_BLOCK_TIME = 60
+
+    # Processes searching the nonce space (1 to mine on the calling thread) and
+    # how many hashes each of them computes between two checks for a solution found elsewhere
+    MINING_WORKERS = os.cpu_count() or 1
+    MINING_BATCH = 20_000
+    # Whether the background miner keeps mining blocks holding only the reward when the pool is empty
+    MINING_EMPTY_BLOCKS = False
+
+    # Parsed public keys and verified (input hash, signature) pairs kept in memory, and the
+    # processes verifying signatures in batches of VERIFY_CHUNK (1 to verify on the calling thread)
+    PUBLIC_KEY_CACHE_SIZE = 4096
+    SIGNATURE_CACHE_SIZE = 200_000
+    VERIFY_WORKERS = os.cpu_count() or 1
+    VERIFY_CHUNK = 64
+
+    # Coin selection: time allowed to look for the best set of outputs, and how many of the largest
+    # outputs of an address the exact match and knapsack searches look at
+    COIN_SELECTION_BUDGET = 0.005
+    COIN_SELECTION_CANDIDATES = 1000
+
+    # Submitted transactions waiting for validation (more are refused until the queue drains), the most
+    # validated together, transactions per bulk request and how many outcomes are kept for status requests
+    INGEST_QUEUE_SIZE = 10_000
+    INGEST_BATCH = 512
+    INGEST_BULK_LIMIT = 1000
+    INGEST_STATUS_SIZE = 100_000
+
+    # Persistent block store: blocks appended between two fsyncs, and blocks between two commits of the
+    # UTXO set and chain index kept in SQLite next to it, a restart only replays the blocks after the last one
+    FSYNC_BATCH_BLOCKS = 16
+    STATE_COMMIT_BLOCKS = 256
+    # Decoded blocks kept in memory by the block store
+    BLOCK_CACHE_SIZE = 256
+
+    # Chain sync: headers returned per request, pages of headers read from a peer in one round
+    # and blocks returned per /blockchain/blocks/range/ request
+    SYNC_HEADERS_LIMIT = 2000
+    SYNC_HEADERS_MAX_PAGES = 50
+    SYNC_BLOCKS_BATCH = 100
+
+    # Blocks of side branches kept in memory in case one of them ends up with more work than the main chain
+    MAX_SIDE_BLOCKS = 10_000
+
+    # Peers: requests in flight at the same time, timeouts in seconds, and how long a peer
+    # failing PEER_MAX_FAILURES times in a row is left out of the rounds
+    PEER_MAX_CONCURRENCY = 16
+    PEER_CONNECT_TIMEOUT = 3
+    PEER_READ_TIMEOUT = 10
+    PEER_MAX_FAILURES = 3
+    PEER_RETRY_AFTER = 60
+
+    # Logging: lowest level written and whether records are JSON objects or plain text lines
+    LOG_LEVEL = 'INFO'
+    LOG_JSON = True
+    # Sampling profiler (off unless started): seconds between two samples, deepest stack kept and
+    # whether clients may start and stop it through /debug/profiler/start/ and /debug/profiler/stop/
+    PROFILER_INTERVAL = 0.005
+    PROFILER_MAX_DEPTH = 64
+    PROFILER_CONTROL = False
+
     SERVER_HOST = '127.0.0.1'
     REDIS_URL_BASE = 'redis://localhost:'
     REDIS_PORT = 6380
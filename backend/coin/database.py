@@ -1,14 +1,30 @@
-from typing import Union, List
+import json
+import logging
+from typing import Union, List, Sequence, Tuple
 
+from coin import codec
+from coin.blockstore import BlockLog, StoredBlocks
+from coin.chainindex import ChainIndex
+from coin.chainstate import StateStore, StoredUtxoSet, StoredChainIndex
+from coin.config import Config
 from coin.domain import Wallet, Block, Transaction
+from coin.mempool import Mempool
+from coin.utxo import UtxoSet, PendingUtxos, BlockUndo
+
+log = logging.getLogger(__name__)
 
 
 class Database:
 
     def __init__(self):
-        self.unconfirmed_transactions = []
+        self.mempool = Mempool()
         self.blocks = []
         self.wallets = []
+        self.utxos = UtxoSet()
+        self.pending_utxos = PendingUtxos()
+        self.index = ChainIndex()
+        # undo record of every block, by height
+        self.undo: List[BlockUndo] = []
 
     def add_wallet(self, wallet: Wallet):
         pass
@@ -16,28 +32,226 @@ class Database:
     def get_wallet_by_id(self, wallet_id) -> Union[Wallet, None]:
         pass
 
-    def get_blocks(self) -> List[Block]:
+    def get_blocks(self) -> Sequence[Block]:
         return self.blocks
 
     def replace_blocks(self, new_blocks):
         self.blocks = new_blocks
+        self.utxos = UtxoSet()
+        self.undo = [self.utxos.apply_block(x) for x in new_blocks]
+        self.pending_utxos = PendingUtxos.from_transactions(self.mempool, self.utxos)
+        self.index = ChainIndex.from_blocks(new_blocks)
 
     def add_block(self, block: Block):
         self.blocks.append(block)
+        self.undo.append(self.utxos.apply_block(block))
+        self.index.add_block(len(self.blocks) - 1, block)
+
+    def truncate_blocks(self, height: int) -> List[Block]:
+        """
+        Disconnects the blocks from `height` to the tip, last first, and returns them in chain order.
+        The UTXO set is rolled back with the undo record of each block.
+        """
+        removed = []
+        while len(self.blocks) > height:
+            block = self.blocks.pop()
+            self.utxos.undo_block(block, self.undo.pop())
+            self.index.remove_block(block)
+            removed.append(block)
+        removed.reverse()
+        return removed
+
+    def refresh_pending_utxos(self):
+        # after the UTXO set changed under the unconfirmed transactions
+        self.pending_utxos = PendingUtxos.from_transactions(self.mempool, self.utxos)
+
+    def remove_unspendable_transactions(self) -> List[Transaction]:
+        """
+        After the UTXO set lost outputs, e.g. those of blocks disconnected by a reorganization, removes the
+        unconfirmed transactions spending an output that is neither unspent nor created by another
+        unconfirmed transaction, then the ones spending their outputs. Returns the removed transactions.
+        """
+        removed = []
+        while True:
+            created = {(tx.hash, i): x.amount for tx in self.mempool for i, x in enumerate(tx.outputs)}
+            stale = []
+            for tx in self.mempool:
+                for input_ in tx.inputs:
+                    output = self.utxos.get(input_.tx_hash, input_.index)
+                    amount = output.amount if output is not None else created.get((input_.tx_hash, input_.index))
+                    if amount != input_.amount:
+                        stale.append(tx)
+                        break
+            if not stale:
+                break
+            removed += [self.mempool.remove(tx.hash) for tx in stale]
+        self.refresh_pending_utxos()
+        return removed
+
+    def get_block_hash(self, height: int) -> str:
+        return self.blocks[height].hash
+
+    def get_block_height(self, block_hash: str) -> Union[int, None]:
+        return self.index.block_height(block_hash)
+
+    def get_block_by_hash(self, block_hash: str) -> Union[Block, None]:
+        height = self.index.block_height(block_hash)
+        return self.get_blocks()[height] if height is not None else None
+
+    def get_transaction(self, tx_hash: str) -> Union[Tuple[Transaction, int], None]:
+        # confirmed transaction and the height of its block
+        location = self.index.transaction_location(tx_hash)
+        if location is None:
+            return None
+        height, position = location
+        return self.get_blocks()[height].transactions[position], height
 
-    def get_transactions(self) -> List[Transaction]:
-        transactions = []
-        for block in self.blocks:
-            transactions += block.transactions
-        return transactions
+    def has_transaction(self, transaction: Transaction) -> bool:
+        return (self.index.transaction_location(transaction.hash) is not None
+                or self.index.transaction_hash(transaction.id) is not None)
 
-    def add_unconfirmed_transaction(self, transaction: Transaction):
-        self.unconfirmed_transactions.append(transaction)
+    def replace_blocks_from(self, height: int, new_blocks: List[Block]):
+        # blocks below `height` are kept, only the blocks above it are undone
+        if height < len(self.get_blocks()):
+            self.truncate_blocks(height)
+            self.refresh_pending_utxos()
+        for block in new_blocks:
+            self.add_block(block)
+
+    def get_utxos(self) -> UtxoSet:
+        return self.utxos
+
+    def get_index(self) -> ChainIndex:
+        return self.index
+
+    def get_pending_utxos(self) -> PendingUtxos:
+        return self.pending_utxos
+
+    def add_unconfirmed_transaction(self, transaction: Transaction) -> bool:
+        if not self.mempool.add(transaction):
+            return False
+        self.pending_utxos.add(transaction, self.utxos)
+        for evicted in self.mempool.trim():
+            self.pending_utxos.remove(evicted)
+        return transaction.hash in self.mempool
 
     def get_unconfirmed_transactions(self) -> List[Transaction]:
-        return self.unconfirmed_transactions
+        return list(self.mempool)
+
+    def has_unconfirmed_transaction(self, transaction: Transaction) -> bool:
+        return transaction.hash in self.mempool or self.mempool.has_id(transaction.id)
+
+    def remove_unconfirmed_transaction(self, tx_hash: str) -> Union[Transaction, None]:
+        removed = self.mempool.remove(tx_hash)
+        if removed is not None:
+            self.pending_utxos.remove(removed)
+        return removed
+
+    def get_mempool(self) -> Mempool:
+        return self.mempool
 
     def remove_transactions_from_unconfirmed_list(self, transactions: List[Transaction]):
+        # mined transactions and the ones spending the same outputs as them
         for tx in transactions:
-            if tx.type == tx.REGULAR:
-                self.unconfirmed_transactions.remove(tx)
+            hashes = [tx.hash] + [self.mempool.spender((x.tx_hash, x.index)) for x in tx.inputs]
+            for tx_hash in hashes:
+                if tx_hash:
+                    self.remove_unconfirmed_transaction(tx_hash)
+
+
+class FileDatabase(Database):
+    """
+    Database whose blocks live in an append-only BlockLog under `directory`, next to a second log
+    holding the undo record of every block.
+    The UTXO set and the chain index are tables of a StateStore in the same directory, committed every
+    Config.STATE_COMMIT_BLOCKS blocks, and only the blocks appended after the last commit are replayed.
+    Unconfirmed transactions and wallets are kept in memory like in Database.
+    """
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.log = BlockLog(directory, hash_of=lambda payload: self._decode(payload).hash)
+        self.undo_log = BlockLog(directory, hash_of=lambda payload: codec.decode_undo(payload)[0], name='undo')
+        self.blocks = StoredBlocks(self.log, self._decode)
+        self.state = StateStore(directory)
+        self.utxos = StoredUtxoSet(self.state)
+        self.index = StoredChainIndex(self.state)
+        self._load_state()
+
+    def get_block_hash(self, height: int) -> str:
+        return self.log.block_hash(height)
+
+    @staticmethod
+    def _encode(block: Block) -> bytes:
+        return codec.encode_block(block)
+
+    @staticmethod
+    def _decode(payload: bytes) -> Block:
+        # blocks written before the binary encoding are JSON objects
+        if payload[:1] == b'{':
+            return Block.from_json(json.loads(payload))
+        return codec.decode_block(payload)
+
+    def _load_state(self):
+        # undo records are written after their block, a crash can leave the undo log behind but never ahead
+        self.undo_log.truncate(len(self.log))
+        height = self.state.height
+        if height and (height > len(self.undo_log) or self.log.block_hash(height - 1) != self.state.tip):
+            log.warning("Chain state doesn't match the block log, rebuilding it")
+            self.state.reset()
+            self.index = StoredChainIndex(self.state)
+            height = 0
+        self.undo_log.truncate(height)
+        for position in range(height, len(self.blocks)):
+            block = self.blocks[position]
+            self.undo_log.append(codec.encode_undo(block.hash, self.utxos.apply_block(block)), block.hash)
+            self.index.add_block(position, block)
+        if height < len(self.log):
+            self._commit_state()
+
+    def _commit_state(self):
+        # the state must never be ahead of what is durable in the logs
+        self.log.flush(force=True)
+        self.undo_log.flush(force=True)
+        self.state.commit(len(self.log), self.log.block_hash(len(self.log) - 1) if len(self.log) else None)
+
+    def add_block(self, block: Block):
+        self.log.append(self._encode(block), block.hash)
+        undo = self.utxos.apply_block(block)
+        self.undo_log.append(codec.encode_undo(block.hash, undo), block.hash)
+        self.index.add_block(len(self.log) - 1, block)
+        if len(self.log) % Config.STATE_COMMIT_BLOCKS == 0:
+            self._commit_state()
+
+    def truncate_blocks(self, height: int) -> List[Block]:
+        removed = []
+        for position in range(len(self.log) - 1, height - 1, -1):
+            block = self.blocks[position]
+            _, undo = codec.decode_undo(self.undo_log.read(position))
+            self.utxos.undo_block(block, undo)
+            self.index.remove_block(block)
+            removed.append(block)
+        # committed before the logs are cut, so the state is never left with blocks that are gone
+        self.log.flush(force=True)
+        self.undo_log.flush(force=True)
+        self.state.commit(height, self.log.block_hash(height - 1) if height else None)
+        self.log.truncate(height)
+        self.undo_log.truncate(height)
+        removed.reverse()
+        return removed
+
+    def replace_blocks(self, new_blocks):
+        # keep the common prefix on disk, comparing the hashes stored in the index
+        common = 0
+        limit = min(len(self.log), len(new_blocks))
+        while common < limit and self.log.block_hash(common) == new_blocks[common].hash:
+            common += 1
+        self.replace_blocks_from(common, list(new_blocks[common:]))
+        self.log.flush(force=True)
+        self.undo_log.flush(force=True)
+
+    def close(self):
+        self._commit_state()
+        self.state.close()
+        self.log.close()
+        self.undo_log.close()
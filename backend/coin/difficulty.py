@@ -0,0 +1,98 @@
+"""
+Proof of work targets.
+
+A block is valid when its hash, read as a 256 bits number, is at most the target of its height.
+Blocks 0 to Config.DIFFICULTY_WINDOW - 1 use Config.INITIAL_TARGET. At every multiple of the window
+the target of the previous block is scaled by how long the last window of blocks took compared with
+Config.BLOCK_TIME seconds per block, by a factor 4 at most either way, and otherwise carried over.
+So the target of a block only depends on the targets and timestamps of the blocks before it, which
+the chain index keeps for every height.
+
+Since the timestamps set the targets, a block must be later than the median of the
+Config.MEDIAN_TIME_BLOCKS blocks before it and at most Config.MAX_FUTURE_BLOCK_TIME seconds ahead
+of the clock of the node checking it (see timestamp_error).
+"""
+import time
+from typing import Callable, List, Optional
+
+from coin.config import Config
+
+
+def target_bytes(target: int) -> bytes:
+    # comparing 32 bytes digests with this is the same as comparing the numbers
+    return target.to_bytes(32, 'big')
+
+
+def meets_target(block_hash: str, target: int) -> bool:
+    return int(block_hash, 16) <= target
+
+
+def work(target: int) -> int:
+    # expected number of hashes to find a hash at most `target`
+    return (1 << 256) // (target + 1)
+
+
+def next_target(height: int, timestamp_of: Callable[[int], float], target_of: Callable[[int], int]) -> int:
+    """
+    Target of the block at `height`, from the timestamps and targets of the blocks below it.
+    """
+    window = Config.DIFFICULTY_WINDOW
+    if height < window:
+        return Config.INITIAL_TARGET
+    previous = target_of(height - 1)
+    if height % window != 0:
+        return previous
+    expected = (window - 1) * Config.BLOCK_TIME
+    elapsed = timestamp_of(height - 1) - timestamp_of(height - window)
+    elapsed = min(max(elapsed, expected / 4), expected * 4)
+    return max(min(previous * int(elapsed * 1000) // int(expected * 1000), Config.MAX_TARGET), 1)
+
+
+def median_time_past(height: int, timestamp_of: Callable[[int], float]) -> float:
+    # median timestamp of the Config.MEDIAN_TIME_BLOCKS blocks below `height`
+    timestamps = sorted([timestamp_of(x) for x in range(max(height - Config.MEDIAN_TIME_BLOCKS, 0), height)])
+    return timestamps[len(timestamps) // 2]
+
+
+def timestamp_error(height: int, timestamp, timestamp_of: Callable[[int], float], now: float = None) -> Optional[str]:
+    """
+    What is wrong with `timestamp` for a block at `height` on top of the blocks whose timestamps
+    `timestamp_of` gives, or None.
+    """
+    if type(timestamp) not in (int, float):
+        return "timestamp is not a number"
+    if height > 0 and timestamp <= median_time_past(height, timestamp_of):
+        return "timestamp is not later than the median of the previous blocks"
+    if timestamp > (time.time() if now is None else now) + Config.MAX_FUTURE_BLOCK_TIME:
+        return "timestamp is too far in the future"
+    return None
+
+
+class TargetSchedule:
+    """
+    Targets of a branch forking from the main chain: heights below `start` come from the chain index,
+    the following ones are computed as the timestamps of the branch blocks are added.
+    """
+
+    def __init__(self, index, start: int):
+        self.index = index
+        self.start = start
+        self._timestamps: List[float] = []
+        self._targets: List[int] = []
+
+    def timestamp(self, height: int) -> float:
+        return self.index.timestamp(height) if height < self.start else self._timestamps[height - self.start]
+
+    def target(self, height: int) -> int:
+        return self.index.target(height) if height < self.start else self._targets[height - self.start]
+
+    def timestamp_error(self, timestamp: float) -> Optional[str]:
+        # see timestamp_error, for the next block of the branch
+        return timestamp_error(self.start + len(self._targets), timestamp, self.timestamp)
+
+    def add(self, timestamp: float) -> int:
+        # target of the next block of the branch, whose timestamp is `timestamp`
+        target = next_target(self.start + len(self._targets), self.timestamp, self.target)
+        self._timestamps.append(timestamp)
+        self._targets.append(target)
+        return target
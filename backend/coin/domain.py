@@ -1,4 +1,9 @@
 import binascii
+import hashlib
+import json
+import logging
+import struct
+import sys
 from collections import OrderedDict
 from typing import List
 from typing import TypeVar, Type, Optional
@@ -7,18 +12,26 @@ import Crypto
 from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
 
-from coin import util
+from coin import util, signatures
 from coin.config import Config
 
 T = TypeVar('T')
+log = logging.getLogger(__name__)
+
+
+def _intern(value):
+    # addresses and transaction hashes are repeated all over the chain, keep a single copy of each
+    return sys.intern(value) if type(value) is str else value
 
 
 class InputInfo:
+    __slots__ = ('tx_hash', 'index', 'amount', 'address', 'signature')
+
     def __init__(self, tx_hash, index, amount, address, signature=None):
-        self.tx_hash = tx_hash
+        self.tx_hash = _intern(tx_hash)
         self.index = index  # index of the transaction taken from a previous unspent transaction output
         self.amount = amount  # amount of satoshis
-        self.address = address  # from address
+        self.address = _intern(address)  # from address
         # transaction input hash: sha256 (tx_hash + index + amount + address)
         # signed with owner's address secret key (128 bytes)
         self.signature = signature
@@ -41,21 +54,29 @@ class InputInfo:
         val.pop('signature')
         return val
 
+    def message(self) -> bytes:
+        # what the owner of the address signs
+        return json.dumps(self._to_json_no_signature()).encode('utf8')
+
+    def signature_job(self) -> signatures.Job:
+        return self.address, self.message(), self.signature
+
     def check(self) -> bool:
-        return util.verify_hash(self.address, self.compute_hash(), self.signature)
+        return signatures.verify_signature(*self.signature_job())
 
     def compute_hash(self) -> SHA256.SHA256Hash:
         return util.crypto_hash(self._to_json_no_signature())
 
     def sign(self, private_key: str) -> str:
-        private_key = util.import_rsa_key(private_key)
-        return util.sign_hash(private_key, self.compute_hash())
+        return signatures.sign_messages(private_key, [self.message()])[0]
 
 
 class OutputInfo:
+    __slots__ = ('amount', 'address')
+
     def __init__(self, amount, address):
         self.amount = amount  # amount of satoshis
-        self.address = address  # to address
+        self.address = _intern(address)  # to address
 
     @classmethod
     def from_json(cls: Type[T], data) -> T:
@@ -73,13 +94,15 @@ class Transaction:
     REWARD = 'reward'
     FEE = 'fee'
 
+    __slots__ = ('inputs', 'outputs', 'type', 'id', 'hash')
+
     def __init__(self, id_, type_=None, hash_=None, inputs: List[InputInfo] = None,
                  outputs: List[OutputInfo] = None):
         self.inputs = inputs
         self.outputs = outputs
-        self.type = type_
+        self.type = _intern(type_)
         self.id = id_
-        self.hash = hash_
+        self.hash = _intern(hash_)
 
     def to_json(self) -> dict:
         return OrderedDict({
@@ -108,11 +131,30 @@ class Transaction:
         self.hash = signature
 
     def check(self) -> bool:
-        if self.hash != self.compute_hash():
-            print("Uneven tx hashes", self.type)
+        if not self.check_structure():
+            return False
+        if not all(signatures.verify_signatures([x.signature_job() for x in self.inputs])):
+            log.debug("Transaction '%s' has an invalid input signature", self.hash)
+            return False
+        return True
+
+    def _well_typed(self) -> bool:
+        # fields of the types the codec stores, so a transaction of a peer can't fail once accepted
+        if not all(type(x) is str for x in (self.id, self.type, self.hash)):
+            return False
+        if not all(type(x.tx_hash) is str and type(x.address) is str and type(x.index) is int
+                   and type(x.amount) is int and (x.signature is None or type(x.signature) is str)
+                   for x in self.inputs):
             return False
-        if not all([x.check() for x in self.inputs]):
-            print("jdfdsf")
+        return all(type(x.address) is str and type(x.amount) is int for x in self.outputs)
+
+    def check_structure(self) -> bool:
+        # everything but the signatures
+        if not self._well_typed():
+            log.debug("Transaction '%s' has malformed fields", self.hash)
+            return False
+        if self.hash != self.compute_hash():
+            log.debug("Transaction '%s' doesn't match its hash", self.hash)
             return False
 
         # for regular type
@@ -125,7 +167,7 @@ class Transaction:
 
             # if enough fee
             if not (inputs_sum - outputs_sum >= Config.FEE_PER_TRANSACTION):
-                print("Fee not enough")
+                log.debug("Transaction '%s' doesn't pay enough fee", self.hash)
                 return False
 
             # make sure there's no negative output
@@ -175,16 +217,93 @@ class Wallet:
         }
 
     def sign_transaction(self, transaction: Transaction) -> Transaction:
-        signer = util.import_rsa_key(self.identity_private)
-        for input_ in transaction.inputs:
-            h = util.hash_str(input_.tx_hash + str(input_.index) + str(input_.amount) + input_.address)
-            input_.signature = util.sign_hash(signer, h)
-        transaction.hash = transaction.compute_hash()
-        return transaction
+        return self.sign_transactions([transaction])[0]
+
+    def sign_transactions(self, transactions: List[Transaction]) -> List[Transaction]:
+        # the inputs of all the transactions are signed in one batch, each over its message like InputInfo.check expects
+        inputs = [x for tx in transactions for x in tx.inputs]
+        signed = signatures.sign_messages(self.identity_private, [x.message() for x in inputs])
+        for input_, signature in zip(inputs, signed):
+            input_.signature = signature
+        for tx in transactions:
+            tx.hash = tx.compute_hash()
+        return transactions
+
+
+class BlockHeader:
+    """
+    Fixed-size part of a block that gets hashed:
+        index: u64 | previous hash: 32 bytes | merkle root of the transaction hashes: 32 bytes | timestamp: f64 | nonce: u64
+    The first four fields only change when the block content changes, so they are packed once
+    and mining or validating only hashes those bytes followed by the nonce.
+    """
+    PREFIX = struct.Struct('<Q32s32sd')
+    NONCE = struct.Struct('<Q')
+
+    def __init__(self, index, previous_hash, merkle_root: str, timestamp, nonce=None, hash_: str = None):
+        self.index = index
+        self.previous_hash = previous_hash
+        self.merkle_root = merkle_root
+        self.timestamp = timestamp
+        self.nonce = nonce
+        self.hash = hash_
+
+    @classmethod
+    def pack_prefix(cls, index, previous_hash, merkle_root: bytes, timestamp) -> bytes:
+        # the genesis block has no previous block and uses 0, malformed fields raise ValueError
+        if previous_hash is None or (type(previous_hash) is int and previous_hash == 0):
+            previous_hash = bytes(32)
+        elif isinstance(previous_hash, str) and len(previous_hash) == 64:
+            previous_hash = bytes.fromhex(previous_hash)
+        else:
+            raise ValueError(f"Previous hash isn't a block hash: {previous_hash!r}")
+        if len(merkle_root) != 32:
+            raise ValueError("Merkle root isn't 32 bytes")
+        try:
+            return cls.PREFIX.pack(index, previous_hash, merkle_root, timestamp)
+        except struct.error as e:
+            raise ValueError(f"Header can't be packed: {e}")
+
+    @classmethod
+    def hash_with_nonce(cls, prefix: bytes, nonce) -> str:
+        try:
+            return hashlib.sha256(prefix + cls.NONCE.pack(nonce or 0)).hexdigest()
+        except struct.error as e:
+            raise ValueError(f"Nonce can't be packed: {e}")
+
+    def compute_hash(self) -> str:
+        if not isinstance(self.merkle_root, str):
+            raise ValueError(f"Merkle root isn't a hex string: {self.merkle_root!r}")
+        prefix = self.pack_prefix(self.index, self.previous_hash, bytes.fromhex(self.merkle_root), self.timestamp)
+        return self.hash_with_nonce(prefix, self.nonce)
+
+    def to_json(self) -> dict:
+        return OrderedDict({
+            'index': self.index,
+            'previous_hash': self.previous_hash,
+            'merkle_root': self.merkle_root,
+            'timestamp': self.timestamp,
+            'nonce': self.nonce,
+            'hash': self.hash
+        })
+
+    @classmethod
+    def from_json(cls: Type[T], data: dict) -> T:
+        return BlockHeader(data['index'], data['previous_hash'], data['merkle_root'], data['timestamp'],
+                           data['nonce'], data.get('hash'))
 
 
 class Block:
+    # changing any of these invalidates the packed header
+    HEADER_FIELDS = {'index', 'transactions', 'timestamp', 'previous_hash'}
+
+    __slots__ = ('index', 'transactions', 'timestamp', 'previous_hash', 'nonce', 'hash',
+                 '_header_prefix', '_merkle_root', '_merkle_mutated')
+
     def __init__(self, index, transactions: List[Transaction], timestamp, previous_hash, hash_: str = None, nonce=None):
+        self._header_prefix = None
+        self._merkle_root = None
+        self._merkle_mutated = None
         self.index = index
         self.transactions = transactions
         self.timestamp = timestamp
@@ -192,6 +311,13 @@ class Block:
         self.nonce = nonce
         self.hash = hash_
 
+    def __setattr__(self, key, value):
+        if key in Block.HEADER_FIELDS:
+            object.__setattr__(self, '_header_prefix', None)
+            if key == 'transactions':
+                object.__setattr__(self, '_merkle_root', None)
+        object.__setattr__(self, key, value)
+
     def to_json_no_hash(self):
         val = self.to_json()
         val.pop('hash')
@@ -212,5 +338,34 @@ class Block:
         return Block(data['index'], [Transaction.from_json(x) for x in data['transactions']],
                      data['timestamp'], data['previous_hash'], data.get('hash'), data['nonce'])
 
+    def _build_merkle_tree(self):
+        # the leaves are hashed from the content of the transactions, not taken from their `hash`,
+        # so the proof of work covers everything in the block
+        if self._merkle_root is None:
+            self._merkle_root, self._merkle_mutated = util.merkle_tree([x.compute_hash() for x in self.transactions])
+
+    @property
+    def merkle_root(self) -> bytes:
+        self._build_merkle_tree()
+        return self._merkle_root
+
+    @property
+    def merkle_mutated(self) -> bool:
+        # see util.merkle_tree
+        self._build_merkle_tree()
+        return self._merkle_mutated
+
+    @property
+    def header_prefix(self) -> bytes:
+        if self._header_prefix is None:
+            self._header_prefix = BlockHeader.pack_prefix(self.index, self.previous_hash, self.merkle_root,
+                                                          self.timestamp)
+        return self._header_prefix
+
+    @property
+    def header(self) -> BlockHeader:
+        return BlockHeader(self.index, self.previous_hash, self.merkle_root.hex(), self.timestamp, self.nonce,
+                           self.hash)
+
     def compute_hash(self) -> str:
-        return util.crypto_hash(self.to_json_no_hash()).hexdigest()
+        return BlockHeader.hash_with_nonce(self.header_prefix, self.nonce)
@@ -0,0 +1,106 @@
+"""
+Ingestion of submitted transactions away from the request threads.
+
+submit() only refuses the transactions already known and queues the others, so a request returns as soon
+as its transactions are parsed. A worker thread drains the queue in batches of up to Config.INGEST_BATCH:
+the signatures of a batch are verified together by the signatures process pool and the batch enters the
+pool under a single lock (see Blockchain.add_new_transactions). on_batch is then called once with the
+transactions accepted, so a burst of submissions triggers a single mining attempt.
+The outcome of the last Config.INGEST_STATUS_SIZE transactions is kept for status().
+"""
+import logging
+import queue
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+from coin.config import Config
+from coin.domain import Transaction
+
+log = logging.getLogger(__name__)
+
+
+class TransactionPipeline:
+    QUEUED = 'queued'
+    ACCEPTED = 'accepted'
+    REJECTED = 'rejected'
+    # the queue is full, nothing was recorded and the transaction can be sent again later
+    BUSY = 'busy'
+
+    def __init__(self, blockchain, on_batch: Callable[[List[Transaction]], None] = None):
+        self.blockchain = blockchain
+        self.on_batch = on_batch
+        self._queue = queue.Queue(maxsize=Config.INGEST_QUEUE_SIZE)
+        self._statuses = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ingestion', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def __len__(self) -> int:
+        # transactions waiting for validation
+        return self._queue.qsize()
+
+    def submit(self, tx: Transaction) -> str:
+        with self._lock:
+            status = self._statuses.get(tx.hash)
+            if status in (self.QUEUED, self.ACCEPTED):
+                return status
+            if self.blockchain.database.has_unconfirmed_transaction(tx) or self.blockchain.database.has_transaction(tx):
+                return self._set_status(tx.hash, self.REJECTED)
+            try:
+                self._queue.put_nowait(tx)
+            except queue.Full:
+                return self.BUSY
+            return self._set_status(tx.hash, self.QUEUED)
+
+    def status(self, tx_hash: str) -> Optional[str]:
+        with self._lock:
+            return self._statuses.get(tx_hash)
+
+    def _set_status(self, tx_hash: str, status: str) -> str:
+        self._statuses[tx_hash] = status
+        self._statuses.move_to_end(tx_hash)
+        if len(self._statuses) > Config.INGEST_STATUS_SIZE:
+            self._statuses.popitem(last=False)
+        return status
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            # waits for a transaction, then takes the ones already queued behind it
+            batch = [self._queue.get()]
+            while len(batch) < Config.INGEST_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # stop() queues None
+            stopping = None in batch
+            batch = [x for x in batch if x is not None]
+            if batch:
+                self._process(batch)
+
+    def _process(self, batch: List[Transaction]):
+        try:
+            added = self.blockchain.add_new_transactions(batch)
+        except Exception as e:
+            log.exception("Unable to add %d transactions: %s", len(batch), e)
+            added = [False] * len(batch)
+        with self._lock:
+            for tx, is_added in zip(batch, added):
+                self._set_status(tx.hash, self.ACCEPTED if is_added else self.REJECTED)
+        accepted = [tx for tx, is_added in zip(batch, added) if is_added]
+        if accepted and self.on_batch is not None:
+            self.on_batch(accepted)
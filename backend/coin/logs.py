@@ -0,0 +1,40 @@
+"""
+Logging of the node. Every module logs to logging.getLogger(__name__) with %-style arguments, so nothing
+is formatted for the records below the level. configure() sends the records to stderr, one JSON object
+per line by default: time, level, logger, message and the fields passed with `extra`.
+"""
+import json
+import logging
+import sys
+
+from coin.config import Config
+
+# attributes every LogRecord has, the others come from `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure(level: str = None, json_format: bool = None):
+    handler = logging.StreamHandler(sys.stderr)
+    if Config.LOG_JSON if json_format is None else json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level or Config.LOG_LEVEL)
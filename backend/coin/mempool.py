@@ -0,0 +1,134 @@
+import heapq
+import itertools
+import json
+import logging
+from typing import Dict, List, Optional, Callable, Iterator
+
+from coin.config import Config
+from coin.domain import Transaction
+from coin.utxo import Outpoint
+
+log = logging.getLogger(__name__)
+
+
+class MempoolEntry:
+    def __init__(self, tx: Transaction, sequence: int):
+        self.tx = tx
+        self.sequence = sequence
+        self.fee = sum([x.amount for x in tx.inputs]) - sum([x.amount for x in tx.outputs])
+        # Usually the size is the size of the serialized transaction
+        self.size = len(json.dumps(tx.to_json()))
+        self.fee_rate = self.fee / self.size
+
+
+class Mempool:
+    """
+    Unconfirmed transactions by hash, in arrival order, with their ids indexed too so a
+    transaction resubmitted through another path is recognized as a duplicate.
+
+    Every output spent by a transaction of the pool is mapped to that transaction, so a transaction
+    spending an output already spent by another one is refused (first seen wins) in O(inputs).
+    Two heaps ordered by fee per byte, then fee, then arrival give the best transactions to mine
+    and the worst ones to evict when the pool is over capacity. Entries leaving the pool are
+    dropped from the heaps lazily, when they reach the top.
+    """
+
+    def __init__(self, capacity: int = None):
+        self.capacity = capacity or Config.MEMPOOL_MAX_TRANSACTIONS
+        self._entries: Dict[str, MempoolEntry] = {}
+        self._ids: Dict[str, str] = {}
+        self._spenders: Dict[Outpoint, str] = {}
+        self._best = []
+        self._worst = []
+        self._sequence = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, tx_hash: str) -> bool:
+        return tx_hash in self._entries
+
+    def __iter__(self) -> Iterator[Transaction]:
+        return (x.tx for x in list(self._entries.values()))
+
+    def has_id(self, tx_id: str) -> bool:
+        return tx_id in self._ids
+
+    def entry(self, tx_hash: str) -> Optional[MempoolEntry]:
+        return self._entries.get(tx_hash)
+
+    def get(self, tx_hash: str) -> Optional[Transaction]:
+        entry = self._entries.get(tx_hash)
+        return entry.tx if entry else None
+
+    def spender(self, outpoint: Outpoint) -> Optional[str]:
+        return self._spenders.get(outpoint)
+
+    def conflicts(self, tx: Transaction) -> List[str]:
+        spenders = [self._spenders.get((x.tx_hash, x.index)) for x in tx.inputs]
+        return [x for x in spenders if x is not None and x != tx.hash]
+
+    def add(self, tx: Transaction) -> bool:
+        if tx.hash in self._entries or tx.id in self._ids:
+            return False
+        if self.conflicts(tx):
+            log.debug("Transaction '%s' spends outputs already spent in the pool", tx.hash)
+            return False
+        entry = MempoolEntry(tx, next(self._sequence))
+        self._entries[tx.hash] = entry
+        self._ids[tx.id] = tx.hash
+        for input_ in tx.inputs:
+            self._spenders[(input_.tx_hash, input_.index)] = tx.hash
+        heapq.heappush(self._best, (-entry.fee_rate, -entry.fee, entry.sequence, tx.hash))
+        heapq.heappush(self._worst, (entry.fee_rate, entry.fee, -entry.sequence, tx.hash))
+        return True
+
+    def remove(self, tx_hash: str) -> Optional[Transaction]:
+        entry = self._entries.pop(tx_hash, None)
+        if entry is None:
+            return None
+        if self._ids.get(entry.tx.id) == tx_hash:
+            del self._ids[entry.tx.id]
+        for input_ in entry.tx.inputs:
+            outpoint = (input_.tx_hash, input_.index)
+            if self._spenders.get(outpoint) == tx_hash:
+                del self._spenders[outpoint]
+        if len(self._best) > 2 * len(self._entries) + 64:
+            self._rebuild_heaps()
+        return entry.tx
+
+    def _is_live(self, item) -> bool:
+        entry = self._entries.get(item[3])
+        return entry is not None and entry.sequence == abs(item[2])
+
+    def _rebuild_heaps(self):
+        self._best = [x for x in self._best if self._is_live(x)]
+        self._worst = [x for x in self._worst if self._is_live(x)]
+        heapq.heapify(self._best)
+        heapq.heapify(self._worst)
+
+    def trim(self) -> List[Transaction]:
+        # evicts the lowest paying transactions while the pool is over capacity
+        evicted = []
+        while len(self._entries) > self.capacity:
+            item = heapq.heappop(self._worst)
+            if self._is_live(item):
+                evicted.append(self.remove(item[3]))
+        return evicted
+
+    def select(self, count: int, accept: Callable[[Transaction], bool] = None) -> List[Transaction]:
+        """
+        Up to `count` transactions in decreasing order of fee per byte, skipping those refused by `accept`.
+        """
+        selected, popped = [], []
+        while self._best and len(selected) < count:
+            item = heapq.heappop(self._best)
+            if not self._is_live(item):
+                continue
+            popped.append(item)
+            tx = self._entries[item[3]].tx
+            if accept is None or accept(tx):
+                selected.append(tx)
+        for item in popped:
+            heapq.heappush(self._best, item)
+        return selected
@@ -0,0 +1,176 @@
+"""
+Counters, gauges and latency histograms of the node, rendered in the Prometheus text format by /metrics.
+
+The modules doing the work create their metrics once, at import time, with the names of their labels.
+An update is a dictionary lookup and an addition under the metric's lock. Values that already live
+somewhere else (pool size, chain height, hashes of the mining engine) are read by a callback when
+the metrics are rendered instead of being updated on every change.
+"""
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Tuple
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, 'Metric'] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: 'Metric'):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise Exception(f"Metric '{metric.name}' already registered")
+            self._metrics[metric.name] = metric
+
+    def unregister(self, name: str):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def get(self, name: str) -> 'Metric':
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Metric:
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, help_: str, labels: Tuple[str, ...] = (), callback: Callable[[], float] = None):
+        self.name = name
+        self.help = help_
+        self.label_names = tuple(labels)
+        # unlabeled metrics only: the value is read from the callback when rendering
+        self.callback = callback
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: dict) -> LabelValues:
+        return tuple(str(labels[x]) for x in self.label_names)
+
+    def _format_labels(self, key: LabelValues, extra: List[Tuple[str, str]] = ()) -> str:
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        if self.callback is None:
+            return
+        try:
+            value = self.callback()
+        except Exception:
+            # whatever the callback reads may not be there yet
+            return
+        yield self.name, '', value
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name: str, help_: str, labels: Tuple[str, ...] = (), callback: Callable[[], float] = None):
+        super().__init__(name, help_, labels, callback)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        yield from super().samples()
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, self._format_labels(key), value
+
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class _Timer:
+    def __init__(self, histogram: 'Histogram', labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    # seconds
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name: str, help_: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = None):
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+        # per label values: count of observations in each bucket (not cumulative, the last one is +Inf) and sum
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            counts[position] += 1
+            self._sums[key] += value
+
+    def time(self, **labels) -> _Timer:
+        # with histogram.time(): ... observes the time spent in the block
+        return _Timer(self, labels)
+
+    def count(self, **labels) -> int:
+        return sum(self._counts.get(self._key(labels), []))
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), self._sums[key]) for key, counts in self._counts.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', self._format_labels(key, [('le', _format_number(bound))]), cumulative
+            yield self.name + '_sum', self._format_labels(key), total
+            yield self.name + '_count', self._format_labels(key), cumulative
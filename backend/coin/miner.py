@@ -1,100 +1,70 @@
 import datetime
-from functools import reduce, partial
-from typing import List, Union
+import logging
+from typing import Union
 
 from coin import util
 from coin.blockchain import Blockchain
 from coin.config import Config
-from coin.domain import Transaction, InputInfo, Block
+from coin.domain import Transaction, Block
+from coin.pow import ProofOfWorkEngine
 
 """
 The Miner gets the list of pending transactions and create a new block containing the transactions.
 By configuration, every block has at most 2 transactions in it.
 
 Assembling a new block:
-    1.  From the list of unconfirmed transaction, select candidate transactions that are not already in the 
-        blockchain or not already selected.
-    2.  Get the first two transaction from the candidate list of transactions
+    1.  From the mempool, take the unconfirmed transactions paying the highest fee per byte first,
+        skipping those spending outputs that are already spent in the blockchain.
+    2.  Stop after the first two transactions found
     3.  Add a new transaction containing the fee value to the miner's address, 1 satoshi per transactions;
     4.  Add a reward transaction containing 50 coins to the miner's address.
     5.  Prove work of this block.
 """
 
+log = logging.getLogger(__name__)
+
 
 class Miner:
-    def __init__(self, blockchain: Blockchain):
+    def __init__(self, blockchain: Blockchain, engine: ProofOfWorkEngine = None):
         self.blockchain = blockchain
+        self.engine = engine or ProofOfWorkEngine()
 
-    def proof_of_work(self, block: Block):
-        block.nonce = 0
-        computed_hash = block.compute_hash()
-        while not computed_hash.startswith('0' * self.blockchain.difficulty):
-            block.nonce += 1
-            computed_hash = block.compute_hash()
+    def proof_of_work(self, block: Block) -> Union[str, None]:
+        result = self.engine.search(block.header_prefix, self.blockchain.next_target())
+        if result is None:
+            return None
+        block.nonce, computed_hash = result
         return computed_hash
 
     def mine(self, reward_address, fee_address) -> Union[Block, None]:
         new_block = self.generate_block(reward_address, fee_address)
         if new_block:
             proof = self.proof_of_work(new_block)
+            if proof is None:
+                log.info("Mining cancelled")
+                return None
             return self.blockchain.add_block(new_block, proof)
         else:
-            print("No block generated")
+            log.info("No block generated")
         return None
 
     def generate_block(self, reward_address, fee_address) -> Block:
         previous_hash = self.blockchain.last_block.hash
-        index = self.blockchain.last_block.index
-        candidate_transactions = self.blockchain.unconfirmed_transactions
-        selected = []
-        rejected = []
-
-        # ===========================================
-        def transactions_to_inputs(transactions) -> List[InputInfo]:
-            def mapper(x: Transaction) -> List[InputInfo]:
-                return x.inputs
-
-            def reducer(x: List[InputInfo], y: List[InputInfo]) -> List[InputInfo]:
-                return x + y
-
-            return reduce(reducer, map(mapper, transactions), [])
-
-        def input_equals(a: InputInfo, b: InputInfo):
-            return a.tx_hash == b.tx_hash and a.index == b.index
+        index = self.blockchain.last_block.index + 1
+        utxos = self.blockchain.utxos
 
-        def find_input_in_transaction_list(transactions, input_info):
-            inputs = transactions_to_inputs(transactions)
-            return any([input_equals(x, input_info) for x in inputs])
-
-        def transaction_input_found_anywhere(transaction):
-            # Check if transaction is attempting to reuse inputs (double spending)
-            is_already_spent = partial(find_input_in_transaction_list, selected)
-            if any([is_already_spent(x) for x in transaction.inputs]):
-                print("Transactions has some inputs already spent")
-                return False
-
-            # Check if transaction already mined
-            is_in_blockchain = partial(find_input_in_transaction_list, self.blockchain.confirmed_transactions)
-            if any([is_in_blockchain(x) for x in transaction.inputs]):
-                print("Transactions has some inputs already in blockchain")
+        def is_spendable(tx: Transaction) -> bool:
+            # Conflicts between unconfirmed transactions are refused by the mempool,
+            # so only the inputs already spent in the blockchain are left to check
+            if tx.type != Transaction.REGULAR or any([output.amount < 0 for output in tx.outputs]):
                 return False
+            for input_ in tx.inputs:
+                output = utxos.get(input_.tx_hash, input_.index)
+                if output is None or output.amount != input_.amount:
+                    return False
+            return True
 
-        # ==================================================
-
-        for tx in candidate_transactions:
-            all_positive_utxos = all([output.amount >= 0 for output in tx.outputs])
-            if not transaction_input_found_anywhere(tx):
-                if tx.type == Transaction.REGULAR and all_positive_utxos:
-                    selected.append(tx)
-                # if negative output found
-                elif tx.type == Transaction.REWARD:
-                    selected.append(tx)
-                elif all_positive_utxos:
-                    rejected.append(tx)
-            else:
-                rejected.append(tx)
-        print(f"Rejected: {len(rejected)} txs {[x.id for x in rejected]}")
-        transactions_to_mine = selected[:Config.TRANSACTIONS_PER_BLOCK]
+        transactions_to_mine = self.blockchain.mempool.select(Config.TRANSACTIONS_PER_BLOCK, is_spendable)
         # Add fee transaction (1 satoshi per transaction)
         if len(transactions_to_mine) > 0:
             fee_tx = Transaction.from_json({
@@ -112,7 +82,7 @@ class Miner:
             }, True)
             transactions_to_mine.append(fee_tx)
         else:
-            print("No transaction to mine")
+            log.debug("No transaction to mine")
 
         # Add reward transaction of 50 coins
         if reward_address is not None:
@@ -131,4 +101,6 @@ class Miner:
             }, True)
             transactions_to_mine.append(reward_tx)
 
-        return Block(index, transactions_to_mine, datetime.datetime.now().timestamp(), previous_hash)
+        # a clock behind the chain still gives a valid timestamp
+        timestamp = max(datetime.datetime.now().timestamp(), self.blockchain.median_time_past() + 0.001)
+        return Block(index, transactions_to_mine, timestamp, previous_hash)
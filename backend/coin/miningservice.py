@@ -0,0 +1,149 @@
+"""
+Mining in a background thread of the node, instead of inside a request.
+
+The service builds a block template from the pool and searches its proof of work. The search is cancelled
+and a new template built when:
+    1.  the last block changes (a peer's chain replaced ours, or a block was mined elsewhere);
+    2.  a transaction enters the pool while the template isn't full, or pays a higher fee per byte
+        than the cheapest transaction of the template.
+Unless Config.MINING_EMPTY_BLOCKS is set, the service waits for transactions when the pool has none.
+"""
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from coin.config import Config
+from coin.domain import Block, Transaction
+from coin.miner import Miner
+
+log = logging.getLogger(__name__)
+
+
+class MiningService:
+    def __init__(self, miner: Miner, reward_address, fee_address, on_block: Callable[[Block], None] = None):
+        self.miner = miner
+        self.blockchain = miner.blockchain
+        self.engine = miner.engine
+        self.reward_address = reward_address
+        self.fee_address = fee_address
+        self.on_block = on_block
+        self.blocks_mined = 0
+        self._thread: Optional[threading.Thread] = None
+        self._running = threading.Event()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        # the template being mined and the lowest fee per byte among its transactions
+        self._template: Optional[Block] = None
+        self._template_min_fee_rate = None
+        self._template_full = False
+        self._target = None
+        self._attempt_start = 0.0
+        self._attempt_hashes = 0
+        self._hashrate = 0.0
+        self.blockchain.block_listeners.append(self._on_new_block)
+        self.blockchain.transaction_listeners.append(self._on_new_transaction)
+
+    @property
+    def running(self) -> bool:
+        return self._running.is_set()
+
+    def start(self) -> bool:
+        with self._lock:
+            if self.running:
+                return False
+            self._running.set()
+            self._thread = threading.Thread(target=self._run, name='mining', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self) -> bool:
+        with self._lock:
+            if not self.running:
+                return False
+            self._running.clear()
+            self._wake.set()
+            self.engine.cancel()
+            thread = self._thread
+        thread.join()
+        return True
+
+    def _refresh(self):
+        # drops the current attempt, the loop starts over with a new template
+        self._wake.set()
+        self.engine.cancel()
+
+    def _on_new_block(self, block: Block):
+        template = self._template
+        if template is not None and template.previous_hash != block.hash:
+            self._refresh()
+
+    def _on_new_transaction(self, tx: Transaction):
+        if self._template is None:
+            self._wake.set()
+            return
+        entry = self.blockchain.mempool.entry(tx.hash)
+        if not self._template_full or (entry is not None and entry.fee_rate > self._template_min_fee_rate):
+            self._refresh()
+
+    def _build_template(self) -> Optional[Block]:
+        with self.blockchain.lock:
+            if len(self.blockchain.mempool) == 0 and not Config.MINING_EMPTY_BLOCKS:
+                return None
+            block = self.miner.generate_block(self.reward_address, self.fee_address)
+            self._target = self.blockchain.next_target()
+        regular = [x for x in block.transactions if x.type == Transaction.REGULAR]
+        if not regular and not Config.MINING_EMPTY_BLOCKS:
+            return None
+        entries = [self.blockchain.mempool.entry(x.hash) for x in regular]
+        rates = [x.fee_rate for x in entries if x is not None]
+        self._template_min_fee_rate = min(rates) if rates else 0
+        self._template_full = len(regular) >= Config.TRANSACTIONS_PER_BLOCK
+        return block
+
+    def _run(self):
+        while self.running:
+            # a cancel from here on stops the next search, even if it comes before the search starts
+            self.engine.reset()
+            self._wake.clear()
+            self._template = self._build_template()
+            if self._template is None:
+                self._wake.wait()
+                continue
+
+            self._attempt_start, self._attempt_hashes = time.time(), self.engine.hashes
+            result = self.engine.search(self._template.header_prefix, self._target, reset=False)
+            self._update_hashrate()
+            if result is None:
+                continue
+            block = self._template
+            block.nonce, proof = result
+            if self.blockchain.add_block(block, proof) is not None:
+                self.blocks_mined += 1
+                log.info("Mined block %d %s", block.index, block.hash,
+                         extra={'height': block.index, 'block': block.hash})
+                if self.on_block is not None:
+                    self.on_block(block)
+        self._template = None
+
+    def _update_hashrate(self):
+        elapsed = time.time() - self._attempt_start
+        if elapsed > 0:
+            self._hashrate = (self.engine.hashes - self._attempt_hashes) / elapsed
+
+    def status(self) -> dict:
+        template = self._template
+        searching = template is not None and self.running
+        if searching:
+            self._update_hashrate()
+        return {
+            'running': self.running,
+            'mining': searching,
+            'height': template.index if searching else None,
+            'transactions': len(template.transactions) if searching else 0,
+            # nonces tried on the current template
+            'nonces': self.engine.hashes - self._attempt_hashes if searching else 0,
+            'hashrate': self._hashrate,
+            'total_hashes': self.engine.hashes,
+            'blocks_mined': self.blocks_mined
+        }
@@ -1,19 +1,27 @@
+import json
+import logging
 from threading import Timer
-from typing import Set
+from typing import Set, Union, Tuple, List, Iterator
 
 import requests
 from flask import url_for
 
+from coin import codec, difficulty
 from coin.blockchain import Blockchain
 from coin.config import Config
-from coin.domain import Block
+from coin.domain import Block, BlockHeader
+from coin.peers import PeerClient
+from coin.validation import ChainValidator, InvalidChainError, check_headers
+
+log = logging.getLogger(__name__)
 
 
 class Node:
-    def __init__(self, port: str, blockchain: Blockchain, peers: Set[str] = None):
+    def __init__(self, port: str, blockchain: Blockchain, peers: Set[str] = None, client: PeerClient = None):
         self.port = port
         self.blockchain = blockchain
         self.peers = set()
+        self.client = client or PeerClient()
         self.initial_connect_to_peers(peers)
 
     def initial_connect_to_peers(self, peers):
@@ -25,10 +33,9 @@ class Node:
 
     def connect_to_peers(self, peers: Set[str]):
         me = 'http://' + Config.SERVER_HOST + ':' + self.port
-        for peer in peers:
-            if len(self.peers.intersection({peer})) == 0:
-                self.peers.add(peer)
-                self.send_to_peer(peer, me)
+        new_peers = peers - self.peers
+        self.peers.update(new_peers)
+        self.client.map(lambda peer: self.send_to_peer(peer, me), new_peers)
 
         self.consensus()
 
@@ -36,41 +43,128 @@ class Node:
         return self.connect_to_peers({peer})
 
     def send_to_peer(self, peer, peer_to_send):
-        print(peer_to_send)
-        r = requests.post(peer + '/node/peers/', data={'url': peer_to_send})
+        r = self.client.post(peer, '/node/peers/', data={'url': peer_to_send})
         if r.status_code not in [200, 201]:
-            print("Unable to connect to peer")
+            log.warning("Unable to connect to peer %s", peer)
         else:
-            print("Success!")
+            log.info("Connected to peer %s as %s", peer, peer_to_send)
 
     def consensus_requests(self):
-        for peer in self.peers:
-            requests.get(peer + url_for('consensus'))
-
-    def consensus(self):
-        neighbours = self.peers
-        new_chain = None
-        max_length = self.blockchain.length
-
-        # We're only looking for chains longer than ours
-        # Grab and verify the chains from all the nodes in our network
-        for node in neighbours:
-            response = requests.get(node + '/blockchain/blocks/')
-            if response.status_code == 200:
-                data = response.json()
-                length = data['length']
-                chain = data['chain']
-                # Check if the length is longer and the chain is valid
-                if length > max_length:
-                    if self.blockchain.valid_chain(chain):
-                        max_length = length
-                        new_chain = chain
-                    else:
-                        print(f"Bigger length found {length} but chain not valid")
-            else:
-                print(response.text, response.url)
-        # Replace our chain if longer chain is found
-        if new_chain:
-            self.blockchain.replace_chain([Block.from_json(block) for block in new_chain])
-            return True
+        path = url_for('consensus')
+        self.client.map(lambda peer: self.client.get(peer, path), self.peers)
+
+    def consensus(self) -> bool:
+        # Ask every peer for the headers after our common block at the same time,
+        # then sync with the chain with the most work, falling back on the next one if it isn't valid
+        our_work = self.blockchain.chain_work()
+        fetched = self.client.map(self.fetch_headers, self.peers)
+        candidates = sorted([(x[1], peer) for peer, x in fetched.items() if x and x[1] > our_work], reverse=True)
+        for work, peer in candidates:
+            fork_height, work, headers = fetched[peer]
+            try:
+                if self.sync_with_peer(peer, fork_height, work, headers):
+                    return True
+            except InvalidChainError as e:
+                log.warning("Chain of %s not valid: %s", peer, e, extra={'peer': peer, 'height': e.height})
+            except (requests.RequestException, ValueError) as e:
+                log.warning("Unable to sync with %s: %s", peer, e, extra={'peer': peer})
         return False
+
+    def fetch_headers(self, peer: str) -> Union[Tuple[int, int, List[BlockHeader]], None]:
+        # Headers of the peer's blocks after the last block we have in common with it,
+        # with the fork height and the work of the peer's chain. At most Config.SYNC_HEADERS_MAX_PAGES
+        # pages are read, a longer branch is synced a part at a time. A malformed answer raises ValueError.
+        since = ','.join(self.blockchain.locator())
+        headers = []
+        for _ in range(Config.SYNC_HEADERS_MAX_PAGES):
+            response = self.client.get(peer, '/blockchain/headers/',
+                                       params={'since': since, 'limit': Config.SYNC_HEADERS_LIMIT})
+            if response.status_code != 200:
+                log.warning("%s answered %d: %s", response.url, response.status_code, response.text)
+                return None
+            try:
+                data = response.json()
+                page = [BlockHeader.from_json(x) for x in data['headers']]
+                if not headers:
+                    fork_height, length = int(data['fork_height']), int(data['length'])
+                    # peers running an older version only tell their length
+                    work = int(data.get('work', length * difficulty.work(Config.INITIAL_TARGET)))
+            except (KeyError, TypeError, AttributeError) as e:
+                raise ValueError(f"Malformed headers from {peer}: {e!r}")
+
+            if not headers:
+                if not 0 <= fork_height < min(self.blockchain.length, length):
+                    raise ValueError(f"Fork height {fork_height} of {peer} is out of range")
+                if work <= self.blockchain.chain_work():
+                    return fork_height, work, []
+            elif page and page[0].previous_hash != since:
+                raise InvalidChainError(fork_height + 1 + len(headers), "header doesn't follow the previous page")
+            headers += page
+            if len(headers) > length - fork_height - 1:
+                raise ValueError(f"{peer} sent more headers than its chain has")
+            if not page or fork_height + 1 + len(headers) >= length:
+                break
+            since = headers[-1].hash
+        return fork_height, work, headers
+
+    @staticmethod
+    def stream_blocks(response: requests.Response) -> Iterator[Block]:
+        # blocks of a streamed response, each one decoded as soon as it has arrived
+        content_type = response.headers.get('Content-Type', '')
+        if content_type.startswith(codec.CONTENT_TYPE):
+            return codec.iter_decode_blocks(response.iter_content(chunk_size=64 * 1024))
+        if content_type.startswith(codec.JSON_LINES_CONTENT_TYPE):
+            return (Block.from_json(json.loads(x)) for x in response.iter_lines() if x)
+        return (Block.from_json(x) for x in response.json()['chain'])
+
+    def download_blocks(self, peer: str, start: int, headers: List[BlockHeader], staged: List[Block],
+                        validator: ChainValidator) -> bool:
+        # appends to `staged` the blocks of `headers` that follow it
+        accept = f'{codec.CONTENT_TYPE}, {codec.JSON_LINES_CONTENT_TYPE};q=0.8, application/json;q=0.5'
+        params = {'from': start + len(staged), 'limit': len(headers) - len(staged)}
+        with self.client.get(peer, '/blockchain/blocks/', params=params, headers={'Accept': accept},
+                             stream=True) as response:
+            if response.status_code != 200:
+                log.warning("%s answered %d: %s", response.url, response.status_code, response.text)
+                return False
+            for block in self.stream_blocks(response):
+                if len(staged) == len(headers) or block.hash != headers[len(staged)].hash:
+                    raise InvalidChainError(start + len(staged), "block doesn't match its header")
+                validator.add(block)
+                staged.append(block)
+        return True
+
+    def sync_with_peer(self, peer: str, fork_height: int, work: int, headers: List[BlockHeader]) -> bool:
+        # We're only looking for chains with more work than ours
+        if work <= self.blockchain.chain_work() or not headers:
+            return False
+
+        start = fork_height + 1
+        previous_hash = self.blockchain.database.get_block_hash(fork_height)
+        check_headers(previous_hash, headers, self.blockchain.target_schedule(start), start)
+
+        # Stream the blocks after the fork point and validate each one as it arrives. The first invalid
+        # block raises and closes the connection, valid ones are staged until the whole branch is there.
+        # Blocks of a side branch we already have aren't downloaded again.
+        validator = ChainValidator(previous_hash, self.blockchain.target_schedule(start), start)
+        staged = []
+        for header in headers:
+            block = self.blockchain.tree.get(header.hash)
+            if block is None:
+                break
+            validator.add(block)
+            staged.append(block)
+        if len(staged) < len(headers) and not self.download_blocks(peer, start, headers, staged, validator):
+            return False
+        validator.finish()
+        if len(staged) != len(headers):
+            log.warning("Expected %d blocks from %s, got %d", len(headers), peer, len(staged))
+            return False
+
+        # Our chain may have moved while downloading
+        if self.blockchain.length <= fork_height or self.blockchain.database.get_block_hash(fork_height) != previous_hash:
+            log.info("Chain changed during the sync with %s, dropping its blocks", peer)
+            return False
+
+        # The branch is kept even if it doesn't have more work than our chain anymore
+        return self.blockchain.replace_chain_from(start, staged)
@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, TypeVar
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from coin import metrics
+from coin.config import Config
+
+T = TypeVar('T')
+log = logging.getLogger(__name__)
+
+request_seconds = metrics.Histogram('coin_peer_request_seconds', 'Round-trip time of the requests sent to peers',
+                                    ('peer',))
+request_failures = metrics.Counter('coin_peer_request_failures_total',
+                                   'Requests to peers that failed or got a server error', ('peer',))
+
+
+class PeerHealth:
+    """
+    Moving averages of the success rate and round-trip time of the requests sent to a peer.
+    A peer failing Config.PEER_MAX_FAILURES times in a row is skipped for Config.PEER_RETRY_AFTER seconds.
+    """
+    ALPHA = 0.3
+
+    def __init__(self):
+        self.success_rate = 1.0
+        self.latency = 0.0
+        self.consecutive_failures = 0
+        self.last_failure = 0.0
+
+    @property
+    def score(self) -> float:
+        return self.success_rate / (1.0 + self.latency)
+
+    def available(self) -> bool:
+        return (self.consecutive_failures < Config.PEER_MAX_FAILURES
+                or time.time() - self.last_failure > Config.PEER_RETRY_AFTER)
+
+    def record_success(self, latency: float):
+        self.success_rate += self.ALPHA * (1.0 - self.success_rate)
+        self.latency += self.ALPHA * (latency - self.latency)
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.success_rate -= self.ALPHA * self.success_rate
+        self.consecutive_failures += 1
+        self.last_failure = time.time()
+
+    def to_json(self) -> dict:
+        return {
+            'score': self.score,
+            'success_rate': self.success_rate,
+            'latency': self.latency,
+            'consecutive_failures': self.consecutive_failures
+        }
+
+
+class PeerClient:
+    """
+    HTTP client shared by everything talking to peers: keep-alive connections from a pool,
+    a timeout on every request and a bounded number of peers contacted at the same time.
+    """
+
+    def __init__(self, max_concurrency: int = None, timeout=None):
+        self.max_concurrency = max_concurrency or Config.PEER_MAX_CONCURRENCY
+        self.timeout = timeout or (Config.PEER_CONNECT_TIMEOUT, Config.PEER_READ_TIMEOUT)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_concurrency, pool_maxsize=self.max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        self._health: Dict[str, PeerHealth] = {}
+        self._lock = threading.Lock()
+
+    def health(self, peer: str) -> PeerHealth:
+        with self._lock:
+            return self._health.setdefault(peer, PeerHealth())
+
+    def health_report(self) -> Dict[str, dict]:
+        with self._lock:
+            return {peer: x.to_json() for peer, x in self._health.items()}
+
+    def request(self, method: str, peer: str, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        health = self.health(peer)
+        start = time.time()
+        try:
+            response = self.session.request(method, peer + path, **kwargs)
+        except requests.RequestException:
+            health.record_failure()
+            request_failures.inc(peer=peer)
+            raise
+        latency = time.time() - start
+        request_seconds.observe(latency, peer=peer)
+        if response.status_code >= 500:
+            health.record_failure()
+            request_failures.inc(peer=peer)
+        else:
+            health.record_success(latency)
+        return response
+
+    def get(self, peer: str, path: str, **kwargs) -> requests.Response:
+        return self.request('GET', peer, path, **kwargs)
+
+    def post(self, peer: str, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', peer, path, **kwargs)
+
+    def ranked(self, peers: Iterable[str]) -> List[str]:
+        # available peers, healthiest first
+        return sorted([x for x in peers if self.health(x).available()], key=lambda x: -self.health(x).score)
+
+    def map(self, fn: Callable[[str], T], peers: Iterable[str]) -> Dict[str, T]:
+        """
+        Calls fn(peer) for every available peer concurrently and returns the results by peer.
+        Peers for which fn raised are left out and count as failed, whatever went wrong: a peer
+        answering nonsense must not lose the results of the others.
+        """
+        futures = {peer: self._executor.submit(fn, peer) for peer in self.ranked(peers)}
+        results = {}
+        for peer, future in futures.items():
+            try:
+                results[peer] = future.result()
+            except Exception as e:
+                # request() already counted the failures of the requests themselves
+                if not isinstance(e, requests.RequestException):
+                    self.health(peer).record_failure()
+                    request_failures.inc(peer=peer)
+                log.warning("Request to %s failed: %r", peer, e)
+        return results
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
@@ -0,0 +1,108 @@
+"""
+Proof of work search over a pool of processes.
+
+Only the packed block header is hashed (see domain.BlockHeader). Every worker hashes the part before
+the nonce a single time and then only feeds the 8 nonce bytes to a copy of that SHA256 state.
+Worker i of n tries the nonces i, i + n, i + 2n, ... and checks the shared stop event between
+batches, so everybody stops shortly after the first solution is found or the search is cancelled.
+"""
+import hashlib
+import multiprocessing
+import threading
+import time
+from typing import Optional, Tuple
+
+from coin import difficulty, metrics
+from coin.config import Config
+from coin.domain import BlockHeader
+
+_stop = None
+_hashes = None
+
+hashes_computed = metrics.Counter('coin_pow_hashes_total', 'Block header hashes computed searching proofs of work')
+search_seconds = metrics.Histogram('coin_pow_search_seconds', 'Time of proof of work searches, by result', ('result',),
+                                   buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600))
+
+
+def _init_worker(stop, hashes):
+    global _stop, _hashes
+    _stop, _hashes = stop, hashes
+
+
+def _search(prefix: bytes, target: bytes, start: int, step: int, batch: int, stop, hashes) -> Optional[Tuple[int, str]]:
+    midstate = hashlib.sha256(prefix)
+    pack_nonce = BlockHeader.NONCE.pack
+    nonce = start
+    while not stop.is_set():
+        for tried in range(batch):
+            h = midstate.copy()
+            h.update(pack_nonce(nonce))
+            if h.digest() <= target:
+                stop.set()
+                with hashes.get_lock():
+                    hashes.value += tried + 1
+                return nonce, h.hexdigest()
+            nonce += step
+        with hashes.get_lock():
+            hashes.value += batch
+    return None
+
+
+def _pool_search(args) -> Optional[Tuple[int, str]]:
+    return _search(*args, _stop, _hashes)
+
+
+class ProofOfWorkEngine:
+    def __init__(self, workers: int = None, batch: int = None):
+        self.workers = Config.MINING_WORKERS if workers is None else workers
+        self.batch = batch or Config.MINING_BATCH
+        self._stop = multiprocessing.Event()
+        self._hashes = multiprocessing.Value('Q', 0)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def hashes(self) -> int:
+        # total number of hashes computed by this engine
+        return self._hashes.value
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers, initializer=_init_worker,
+                                              initargs=(self._stop, self._hashes))
+        return self._pool
+
+    def search(self, prefix: bytes, target: int, reset=True) -> Optional[Tuple[int, str]]:
+        """
+        Returns the first (nonce, hash) found such that the hash of the header `prefix` followed by
+        the nonce is at most `target`, or None if the search was cancelled.
+        With reset=False a cancel() received since the last reset() stops the search right away.
+        """
+        target = difficulty.target_bytes(target)
+        with self._lock:
+            if reset:
+                self._stop.clear()
+            start, hashes = time.perf_counter(), self.hashes
+            if self.workers <= 1:
+                result = _search(prefix, target, 0, 1, self.batch, self._stop, self._hashes)
+            else:
+                pool = self._get_pool()
+                pending = [pool.apply_async(_pool_search, ((prefix, target, i, self.workers, self.batch),))
+                           for i in range(self.workers)]
+                found = [x for x in (result.get() for result in pending) if x is not None]
+                result = min(found) if found else None
+            hashes_computed.inc(self.hashes - hashes)
+            search_seconds.observe(time.perf_counter() - start, result='cancelled' if result is None else 'found')
+            return result
+
+    def reset(self):
+        self._stop.clear()
+
+    def cancel(self):
+        self._stop.set()
+
+    def close(self):
+        self.cancel()
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
@@ -0,0 +1,78 @@
+"""
+Sampling profiler that can be turned on and off in a running node.
+
+While running, a thread takes the stack of every other thread of the process every Config.PROFILER_INTERVAL
+seconds and counts how often each stack was seen. The report is in the collapsed format of flame graph
+tools: one line per stack, its frames from the outermost separated by ';', then the number of samples.
+Only the threads of the node's own process are seen, not the mining or signature verification processes.
+"""
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+from coin.config import Config
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = None):
+        self.interval = interval or Config.PROFILER_INTERVAL
+        self.samples = 0
+        self._stacks = Counter()
+        self._thread: Optional[threading.Thread] = None
+        self._running = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._running.is_set()
+
+    def start(self) -> bool:
+        with self._lock:
+            if self.running:
+                return False
+            self._running.set()
+            self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self) -> bool:
+        with self._lock:
+            if not self.running:
+                return False
+            self._running.clear()
+            thread = self._thread
+        thread.join()
+        return True
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+    def _run(self):
+        me = threading.get_ident()
+        while self.running:
+            frames = sys._current_frames()
+            stacks = []
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < Config.PROFILER_MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                    frame = frame.f_back
+                stacks.append(';'.join(reversed(stack)))
+            del frames
+            with self._lock:
+                self._stacks.update(stacks)
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def report(self, limit: int = None) -> str:
+        # the `limit` most sampled stacks, most sampled first
+        with self._lock:
+            stacks = self._stacks.most_common(limit)
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
@@ -0,0 +1,143 @@
+"""
+Verification of input signatures.
+
+A job is (address, signed message, signature). Every pair that verified successfully is remembered
+in a bounded LRU keyed by (message hash, signature), so an input checked when it entered the pool
+isn't verified again when its block is checked or when a peer's chain containing it is validated.
+Batches of jobs that are not in the cache are split in chunks and verified by a process pool.
+Batches of messages to sign with a wallet key are split the same way over the same pool.
+"""
+import binascii
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import List, Tuple, Optional
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+
+from coin import util, metrics
+from coin.config import Config
+
+Job = Tuple[str, bytes, Optional[str]]
+
+
+class SignatureCache:
+    def __init__(self, size: int):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return True
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._entries[key] = True
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+cache = SignatureCache(Config.SIGNATURE_CACHE_SIZE)
+verifications = metrics.Counter('coin_signature_verifications_total',
+                                'Input signatures checked, by result (cached: verified before)', ('result',))
+verification_seconds = metrics.Histogram('coin_signature_batch_seconds', 'Time to verify a batch of input signatures')
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _cache_key(job: Job):
+    return hashlib.sha256(job[1]).digest(), job[2]
+
+
+def _verify(job: Job) -> bool:
+    address, message, signature = job
+    try:
+        return util.verify_hash(address, SHA256.new(message), signature)
+    except (TypeError, ValueError, binascii.Error):
+        # missing or malformed signature or key
+        return False
+
+
+def _verify_chunk(jobs: List[Job]) -> List[bool]:
+    return [_verify(x) for x in jobs]
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=Config.VERIFY_WORKERS)
+        return _pool
+
+
+def verify_signature(address: str, message: bytes, signature: str) -> bool:
+    job = (address, message, signature)
+    key = _cache_key(job)
+    if key in cache:
+        verifications.inc(result='cached')
+        return True
+    valid = _verify(job)
+    verifications.inc(result='valid' if valid else 'invalid')
+    if valid:
+        cache.add(key)
+    return valid
+
+
+def verify_signatures(jobs: List[Job]) -> List[bool]:
+    """
+    Verifies a batch of jobs and returns one result per job, in order.
+    """
+    results = [True] * len(jobs)
+    keys = [_cache_key(x) for x in jobs]
+    missing = [i for i, key in enumerate(keys) if key not in cache]
+
+    chunk = Config.VERIFY_CHUNK
+    with verification_seconds.time():
+        if Config.VERIFY_WORKERS <= 1 or len(missing) <= chunk:
+            verified = _verify_chunk([jobs[i] for i in missing])
+        else:
+            chunks = [[jobs[i] for i in missing[start:start + chunk]] for start in range(0, len(missing), chunk)]
+            verified = [x for part in _get_pool().map(_verify_chunk, chunks) for x in part]
+    valid_count = sum(verified)
+    verifications.inc(len(jobs) - len(missing), result='cached')
+    verifications.inc(valid_count, result='valid')
+    verifications.inc(len(verified) - valid_count, result='invalid')
+
+    for i, valid in zip(missing, verified):
+        results[i] = valid
+        if valid:
+            cache.add(keys[i])
+    return results
+
+
+@lru_cache(maxsize=16)
+def _private_key(private_key: str) -> RSA.RsaKey:
+    # parsed once per process, a batch is always signed with the same few wallet keys
+    return util.import_rsa_key(private_key)
+
+
+def _sign_chunk(private_key: str, messages: List[bytes]) -> List[str]:
+    key = _private_key(private_key)
+    return [util.sign_hash(key, SHA256.new(x)) for x in messages]
+
+
+def sign_messages(private_key: str, messages: List[bytes]) -> List[str]:
+    """
+    Signs every message with the hex encoded `private_key` and returns the signatures, in order.
+    """
+    chunk = Config.VERIFY_CHUNK
+    if Config.VERIFY_WORKERS <= 1 or len(messages) <= chunk:
+        return _sign_chunk(private_key, messages)
+    chunks = [messages[start:start + chunk] for start in range(0, len(messages), chunk)]
+    return [x for part in _get_pool().map(_sign_chunk, [private_key] * len(chunks), chunks) for x in part]
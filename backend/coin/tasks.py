@@ -1,22 +1,30 @@
-import requests
+import atexit
+import logging
+
 from redis import Redis
 
 from coin.app import app
+from coin.peers import PeerClient
+
+log = logging.getLogger(__name__)
+# one client per worker process, so its connections and the health of the peers outlive a job
+client = PeerClient()
+atexit.register(client.close)
 
 
 def launch_task(func, description, *args, **kwargs):
     rq_job = app.task_queue.enqueue_call(func=func, result_ttl=5000, args=args, kwargs=kwargs)
-    print(rq_job)
+    log.info("Enqueued %s: %s", description, rq_job)
+    return rq_job
 
 
 def consensus_requests(*args, **kwargs):
-    for peer in kwargs['peers']:
-        requests.get(peer + '/node/consensus/')
+    client.map(lambda peer: client.get(peer, '/node/consensus/'), kwargs['peers'])
 
 
 def mine_and_consensus(peer: str):
-    r = requests.get(peer + '/miner/mine/')
-    print(r.status_code)
+    r = client.get(peer, '/miner/mine/')
+    log.info("Mining request answered %d", r.status_code)
 
 
 def mine():
@@ -27,9 +35,9 @@ def mine():
 
 
 def example(seconds):
-    print('Starting task')
+    log.info('Starting task')
     import time
     for i in range(seconds):
-        print(i)
+        log.info('%d', i)
         time.sleep(1)
-    print('Task completed')
+    log.info('Task completed')
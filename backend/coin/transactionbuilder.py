@@ -1,8 +1,9 @@
-from typing import Type, TypeVar, List
+from typing import Type, TypeVar, List, Tuple
 
-from coin import util
+from coin import util, codec, coinselection
+from coin.coinselection import FeeModel, SortedUtxos
 from coin.config import Config
-from coin.domain import Transaction, InputInfo, OutputInfo
+from coin.domain import Transaction, InputInfo, OutputInfo, Wallet
 
 T = TypeVar('T')
 
@@ -52,12 +53,7 @@ class TransactionBuilder:
         self.type = Transaction.REGULAR
 
     def process_utxo(self, utxo: InputInfo) -> InputInfo:
-        utxo_hash = util.crypto_hash({
-            'transaction': utxo.tx_hash,
-            'index': utxo.index,
-            'address': utxo.address
-        })
-        utxo.signature = util.sign_hash(self.secret_key, utxo_hash)
+        utxo.signature = util.sign_hash(self.secret_key, utxo.compute_hash())
         return utxo
 
     def build(self):
@@ -87,3 +83,46 @@ class TransactionBuilder:
             'type': self.type,
             'hash': None
         }
+
+
+class BatchTransactionBuilder:
+    """
+    Builds many payments from the unspent outputs of one wallet and signs them together.
+    The outputs are sorted once and every selection (see coinselection.select) is removed from them,
+    so an output is spent by one transaction at most. Payments the remaining outputs can't cover
+    are left in `unpaid`. The inputs of all the transactions are signed in one batch over the
+    signatures process pool, with the key parsed once per process.
+    """
+
+    def __init__(self, wallet: Wallet, list_of_utxo: List[InputInfo], change_address=None,
+                 fee_model: FeeModel = None):
+        self.wallet = wallet
+        self.change_address = change_address or wallet.identity
+        self.fee_model = fee_model or FeeModel()
+        self.utxos = SortedUtxos(list_of_utxo)
+        self.unpaid: List[Tuple[str, int]] = []
+
+    def build(self, payments: List[Tuple[str, int]]) -> List[Transaction]:
+        """
+        A signed transaction for every (address, amount) of `payments` that could be paid, in order.
+        """
+        transactions = []
+        for address, amount in payments:
+            selection = coinselection.select(self.utxos, amount, self.fee_model)
+            if selection is None:
+                self.unpaid.append((address, amount))
+                continue
+            self.utxos.remove(selection.inputs)
+            outputs = [OutputInfo(amount, address)]
+            if selection.change > 0:
+                outputs.append(OutputInfo(selection.change, self.change_address))
+            transactions.append(Transaction(util.random_id(), Transaction.REGULAR, hash_=None,
+                                            inputs=selection.inputs, outputs=outputs))
+        return self.wallet.sign_transactions(transactions)
+
+    @staticmethod
+    def bulk_requests(transactions: List[Transaction]) -> List[bytes]:
+        # bodies to POST to /blockchain/transactions/bulk/ with the codec.CONTENT_TYPE content type
+        limit = Config.INGEST_BULK_LIMIT
+        return [codec.encode_transactions(transactions[start:start + limit])
+                for start in range(0, len(transactions), limit)]
@@ -1,14 +1,18 @@
 import binascii
+import hashlib
 import json
 import re
 import uuid
-from typing import Tuple
+from functools import lru_cache
+from typing import Tuple, List
 
 import Crypto
 from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 
+from coin.config import Config
+
 VALID_URL_RE = re.compile(
     r'^(?:http|ftp)s?://'  # http:// or https://
     r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
@@ -39,14 +43,42 @@ def hash_str(string: str) -> SHA256.SHA256Hash:
     return h
 
 
+def merkle_tree(hashes: List[str]) -> Tuple[bytes, bool]:
+    """
+    Merkle root of sha256 hashes, paired level by level, the last one paired with itself on odd levels.
+    Also tells whether two different nodes of a level are equal: such a list has the same root as a
+    list repeating some of its hashes (CVE-2012-2459), so a block with that tree is not valid.
+    """
+    level = [bytes.fromhex(x) for x in hashes]
+    if not level:
+        return bytes(32), False
+    mutated = False
+    while len(level) > 1:
+        mutated = mutated or any(level[i] == level[i + 1] for i in range(0, len(level) - 1, 2))
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)]
+    return level[0], mutated
+
+
+def merkle_root(hashes: List[str]) -> bytes:
+    return merkle_tree(hashes)[0]
+
+
+@lru_cache(maxsize=Config.PUBLIC_KEY_CACHE_SIZE)
+def import_public_key(public_key: str) -> RSA.RsaKey:
+    # addresses are hex encoded public keys and the same few keep coming back
+    return RSA.import_key(binascii.unhexlify(public_key))
+
+
 def verify_hash(public_key: str, h: SHA256.SHA256Hash, calculated_signature: bytes):
-    public_key = RSA.import_key(binascii.unhexlify(public_key))
+    public_key = import_public_key(public_key)
     verifier = PKCS1_v1_5.new(public_key)
     return verifier.verify(h, binascii.unhexlify(calculated_signature))
 
 
 def verify(public_key: str, dict_object: dict, calculated_signature: bytes):
-    public_key = RSA.import_key(binascii.unhexlify(public_key))
+    public_key = import_public_key(public_key)
     verifier = PKCS1_v1_5.new(public_key)
     h = crypto_hash(dict_object)
     return verifier.verify(h, binascii.unhexlify(calculated_signature))
@@ -0,0 +1,173 @@
+from typing import Dict, Tuple, Optional, Iterable, List
+
+from coin.domain import Transaction, Block, OutputInfo, InputInfo
+
+Outpoint = Tuple[str, int]
+# outputs spent by a block, in the order it spent them, to put them back if the block is disconnected
+BlockUndo = List[Tuple[Outpoint, OutputInfo]]
+
+
+class UtxoSet:
+    """
+    Index of the unspent transaction outputs of the confirmed chain, keyed by (tx_hash, index).
+    It is updated block by block, so existence, amount and double spend checks are O(1) per input.
+    Outputs are also indexed by address together with a running balance per address.
+    """
+
+    def __init__(self):
+        self._outputs: Dict[Outpoint, OutputInfo] = {}
+        self._by_address: Dict[str, Dict[Outpoint, int]] = {}
+        self._balances: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._outputs)
+
+    def __contains__(self, outpoint: Outpoint) -> bool:
+        return outpoint in self._outputs
+
+    def get(self, tx_hash: str, index: int) -> Optional[OutputInfo]:
+        return self._outputs.get((tx_hash, index))
+
+    def outputs_for_address(self, address: str) -> Dict[Outpoint, int]:
+        return self._by_address.get(address, {})
+
+    def balance(self, address: str) -> int:
+        return self._balances.get(address, 0)
+
+    def _add(self, outpoint: Outpoint, output: OutputInfo):
+        self._outputs[outpoint] = output
+        self._by_address.setdefault(output.address, {})[outpoint] = output.amount
+        self._balances[output.address] = self._balances.get(output.address, 0) + output.amount
+
+    def _remove(self, outpoint: Outpoint) -> Optional[OutputInfo]:
+        output = self._outputs.pop(outpoint, None)
+        if output is None:
+            return None
+        outputs = self._by_address[output.address]
+        del outputs[outpoint]
+        if outputs:
+            self._balances[output.address] -= output.amount
+        else:
+            del self._by_address[output.address]
+            del self._balances[output.address]
+        return output
+
+    def apply_transaction(self, tx: Transaction, spent: BlockUndo = None):
+        for input_ in tx.inputs:
+            outpoint = (input_.tx_hash, input_.index)
+            output = self._remove(outpoint)
+            if output is not None and spent is not None:
+                spent.append((outpoint, output))
+        for idx, output in enumerate(tx.outputs):
+            self._add((tx.hash, idx), output)
+
+    def apply_block(self, block: Block) -> BlockUndo:
+        spent = []
+        for tx in block.transactions:
+            self.apply_transaction(tx, spent)
+        return spent
+
+    def undo_block(self, block: Block, undo: BlockUndo):
+        # back to the state before `block`: its outputs go away and the outputs it spent come back,
+        # except the ones created by the block itself
+        created = set()
+        for tx in block.transactions:
+            for idx in range(len(tx.outputs)):
+                created.add((tx.hash, idx))
+                self._remove((tx.hash, idx))
+        for outpoint, output in undo:
+            if outpoint not in created:
+                self._add(outpoint, output)
+
+    def clear(self):
+        self._outputs.clear()
+        self._by_address.clear()
+        self._balances.clear()
+
+    @classmethod
+    def from_blocks(cls, blocks: Iterable[Block]) -> 'UtxoSet':
+        utxos = cls()
+        for block in blocks:
+            utxos.apply_block(block)
+        return utxos
+
+
+class PendingUtxos:
+    """
+    Overlay of the unconfirmed transactions on top of a UtxoSet: the outputs they create
+    and the outputs they spend, with a balance delta per address.
+    """
+
+    def __init__(self):
+        self._created: Dict[str, Dict[Outpoint, int]] = {}
+        # outpoint -> (spending tx hash, owner address, amount)
+        self._spent: Dict[Outpoint, Tuple[str, str, int]] = {}
+        self._deltas: Dict[str, int] = {}
+
+    def _shift(self, address: str, amount: int):
+        delta = self._deltas.get(address, 0) + amount
+        if delta:
+            self._deltas[address] = delta
+        else:
+            self._deltas.pop(address, None)
+
+    def _resolve(self, utxos: UtxoSet, input_: InputInfo) -> Optional[Tuple[str, int]]:
+        output = utxos.get(input_.tx_hash, input_.index)
+        if output is not None:
+            return output.address, output.amount
+        amount = self._created.get(input_.address, {}).get((input_.tx_hash, input_.index))
+        if amount is not None:
+            return input_.address, amount
+        return None
+
+    def add(self, tx: Transaction, utxos: UtxoSet):
+        for idx, output in enumerate(tx.outputs):
+            self._created.setdefault(output.address, {})[(tx.hash, idx)] = output.amount
+            self._shift(output.address, output.amount)
+        for input_ in tx.inputs:
+            outpoint = (input_.tx_hash, input_.index)
+            if outpoint in self._spent:
+                continue
+            owner = self._resolve(utxos, input_)
+            if owner is not None:
+                self._spent[outpoint] = (tx.hash, owner[0], owner[1])
+                self._shift(owner[0], -owner[1])
+
+    def remove(self, tx: Transaction):
+        for input_ in tx.inputs:
+            outpoint = (input_.tx_hash, input_.index)
+            spent = self._spent.get(outpoint)
+            if spent is not None and spent[0] == tx.hash:
+                del self._spent[outpoint]
+                self._shift(spent[1], spent[2])
+        for idx, output in enumerate(tx.outputs):
+            created = self._created.get(output.address)
+            if created is not None and created.pop((tx.hash, idx), None) is not None:
+                if not created:
+                    del self._created[output.address]
+                self._shift(output.address, -output.amount)
+
+    def is_spent(self, outpoint: Outpoint) -> bool:
+        return outpoint in self._spent
+
+    def outputs_for_address(self, address: str) -> Dict[Outpoint, int]:
+        return self._created.get(address, {})
+
+    def balance_delta(self, address: str) -> int:
+        return self._deltas.get(address, 0)
+
+    @classmethod
+    def from_transactions(cls, transactions: Iterable[Transaction], utxos: UtxoSet) -> 'PendingUtxos':
+        pending = cls()
+        for tx in transactions:
+            pending.add(tx, utxos)
+        return pending
+
+
+def unspent_for_address(address: str, utxos: UtxoSet, pending: PendingUtxos) -> List[InputInfo]:
+    unspent = []
+    for outputs in (utxos.outputs_for_address(address), pending.outputs_for_address(address)):
+        for outpoint, amount in outputs.items():
+            if not pending.is_spent(outpoint):
+                unspent.append(InputInfo(outpoint[0], outpoint[1], amount, address, None))
+    return unspent
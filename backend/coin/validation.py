@@ -0,0 +1,144 @@
+"""
+Validation of a sequence of blocks received from a peer, in two stages:
+
+    1.  As each block is added, the cheap checks run right away on the calling thread: block hash,
+        link to the previous block, proof of work against the target of its height (see difficulty)
+        and the transactions of the block (see transactions_error).
+    2.  The signatures of the inputs are queued and verified by the signatures process pool
+        once enough of them are pending, and for the remaining ones when finish() is called.
+
+The first failure stops the validation with an InvalidChainError telling which block failed and why.
+"""
+from typing import List, Tuple, Optional
+
+from coin import signatures, metrics
+from coin.config import Config
+from coin.difficulty import TargetSchedule, meets_target
+from coin.domain import Block, Transaction, BlockHeader
+
+# blocks checked before joining our chain (source 'local') and blocks of a peer's chain (source 'peer')
+block_validation_seconds = metrics.Histogram('coin_block_validation_seconds', 'Time to check a block, by source',
+                                             ('source',))
+blocks_checked = metrics.Counter('coin_blocks_checked_total', 'Blocks checked, by source and result',
+                                 ('source', 'result'))
+
+
+class InvalidChainError(Exception):
+    def __init__(self, height: int, reason: str):
+        super().__init__(f"Block {height}: {reason}")
+        self.height = height
+        self.reason = reason
+
+
+def transactions_error(block: Block) -> Optional[str]:
+    """
+    What is wrong with the transactions of `block` on their own, or None. Signatures and the outputs
+    they spend are checked elsewhere. Every transaction must match its hash, the regular ones must pay
+    at least the fee, and besides them a block holds exactly one reward transaction paying
+    Config.MINING_REWARD and at most one fee transaction taking at most what the regular ones pay.
+    """
+    paid = 0
+    for tx in block.transactions:
+        if tx.type not in (Transaction.REGULAR, Transaction.REWARD, Transaction.FEE):
+            return f"transaction '{tx.hash}' has an unknown type"
+        if not tx.check_structure():
+            return f"transaction '{tx.hash}' is not valid"
+        if tx.type == Transaction.REGULAR:
+            paid += sum([x.amount for x in tx.inputs]) - sum([x.amount for x in tx.outputs])
+        elif tx.inputs or any([x.amount < 0 for x in tx.outputs]):
+            return f"{tx.type} transaction '{tx.hash}' is not valid"
+
+    rewards = [x for x in block.transactions if x.type == Transaction.REWARD]
+    fees = [x for x in block.transactions if x.type == Transaction.FEE]
+    if len(rewards) != 1:
+        return f"expected 1 reward transaction, got {len(rewards)}"
+    if sum([x.amount for x in rewards[0].outputs]) != Config.MINING_REWARD:
+        return "reward transaction doesn't pay the mining reward"
+    if len(fees) > 1:
+        return f"expected at most 1 fee transaction, got {len(fees)}"
+    if fees and sum([x.amount for x in fees[0].outputs]) > paid:
+        return "fee transaction takes more than the transactions pay"
+    return None
+
+
+def _hash_of(block, height: int) -> str:
+    # hash of a block or header, whose fields may not even have the right types
+    try:
+        return block.compute_hash()
+    except ValueError as e:
+        raise InvalidChainError(height, f"malformed block: {e}")
+
+
+def check_headers(previous_hash: str, headers: List[BlockHeader], targets: TargetSchedule, height: int = 1):
+    # only hashes, links and proofs of work: lets a node refuse a branch before downloading its blocks
+    for header in headers:
+        error = targets.timestamp_error(header.timestamp)
+        if error is not None:
+            raise InvalidChainError(height, error)
+        target = targets.add(header.timestamp)
+        if _hash_of(header, height) != header.hash:
+            raise InvalidChainError(height, "header hash doesn't match the header content")
+        if header.previous_hash != previous_hash:
+            raise InvalidChainError(height, "previous hash doesn't match the previous header")
+        if not meets_target(header.hash, target):
+            raise InvalidChainError(height, "proof of work is not valid")
+        previous_hash = header.hash
+        height += 1
+
+
+class ChainValidator:
+    def __init__(self, previous_hash: str, targets: TargetSchedule, height: int = 1):
+        self.previous_hash = previous_hash
+        # targets of the chain below `height`, extended with each block added
+        self.targets = targets
+        # height of the next block to be added
+        self.height = height
+        self.window = Config.VERIFY_CHUNK * max(Config.VERIFY_WORKERS, 1) * 4
+        self._jobs: List[signatures.Job] = []
+        self._owners: List[Tuple[int, str]] = []
+
+    def add(self, block: Block):
+        with block_validation_seconds.time(source='peer'):
+            try:
+                self._add(block)
+            except InvalidChainError:
+                blocks_checked.inc(source='peer', result='invalid')
+                raise
+        blocks_checked.inc(source='peer', result='valid')
+
+    def _add(self, block: Block):
+        height = self.height
+        if _hash_of(block, height) != block.hash:
+            raise InvalidChainError(height, "hash doesn't match the block content")
+        if block.merkle_mutated:
+            raise InvalidChainError(height, "merkle tree repeats transactions")
+        if block.previous_hash != self.previous_hash:
+            raise InvalidChainError(height, "previous hash doesn't match the previous block")
+        error = self.targets.timestamp_error(block.timestamp)
+        if error is not None:
+            raise InvalidChainError(height, error)
+        if not meets_target(block.hash, self.targets.add(block.timestamp)):
+            raise InvalidChainError(height, "proof of work is not valid")
+
+        error = transactions_error(block)
+        if error is not None:
+            raise InvalidChainError(height, error)
+        for tx in block.transactions:
+            for input_ in tx.inputs:
+                self._jobs.append(input_.signature_job())
+                self._owners.append((height, tx.hash))
+
+        self.previous_hash = block.hash
+        self.height += 1
+        if len(self._jobs) >= self.window:
+            self._verify_signatures()
+
+    def _verify_signatures(self):
+        jobs, owners = self._jobs, self._owners
+        self._jobs, self._owners = [], []
+        for valid, (height, tx_hash) in zip(signatures.verify_signatures(jobs), owners):
+            if not valid:
+                raise InvalidChainError(height, f"transaction '{tx_hash}' has an invalid signature")
+
+    def finish(self):
+        self._verify_signatures()
@@ -0,0 +1,64 @@
+import copy
+
+from coin import util
+from coin.blockchain import Blockchain
+from coin.config import Config
+from coin.domain import Block, BlockHeader
+from coin.miner import Miner
+
+WALLET = Config.TEST_WALLET_1['public_key']
+
+
+def mined(blocks: int) -> Blockchain:
+    blockchain = Blockchain()
+    miner = Miner(blockchain)
+    for _ in range(blocks):
+        miner.mine(WALLET, WALLET)
+    return blockchain
+
+
+def test_genesis_hash():
+    genesis = Block.from_json(Config.GENESIS_BLOCK)
+    assert genesis.compute_hash() == Config.GENESIS_BLOCK['hash']
+    assert Blockchain().genesis.hash == Config.GENESIS_BLOCK['hash']
+
+
+def test_header_hash_matches_block_hash():
+    for block in mined(2).chain:
+        assert block.header.compute_hash() == block.hash
+        assert BlockHeader.from_json(block.header.to_json()).compute_hash() == block.hash
+
+
+def test_hash_covers_transaction_content():
+    block = mined(1).last_block
+    data = block.to_json()
+    # the transaction hashes are left alone, the leaves come from the content
+    data['transactions'][0]['outputs'][0]['amount'] += 1
+    assert Block.from_json(data).compute_hash() != block.hash
+
+
+def test_header_fields_reset_the_cached_prefix():
+    block = copy.deepcopy(mined(1).last_block)
+    block.timestamp += 1
+    assert block.compute_hash() != block.hash
+
+
+def test_merkle_tree_mutation():
+    hashes = [util.crypto_hash(x).hexdigest() for x in range(3)]
+    root, mutated = util.merkle_tree(hashes)
+    assert not mutated
+    # the last hash repeated gives the same root
+    assert util.merkle_tree(hashes + hashes[-1:]) == (root, True)
+    assert util.merkle_tree([]) == (bytes(32), False)
+    assert util.merkle_tree(hashes[:1]) == (bytes.fromhex(hashes[0]), False)
+
+
+def test_mutated_block_is_rejected():
+    blockchain = mined(2)
+    transactions = [tx for x in blockchain.chain for tx in x.transactions][:3]
+    block = Block(3, transactions, 0.0, blockchain.last_block.hash)
+    # same root and hash with the last transaction repeated
+    mutated = Block(3, transactions + transactions[-1:], 0.0, blockchain.last_block.hash)
+    assert not block.merkle_mutated and mutated.merkle_mutated
+    assert mutated.compute_hash() == block.compute_hash()
+    assert not blockchain.is_valid_proof(mutated, mutated.compute_hash())
@@ -0,0 +1,149 @@
+import hashlib
+import os
+
+import pytest
+
+from coin.blockchain import Blockchain
+from coin.blockstore import BlockLog, StoredBlocks, RECORD_HEADER, INDEX_ENTRY
+from coin.config import Config
+from coin.database import FileDatabase
+from coin.miner import Miner
+from coin.utxo import UtxoSet
+
+WALLET = Config.TEST_WALLET_1['public_key']
+
+
+def hash_of(payload: bytes) -> str:
+    return hashlib.sha256(payload).hexdigest()
+
+
+def open_log(directory) -> BlockLog:
+    return BlockLog(str(directory), hash_of=hash_of, fsync_batch=1)
+
+
+def filled_log(directory, count: int) -> BlockLog:
+    block_log = open_log(directory)
+    for payload in payloads(count):
+        block_log.append(payload, hash_of(payload))
+    return block_log
+
+
+def payloads(count: int):
+    return [b'block %d ' % x * (x + 1) for x in range(count)]
+
+
+def contents(block_log: BlockLog):
+    return [(block_log.read(x), block_log.block_hash(x)) for x in range(len(block_log))]
+
+
+def test_append_and_reopen(tmp_path):
+    block_log = filled_log(tmp_path, 5)
+    expected = [(x, hash_of(x)) for x in payloads(5)]
+    assert contents(block_log) == expected
+    block_log.close()
+    assert contents(open_log(tmp_path)) == expected
+
+
+def test_torn_record_is_cut_off(tmp_path):
+    filled_log(tmp_path, 3).close()
+    size = os.path.getsize(tmp_path / 'blocks.log')
+    with open(tmp_path / 'blocks.log', 'ab') as f:
+        f.write(RECORD_HEADER.pack(100, 0) + b'partial')
+    block_log = open_log(tmp_path)
+    assert len(block_log) == 3 and os.path.getsize(tmp_path / 'blocks.log') == size
+    # appending after the recovery gives a readable record
+    block_log.append(b'next', hash_of(b'next'))
+    block_log.close()
+    assert contents(open_log(tmp_path))[-1] == (b'next', hash_of(b'next'))
+
+
+def test_damaged_record_drops_its_index_entry(tmp_path):
+    filled_log(tmp_path, 3).close()
+    with open(tmp_path / 'blocks.log', 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'\xff')
+    assert contents(open_log(tmp_path)) == [(x, hash_of(x)) for x in payloads(2)]
+
+
+def test_records_missing_from_the_index_are_indexed(tmp_path):
+    filled_log(tmp_path, 4).close()
+    # the index entries of the last two records and half of another never made it to disk
+    with open(tmp_path / 'blocks.idx', 'r+b') as f:
+        f.truncate(2 * INDEX_ENTRY.size + 5)
+    assert contents(open_log(tmp_path)) == [(x, hash_of(x)) for x in payloads(4)]
+
+
+def test_truncate_and_cached_blocks(tmp_path):
+    block_log = filled_log(tmp_path, 4)
+    blocks = StoredBlocks(block_log, bytes, cache_size=2)
+    assert blocks[-1] == payloads(4)[-1] and blocks[1:3] == payloads(4)[1:3]
+    block_log.truncate(2)
+    block_log.append(b'other', hash_of(b'other'))
+    # the position is reused by another block, the cache is keyed by hash
+    assert len(blocks) == 3 and blocks[2] == b'other'
+    with pytest.raises(IndexError):
+        blocks[3]
+    block_log.close()
+    assert contents(open_log(tmp_path)) == [(x, hash_of(x)) for x in payloads(2) + [b'other']]
+
+
+def state(database: FileDatabase):
+    blocks = list(database.get_blocks())
+    outpoints = [(tx.hash, i) for x in blocks for tx in x.transactions for i in range(len(tx.outputs))]
+    expected = UtxoSet.from_blocks(blocks)
+    for outpoint in outpoints:
+        output, stored = expected.get(*outpoint), database.utxos.get(*outpoint)
+        if output is None:
+            assert stored is None
+        else:
+            assert (stored.amount, stored.address) == (output.amount, output.address)
+    assert database.utxos.balance(WALLET) == expected.balance(WALLET)
+    return [x.hash for x in blocks], database.utxos.balance(WALLET)
+
+
+def mine_on_disk(directory, blocks: int) -> Blockchain:
+    blockchain = Blockchain(FileDatabase(str(directory)))
+    for _ in range(blocks):
+        Miner(blockchain).mine(WALLET, WALLET)
+    return blockchain
+
+
+@pytest.mark.parametrize('commit_blocks', [1, 2, 1000])
+def test_file_database_reopens(tmp_path, monkeypatch, commit_blocks):
+    # with 1000 nothing is committed before close, with 2 the blocks after the last commit are replayed
+    monkeypatch.setattr(Config, 'STATE_COMMIT_BLOCKS', commit_blocks)
+    database = mine_on_disk(tmp_path, 3).database
+    expected = state(database)
+    database.log.flush(force=True)
+    database.undo_log.flush(force=True)
+    database.state.close()
+
+    reopened = FileDatabase(str(tmp_path))
+    assert state(reopened) == expected
+    reopened.close()
+
+
+def test_state_ahead_of_the_block_log_is_rebuilt(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(Config, 'STATE_COMMIT_BLOCKS', 1)
+    mine_on_disk(tmp_path, 3).database.close()
+    block_log = BlockLog(str(tmp_path), hash_of=hash_of)
+    block_log.truncate(2)
+    block_log.close()
+
+    reopened = FileDatabase(str(tmp_path))
+    assert "rebuilding" in caplog.text
+    hashes, _ = state(reopened)
+    assert len(hashes) == 2
+    reopened.close()
+
+
+def test_truncate_blocks_undoes_the_utxo_set(tmp_path):
+    database = mine_on_disk(tmp_path, 3).database
+    hashes, balance = state(database)
+    removed = database.truncate_blocks(2)
+    assert [x.hash for x in removed] == hashes[2:]
+    assert state(database) == (hashes[:2], balance - 2 * Config.MINING_REWARD)
+    database.close()
+    reopened = FileDatabase(str(tmp_path))
+    assert state(reopened)[0] == hashes[:2] and len(reopened.undo_log) == 2
+    reopened.close()
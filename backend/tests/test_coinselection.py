@@ -0,0 +1,114 @@
+import itertools
+import random
+import time
+
+from coin import coinselection
+from coin.coinselection import FeeModel, SortedUtxos
+from coin.domain import InputInfo
+
+
+def utxos(amounts):
+    return [InputInfo('%064x' % i, 0, amount, 'address') for i, amount in enumerate(amounts)]
+
+
+def check_selection(selection, amount, fee_model):
+    assert selection.total == amount + selection.fee + selection.change
+    assert selection.fee >= fee_model.fee(len(selection.inputs), 2 if selection.change else 1)
+    assert len(set(map(id, selection.inputs))) == len(selection.inputs)
+
+
+def test_many_small_outputs():
+    # the largest candidates of knapsack don't pay the amount, only greedy walking all the outputs does
+    sorted_utxos = SortedUtxos(utxos([10] * 100_000))
+    fee_model = FeeModel()
+    start = time.perf_counter()
+    selection = coinselection.select(sorted_utxos, 50_000, fee_model, budget=0.005)
+    elapsed = time.perf_counter() - start
+    assert selection is not None and selection.strategy == 'greedy'
+    check_selection(selection, 50_000, fee_model)
+    assert len(selection.inputs) == 5001
+    # loose bound, timings vary a lot between machines
+    assert elapsed < 0.05
+
+
+def test_many_small_outputs_respects_budget():
+    sorted_utxos = SortedUtxos(utxos([10] * 100_000))
+    for amount in (500, 5_000, 50_000):
+        start = time.perf_counter()
+        assert coinselection.select(sorted_utxos, amount, budget=0.002) is not None
+        assert time.perf_counter() - start < 0.02
+
+
+def test_not_enough():
+    sorted_utxos = SortedUtxos(utxos([10] * 1000))
+    assert coinselection.select(sorted_utxos, 10_000) is None
+    assert coinselection.select_greedy(sorted_utxos, 10_000) is None
+    assert coinselection.select_knapsack(sorted_utxos, 10_000) is None
+
+
+def test_exact_match_before_single_output():
+    sorted_utxos = SortedUtxos(utxos([5, 10, 3, 40]))
+    selection = coinselection.select(sorted_utxos, 12, FeeModel(1, 0))
+    assert sorted([x.amount for x in selection.inputs]) == [3, 10] and selection.change == 0
+    selection = coinselection.select(sorted_utxos, 20, FeeModel(1, 0))
+    assert [x.amount for x in selection.inputs] == [40] and selection.change == 19
+
+
+def test_greedy_takes_fewest_largest_outputs():
+    rng = random.Random(1)
+    for _ in range(300):
+        amounts = [rng.randint(1, 60) for _ in range(rng.randint(1, 200))]
+        fee_model = FeeModel(base=rng.randint(0, 3), per_input=rng.randint(0, 2), per_output=rng.randint(0, 2))
+        amount = rng.randint(1, 3000)
+        selection = coinselection.select_greedy(SortedUtxos(utxos(amounts)), amount, fee_model)
+
+        useful = sorted([x for x in amounts if x > fee_model.per_input], reverse=True)
+        single = [x for x in sorted(amounts) if x >= amount + fee_model.fee(1, 1)]
+        count = next((k for k in range(1, len(useful) + 1)
+                      if sum(useful[:k]) >= amount + fee_model.fee(k, 1)), None)
+        if single:
+            assert [x.amount for x in selection.inputs] == single[:1]
+        elif count is None:
+            assert selection is None
+        else:
+            assert [x.amount for x in selection.inputs] == useful[:count]
+            check_selection(selection, amount, fee_model)
+
+
+def test_branch_and_bound_matches_brute_force():
+    rng = random.Random(2)
+    for _ in range(300):
+        amounts = [rng.randint(1, 60) for _ in range(rng.randint(1, 9))]
+        fee_model = FeeModel(base=rng.randint(0, 3), per_input=rng.randint(0, 2), per_output=rng.randint(0, 2))
+        amount = rng.randint(1, 120)
+        target = amount + fee_model.fee(0, 1)
+        tolerance = fee_model.per_output + fee_model.per_input
+        best = None
+        for size in range(1, len(amounts) + 1):
+            for combination in itertools.combinations(amounts, size):
+                value = sum([x - fee_model.per_input for x in combination])
+                if all([x > fee_model.per_input for x in combination]) and target <= value <= target + tolerance:
+                    best = value if best is None else min(best, value)
+
+        selection = coinselection.select_branch_and_bound(SortedUtxos(utxos(amounts)), amount, fee_model)
+        if best is None:
+            assert selection is None
+        else:
+            assert sum([x.amount - fee_model.per_input for x in selection.inputs]) == best
+            assert selection.change == 0
+            check_selection(selection, amount, fee_model)
+
+
+def test_knapsack_finds_smallest_overshoot():
+    sorted_utxos = SortedUtxos(utxos([7, 11, 13, 17, 19, 23, 29, 31, 1000]))
+    selection = coinselection.select_knapsack(sorted_utxos, 60, FeeModel(0, 0), rng=random.Random(1))
+    assert selection.total == 60
+
+
+def test_remove_selected_outputs():
+    sorted_utxos = SortedUtxos(utxos([10] * 50 + [20] * 50))
+    selection = coinselection.select(sorted_utxos, 300)
+    sorted_utxos.remove(selection.inputs)
+    assert len(sorted_utxos) == 100 - len(selection.inputs)
+    assert sorted_utxos.total == 1500 - selection.total
+    assert not set(map(id, selection.inputs)) & {id(sorted_utxos[x]) for x in range(len(sorted_utxos))}
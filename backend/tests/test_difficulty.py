@@ -0,0 +1,112 @@
+import copy
+import time
+
+import pytest
+
+from coin import difficulty
+from coin.blockchain import Blockchain
+from coin.chainindex import ChainIndex
+from coin.config import Config
+from coin.difficulty import TargetSchedule
+from coin.miner import Miner
+from coin.validation import ChainValidator, InvalidChainError, check_headers
+
+WALLET = Config.TEST_WALLET_1['public_key']
+
+
+@pytest.fixture
+def small_window(monkeypatch):
+    monkeypatch.setattr(Config, 'DIFFICULTY_WINDOW', 5)
+    monkeypatch.setattr(Config, 'MINING_EMPTY_BLOCKS', True)
+
+
+def mined(blocks: int) -> Blockchain:
+    blockchain = Blockchain()
+    miner = Miner(blockchain)
+    for _ in range(blocks):
+        miner.mine(WALLET, WALLET)
+    return blockchain
+
+
+def remine(block):
+    # the first blocks all use Config.INITIAL_TARGET
+    block.nonce = 0
+    while not difficulty.meets_target(block.compute_hash(), Config.INITIAL_TARGET):
+        block.nonce += 1
+    block.hash = block.compute_hash()
+
+
+def targets_for(timestamps):
+    targets = []
+    for height in range(len(timestamps) + 1):
+        targets.append(difficulty.next_target(height, timestamps.__getitem__, targets.__getitem__))
+    return targets
+
+
+def test_retarget(small_window):
+    # the first window took twice as long as expected, the second one as expected
+    timestamps = [x * 2 * Config.BLOCK_TIME for x in range(5)] + [40 * Config.BLOCK_TIME + x * Config.BLOCK_TIME
+                                                                   for x in range(5)]
+    targets = targets_for(timestamps)
+    assert targets[:5] == [Config.INITIAL_TARGET] * 5
+    assert targets[5] == min(Config.INITIAL_TARGET * 2, Config.MAX_TARGET)
+    assert targets[9] == targets[5]
+    assert targets[10] == targets[9]
+
+
+def test_retarget_clamp(small_window):
+    timestamps = [x * 0.001 for x in range(5)]
+    assert targets_for(timestamps)[5] == Config.INITIAL_TARGET // 4
+
+
+def test_timestamp_error(monkeypatch):
+    monkeypatch.setattr(Config, 'MEDIAN_TIME_BLOCKS', 3)
+    timestamps = [10.0, 30.0, 20.0, 40.0]
+    now = 100.0
+    # the median of 30, 20 and 40 is 30
+    assert difficulty.timestamp_error(4, 30.0, timestamps.__getitem__, now) is not None
+    assert difficulty.timestamp_error(4, 30.5, timestamps.__getitem__, now) is None
+    assert difficulty.timestamp_error(4, now + Config.MAX_FUTURE_BLOCK_TIME + 1, timestamps.__getitem__, now)
+    assert difficulty.timestamp_error(4, '50', timestamps.__getitem__, now) is not None
+    assert difficulty.timestamp_error(0, 5.0, timestamps.__getitem__, now) is None
+
+
+def test_validator_rejects_old_timestamp():
+    blockchain = mined(4)
+    genesis = blockchain.genesis
+    chain = copy.deepcopy(blockchain.chain)
+    chain[3].timestamp = chain[1].timestamp - 1
+    remine(chain[3])
+    validator = ChainValidator(genesis.hash, TargetSchedule(ChainIndex.from_blocks([genesis]), 1))
+    validator.add(chain[1])
+    validator.add(chain[2])
+    with pytest.raises(InvalidChainError) as error:
+        validator.add(chain[3])
+    assert error.value.height == 3 and 'median' in error.value.reason
+
+
+def test_headers_reject_future_timestamp():
+    blockchain = mined(2)
+    headers = [x.header for x in blockchain.chain[1:]]
+    headers[-1].timestamp = time.time() + Config.MAX_FUTURE_BLOCK_TIME + 60
+    with pytest.raises(InvalidChainError) as error:
+        check_headers(blockchain.genesis.hash, headers, blockchain.target_schedule(1))
+    assert error.value.height == 2 and 'future' in error.value.reason
+
+
+def test_check_block_rejects_future_timestamp():
+    blockchain = mined(1)
+    block = Miner(blockchain).generate_block(WALLET, WALLET)
+    block.timestamp = time.time() + Config.MAX_FUTURE_BLOCK_TIME + 60
+    assert not blockchain.check_block(block, block.compute_hash())
+
+
+def test_miner_timestamp_after_median(monkeypatch):
+    blockchain = mined(2)
+    ahead = time.time() + 30
+    for block in blockchain.chain[1:]:
+        block.timestamp = ahead
+    index = ChainIndex.from_blocks(blockchain.chain)
+    monkeypatch.setattr(blockchain.database, 'get_index', lambda: index)
+    block = Miner(blockchain).generate_block(WALLET, WALLET)
+    assert block.timestamp > blockchain.median_time_past()
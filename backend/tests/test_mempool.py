@@ -0,0 +1,146 @@
+from coin import signatures, util
+from coin.blockchain import Blockchain
+from coin.config import Config
+from coin.domain import InputInfo, OutputInfo, Transaction
+from coin.mempool import Mempool
+from coin.miner import Miner
+
+WALLET_1, KEY_1 = Config.TEST_WALLET_1['public_key'], Config.TEST_WALLET_1['private_key']
+WALLET_2 = Config.TEST_WALLET_2['public_key']
+
+
+def unsigned(name: str, spends, fee: int, amount: int = 1000) -> Transaction:
+    # a transaction spending the outputs `spends` of amount `amount` each, paying `fee`
+    inputs = [InputInfo(tx_hash, index, amount, 'a') for tx_hash, index in spends]
+    return Transaction('id-' + name, Transaction.REGULAR, 'hash-' + name, inputs,
+                       [OutputInfo(amount * len(inputs) - fee, 'b')])
+
+
+def payment(source: Transaction, fee: int) -> Transaction:
+    # pays 100 from the first output of `source` to wallet 2, leaving `fee` to the miner
+    output = source.outputs[0]
+    input_ = InputInfo(source.hash, 0, output.amount, output.address)
+    input_.signature = input_.sign(KEY_1)
+    tx = Transaction(util.random_id(), Transaction.REGULAR, None, [input_],
+                     [OutputInfo(100, WALLET_2), OutputInfo(output.amount - 100 - fee, WALLET_1)])
+    tx.hash = tx.compute_hash()
+    return tx
+
+
+def reward(block) -> Transaction:
+    return next(x for x in block.transactions if x.type == Transaction.REWARD)
+
+
+def test_select_by_fee_rate_then_arrival():
+    mempool = Mempool()
+    fees = {'a': 5, 'b': 50, 'c': 5, 'd': 20}
+    for name, fee in fees.items():
+        assert mempool.add(unsigned(name, [(name, 0)], fee))
+    assert [x.hash for x in mempool.select(10)] == ['hash-b', 'hash-d', 'hash-a', 'hash-c']
+    assert [x.hash for x in mempool.select(2)] == ['hash-b', 'hash-d']
+    # refused transactions stay in the pool for the next block
+    assert [x.hash for x in mempool.select(2, lambda tx: tx.hash != 'hash-b')] == ['hash-d', 'hash-a']
+    assert [x.hash for x in mempool.select(1)] == ['hash-b'] and len(mempool) == 4
+
+
+def test_conflicting_transaction_is_refused():
+    mempool = Mempool()
+    first = unsigned('first', [('x', 0), ('x', 1)], 1)
+    conflict = unsigned('conflict', [('x', 1)], 100)
+    assert mempool.add(first)
+    assert mempool.conflicts(conflict) == ['hash-first']
+    assert not mempool.add(conflict)
+    assert mempool.spender(('x', 1)) == 'hash-first'
+
+    mempool.remove('hash-first')
+    assert mempool.spender(('x', 1)) is None
+    assert mempool.add(conflict)
+
+
+def test_trim_evicts_the_lowest_fee_rate():
+    mempool = Mempool(capacity=2)
+    for name, fee in (('a', 10), ('b', 1), ('c', 30)):
+        mempool.add(unsigned(name, [(name, 0)], fee))
+    assert [x.hash for x in mempool.trim()] == ['hash-b']
+    assert [x.hash for x in mempool] == ['hash-a', 'hash-c']
+
+
+def test_database_refuses_a_transaction_trimmed_on_arrival(monkeypatch):
+    monkeypatch.setattr(Config, 'MEMPOOL_MAX_TRANSACTIONS', 1)
+    database = Blockchain().database
+    assert database.add_unconfirmed_transaction(unsigned('rich', [('x', 0)], 30))
+    assert not database.add_unconfirmed_transaction(unsigned('poor', [('y', 0)], 1))
+    assert database.add_unconfirmed_transaction(unsigned('richer', [('z', 0)], 60))
+    assert [x.hash for x in database.get_unconfirmed_transactions()] == ['hash-richer']
+    # the pending outputs only hold what is left in the pool
+    assert database.get_pending_utxos().balance_delta('b') == 940
+
+
+def test_block_takes_the_best_spendable_transactions():
+    blockchain = Blockchain()
+    miner = Miner(blockchain)
+    for _ in range(3):
+        miner.mine(WALLET_1, WALLET_1)
+    low, high, middle = [payment(reward(x), fee) for x, fee in zip(blockchain.chain[1:], (1, 9, 5))]
+    # pays the most but spends an output that doesn't exist
+    missing = unsigned('missing', [('ab' * 32, 0)], 100)
+    for tx in (low, high, middle, missing):
+        assert blockchain.database.add_unconfirmed_transaction(tx)
+
+    block = miner.mine(WALLET_1, WALLET_1)
+    regular = [x.hash for x in block.transactions if x.type == Transaction.REGULAR]
+    assert regular == [high.hash, middle.hash]
+    assert [x.hash for x in blockchain.mempool] == [low.hash, missing.hash]
+
+
+def test_duplicates_by_hash_or_id():
+    mempool = Mempool()
+    tx = unsigned('a', [('x', 0)], 1)
+    assert mempool.add(tx)
+    assert not mempool.add(unsigned('a', [('y', 0)], 1))
+    # the same id under another hash, e.g. resubmitted through another node
+    other = unsigned('b', [('y', 0)], 1)
+    other.id = tx.id
+    assert mempool.has_id(tx.id) and not mempool.add(other)
+
+    assert mempool.remove(tx.hash) is tx
+    assert mempool.remove(tx.hash) is None
+    assert not mempool.has_id(tx.id) and tx.hash not in mempool
+    assert mempool.add(other)
+
+
+def test_duplicate_is_refused_before_checking_signatures(monkeypatch):
+    blockchain = Blockchain()
+    Miner(blockchain).mine(WALLET_1, WALLET_1)
+    tx = payment(reward(blockchain.last_block), 1)
+    assert blockchain.add_new_transaction(tx)
+    verified = []
+    monkeypatch.setattr(signatures, 'verify_signatures', verified.extend)
+    assert not blockchain.add_new_transaction(Transaction.from_json(tx.to_json()))
+    assert verified == []
+
+
+def test_mined_copies_are_removed_by_hash():
+    blockchain = Blockchain()
+    Miner(blockchain).mine(WALLET_1, WALLET_1)
+    tx = payment(reward(blockchain.last_block), 1)
+    assert blockchain.add_new_transaction(tx)
+    # the block comes from a peer, its transactions are other objects
+    copy = Transaction.from_json(tx.to_json())
+    blockchain.database.remove_transactions_from_unconfirmed_list([copy])
+    assert len(blockchain.mempool) == 0
+    assert blockchain.get_balance_for_address(WALLET_2) == 0
+
+
+def test_removed_entries_leave_the_heaps():
+    mempool = Mempool()
+    transactions = [unsigned(str(x), [(str(x), 0)], x + 1) for x in range(500)]
+    for tx in transactions:
+        mempool.add(tx)
+    for tx in transactions[:-10]:
+        mempool.remove(tx.hash)
+    assert len(mempool._best) <= 2 * len(mempool) + 64
+    assert [x.hash for x in mempool.select(3)] == ['hash-499', 'hash-498', 'hash-497']
+    # a removed transaction submitted again is a new entry
+    mempool.add(transactions[0])
+    assert [x.hash for x in mempool.select(20)][-1] == 'hash-0'
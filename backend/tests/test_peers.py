@@ -0,0 +1,51 @@
+import requests
+
+from coin.config import Config
+from coin.peers import PeerClient, PeerHealth
+
+
+def answer(peer):
+    if peer == 'http://broken':
+        return {'unexpected': 1}['headers']
+    if peer == 'http://down':
+        raise requests.ConnectionError('refused')
+    return peer.upper()
+
+
+def test_map_keeps_results_when_a_peer_fails():
+    client = PeerClient(max_concurrency=4)
+    try:
+        results = client.map(answer, ['http://a', 'http://broken', 'http://b'])
+        assert results == {'http://a': 'HTTP://A', 'http://b': 'HTTP://B'}
+        assert client.health('http://broken').consecutive_failures == 1
+        assert client.health('http://a').consecutive_failures == 0
+    finally:
+        client.close()
+
+
+def test_map_skips_failing_peers():
+    client = PeerClient(max_concurrency=4)
+    try:
+        for _ in range(Config.PEER_MAX_FAILURES):
+            assert client.map(answer, ['http://broken', 'http://a']) == {'http://a': 'HTTP://A'}
+        assert client.ranked(['http://broken', 'http://a']) == ['http://a']
+    finally:
+        client.close()
+
+
+def test_map_request_exceptions():
+    client = PeerClient(max_concurrency=4)
+    try:
+        assert client.map(answer, ['http://down']) == {}
+    finally:
+        client.close()
+
+
+def test_health_score():
+    health = PeerHealth()
+    health.record_success(0.1)
+    fast = health.score
+    health.record_failure()
+    assert health.score < fast and health.consecutive_failures == 1
+    health.record_success(0.1)
+    assert health.consecutive_failures == 0 and health.available()
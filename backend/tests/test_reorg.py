@@ -0,0 +1,139 @@
+import pytest
+
+from coin.blockchain import Blockchain
+from coin.config import Config
+from coin.database import FileDatabase
+from coin.domain import InputInfo, Transaction
+from coin.miner import Miner
+from coin.transactionbuilder import NewTransactionViewModel
+from coin.utxo import UtxoSet
+
+WALLET_1, KEY_1 = Config.TEST_WALLET_1['public_key'], Config.TEST_WALLET_1['private_key']
+WALLET_2 = Config.TEST_WALLET_2['public_key']
+
+
+@pytest.fixture(params=['memory', 'file'])
+def make_blockchain(request, tmp_path):
+    opened = []
+
+    def make():
+        database = FileDatabase(str(tmp_path / str(len(opened)))) if request.param == 'file' else None
+        opened.append(database)
+        return Blockchain(database)
+    yield make
+    for database in opened:
+        if database is not None:
+            database.close()
+
+
+def spend(blockchain: Blockchain, tx: Transaction, index: int, amount: int) -> Transaction:
+    # pays `amount` to wallet 2 from output `index` of `tx`, the change going back to wallet 1
+    output = tx.outputs[index]
+    input_ = InputInfo(tx.hash, index, output.amount, output.address)
+    input_.signature = input_.sign(KEY_1)
+    payment = NewTransactionViewModel([input_], amount, WALLET_2, WALLET_1).build()
+    assert blockchain.add_new_transaction(payment)
+    return payment
+
+
+def reward(block) -> Transaction:
+    return next(x for x in block.transactions if x.type == Transaction.REWARD)
+
+
+def state(blockchain: Blockchain, utxos: UtxoSet):
+    addresses = {x.address for block in blockchain.chain for tx in block.transactions for x in tx.outputs}
+    return sorted((address, outpoint, amount, utxos.balance(address))
+                  for address in addresses for outpoint, amount in utxos.outputs_for_address(address).items())
+
+
+def assert_consistent(blockchain: Blockchain):
+    # the incrementally maintained UTXO set matches the one rebuilt from the blocks
+    assert state(blockchain, blockchain.utxos) == state(blockchain, UtxoSet.from_blocks(list(blockchain.chain)))
+
+
+def fork(make_blockchain, ours: int, theirs: int):
+    # two chains sharing their first block, then mining `ours` and `theirs` blocks each
+    a, b = make_blockchain(), make_blockchain()
+    Miner(b).mine(WALLET_1, WALLET_1)
+    assert a.replace_chain_from(1, list(b.chain[1:]))
+    for blockchain, count in ((a, ours), (b, theirs)):
+        for _ in range(count):
+            Miner(blockchain).mine(WALLET_1, WALLET_1)
+    return a, b
+
+
+def test_switch_to_branch_with_more_work(make_blockchain):
+    a, b = fork(make_blockchain, 1, 2)
+    paid = spend(a, reward(a.chain[1]), 0, 100)
+    Miner(a).mine(WALLET_1, WALLET_1)
+    Miner(b).mine(WALLET_1, WALLET_1)
+    assert_consistent(a)
+
+    assert a.replace_chain_from(2, list(b.chain[2:]))
+    assert [x.hash for x in a.chain] == [x.hash for x in b.chain]
+    assert_consistent(a)
+    # the payment of the disconnected block goes back to the pool, the blocks into the tree
+    assert paid.hash in a.database.get_mempool()
+    assert len(a.tree) == 2
+
+
+def test_shorter_branch_is_kept_then_extended(make_blockchain):
+    a, b = fork(make_blockchain, 2, 1)
+    before = [x.hash for x in a.chain]
+    assert not a.replace_chain_from(2, list(b.chain[2:]))
+    assert [x.hash for x in a.chain] == before and b.chain[2].hash in a.tree
+
+    # only the new blocks are sent, they extend the branch kept in the tree
+    for _ in range(2):
+        Miner(b).mine(WALLET_1, WALLET_1)
+    assert a.replace_chain_from(3, list(b.chain[3:]))
+    assert [x.hash for x in a.chain] == [x.hash for x in b.chain]
+    assert_consistent(a)
+
+
+def test_invalid_branch_restores_our_chain(make_blockchain):
+    a, b = fork(make_blockchain, 1, 2)
+    before = [x.hash for x in a.chain]
+    expected = state(a, a.utxos)
+    branch = list(b.chain[2:])
+    branch[-1] = type(branch[-1])(branch[-1].index, branch[-1].transactions[:-1], branch[-1].timestamp,
+                                  branch[-1].previous_hash, branch[-1].hash, branch[-1].nonce)
+    assert not a.replace_chain_from(2, branch)
+    assert [x.hash for x in a.chain] == before
+    assert state(a, a.utxos) == expected
+
+
+def test_reorg_evicts_transactions_spending_disconnected_outputs(make_blockchain):
+    a, b = fork(make_blockchain, 1, 2)
+    # spends the reward of our block at height 2, which the other branch doesn't have, then its change
+    orphan = spend(a, reward(a.chain[2]), 0, 100)
+    child = spend(a, orphan, 1, 50)
+    kept = spend(a, reward(a.chain[1]), 0, 70)
+    pending = a.get_balance_for_address(WALLET_2)
+    assert pending == a.utxos.balance(WALLET_2) + 220
+
+    assert a.replace_chain_from(2, list(b.chain[2:]))
+    mempool = a.database.get_mempool()
+    assert orphan.hash not in mempool and child.hash not in mempool and kept.hash in mempool
+    assert a.get_balance_for_address(WALLET_2) == a.utxos.balance(WALLET_2) + 70
+    assert all(x['transaction'] != orphan.hash for x in a.get_unspent_transactions_for_address(WALLET_1))
+    assert_consistent(a)
+
+
+def test_file_database_reopens_after_reorg(tmp_path):
+    a, b = Blockchain(FileDatabase(str(tmp_path / 'a'))), Blockchain()
+    Miner(b).mine(WALLET_1, WALLET_1)
+    a.replace_chain_from(1, list(b.chain[1:]))
+    Miner(a).mine(WALLET_1, WALLET_1)
+    for _ in range(2):
+        Miner(b).mine(WALLET_1, WALLET_1)
+    assert a.replace_chain_from(2, list(b.chain[2:]))
+    expected = state(a, a.utxos)
+    a.database.close()
+
+    reopened = Blockchain(FileDatabase(str(tmp_path / 'a')))
+    try:
+        assert [x.hash for x in reopened.chain] == [x.hash for x in b.chain]
+        assert state(reopened, reopened.utxos) == expected
+    finally:
+        reopened.database.close()
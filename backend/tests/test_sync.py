@@ -0,0 +1,239 @@
+import hashlib
+import json
+
+import pytest
+
+from coin import codec
+from coin.blockchain import Blockchain
+from coin.config import Config
+from coin.miner import Miner
+from coin.node import Node
+from coin.peers import PeerClient
+from coin.validation import InvalidChainError
+
+WALLET = Config.TEST_WALLET_1['public_key']
+
+
+class Response:
+    def __init__(self, data=None, status_code=200, content_type='application/json', body=None):
+        self.status_code = status_code
+        self.data = data
+        self.url = ''
+        self.text = str(data)
+        self.headers = {'Content-Type': content_type}
+        self.body = body
+
+    def json(self):
+        return self.data
+
+    def iter_content(self, chunk_size):
+        yield from self.body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeClient(PeerClient):
+    # answers every request with a function of the peer, called with the path and the parameters
+    def __init__(self, peers: dict):
+        super().__init__(max_concurrency=2)
+        self.peers = peers
+        self.requests = []
+
+    def request(self, method, peer, path, **kwargs):
+        self.requests.append((peer, path))
+        return self.peers[peer](path, kwargs.get('params') or {})
+
+
+def serve(blockchain: Blockchain, tamper=None):
+    # a peer serving `blockchain`, `tamper` may change the blocks it streams
+    def answer(path, params):
+        if path == '/blockchain/headers/':
+            return Response(blockchain.headers_since(params['since'].split(','), int(params['limit'])))
+        if path == '/blockchain/blocks/':
+            blocks = list(blockchain.iter_blocks(int(params['from']), int(params['limit'])))
+            if tamper:
+                blocks = tamper(blocks)
+            return Response(content_type=codec.CONTENT_TYPE, body=[codec.encode_blocks(blocks)])
+        raise AssertionError(path)
+    return answer
+
+
+def make_node(blockchain: Blockchain, peers: dict) -> Node:
+    node = Node('5000', blockchain, set(), client=FakeClient(peers))
+    node._t.cancel()
+    node.peers = set(peers)
+    return node
+
+
+def mined(blocks: int) -> Blockchain:
+    blockchain = Blockchain()
+    miner = Miner(blockchain)
+    for _ in range(blocks):
+        miner.mine(WALLET, WALLET)
+    return blockchain
+
+
+def fake_hash(n: int) -> str:
+    return hashlib.sha256(str(n).encode()).hexdigest()
+
+
+def endless(genesis_hash: str):
+    # a peer claiming a huge chain and sending linked headers for as long as it is asked
+    state = {'height': 0, 'previous': genesis_hash}
+
+    def answer(path, params):
+        headers = []
+        for _ in range(int(params['limit'])):
+            state['height'] += 1
+            header = {'index': state['height'], 'previous_hash': state['previous'], 'merkle_root': fake_hash(-1),
+                      'timestamp': 0.0, 'nonce': 0, 'hash': fake_hash(state['height'])}
+            headers.append(header)
+            state['previous'] = header['hash']
+        return Response({'fork_height': 0, 'headers': headers, 'length': 10 ** 12, 'work': 10 ** 30})
+    return answer
+
+
+def test_fetch_headers_pages(monkeypatch):
+    monkeypatch.setattr(Config, 'SYNC_HEADERS_LIMIT', 2)
+    peer = mined(5)
+    node = make_node(Blockchain(), {'http://a': serve(peer)})
+    fork_height, work, headers = node.fetch_headers('http://a')
+    assert fork_height == 0 and work == peer.chain_work()
+    assert [x.hash for x in headers] == [x.hash for x in peer.chain[1:]]
+    assert len(node.client.requests) == 3
+
+
+def test_fetch_headers_stops_after_max_pages(monkeypatch):
+    monkeypatch.setattr(Config, 'SYNC_HEADERS_LIMIT', 3)
+    monkeypatch.setattr(Config, 'SYNC_HEADERS_MAX_PAGES', 4)
+    blockchain = Blockchain()
+    node = make_node(blockchain, {'http://a': endless(blockchain.genesis.hash)})
+    fork_height, work, headers = node.fetch_headers('http://a')
+    assert len(headers) == 12 and len(node.client.requests) == 4
+
+
+def test_fetch_headers_rejects_unlinked_pages(monkeypatch):
+    monkeypatch.setattr(Config, 'SYNC_HEADERS_LIMIT', 2)
+    peer = mined(5)
+    answer = serve(peer)
+
+    def unlinked(path, params):
+        response = answer(path, params)
+        if ',' not in params['since']:
+            response.data['headers'][0]['previous_hash'] = fake_hash(0)
+        return response
+    node = make_node(Blockchain(), {'http://a': unlinked})
+    with pytest.raises(InvalidChainError):
+        node.fetch_headers('http://a')
+
+
+@pytest.mark.parametrize('body', [
+    {'unexpected': 1},
+    {'fork_height': 0, 'length': 5, 'headers': [{'index': 1}]},
+    {'fork_height': 'x', 'length': 5, 'headers': []},
+    {'fork_height': 7, 'length': 9, 'headers': []},
+    {'fork_height': 0, 'length': 2, 'work': 10 ** 30, 'headers': [{
+        'index': x, 'previous_hash': fake_hash(x - 1), 'merkle_root': fake_hash(-1), 'timestamp': 0.0,
+        'nonce': 0, 'hash': fake_hash(x)} for x in range(1, 4)]},
+    [],
+])
+def test_fetch_headers_malformed(body):
+    node = make_node(Blockchain(), {'http://a': lambda path, params: Response(body)})
+    with pytest.raises(ValueError):
+        node.fetch_headers('http://a')
+
+
+def test_consensus_survives_a_malformed_peer():
+    peer = mined(3)
+    blockchain = Blockchain()
+    node = make_node(blockchain, {'http://a': serve(peer), 'http://b': lambda path, params: Response({'unexpected': 1})})
+    assert node.consensus()
+    assert blockchain.last_block.hash == peer.last_block.hash
+    assert node.client.health('http://b').consecutive_failures == 1
+
+
+def test_consensus_rejects_blocks_not_matching_their_headers():
+    peer = mined(3)
+    other = mined(3)
+    blockchain = Blockchain()
+    node = make_node(blockchain, {'http://a': serve(peer, tamper=lambda blocks: other.chain[1:1 + len(blocks)])})
+    assert not node.consensus()
+    assert blockchain.length == 1
+
+
+def test_consensus_falls_back_on_the_next_peer():
+    best, second = mined(4), mined(3)
+    blockchain = Blockchain()
+
+    def corrupt(blocks):
+        blocks[-1].nonce = (blocks[-1].nonce or 0) + 1
+        return blocks
+    node = make_node(blockchain, {'http://a': serve(best, tamper=corrupt), 'http://b': serve(second)})
+    assert node.consensus()
+    assert blockchain.last_block.hash == second.last_block.hash
+
+
+def test_download_stops_at_the_first_invalid_block():
+    peer, other = mined(6), mined(2)
+    answer = serve(peer)
+    sent = []
+
+    def lazily(path, params):
+        if path != '/blockchain/blocks/':
+            return answer(path, params)
+        blocks = list(peer.iter_blocks(int(params['from']), int(params['limit'])))
+        blocks[1] = other.chain[2]
+
+        def body():
+            # a chunk per block, counting what the node asked for
+            for chunk in codec.iter_encode_blocks(blocks, len(blocks)):
+                sent.append(chunk)
+                yield chunk
+        return Response(content_type=codec.CONTENT_TYPE, body=body())
+    blockchain = Blockchain()
+    node = make_node(blockchain, {'http://a': lazily})
+    assert not node.consensus()
+    # the count, the first block and the bad one
+    assert len(sent) == 3 and blockchain.length == 1
+
+
+def test_download_json_lines():
+    peer = mined(3)
+    answer = serve(peer)
+
+    def json_lines(path, params):
+        if path != '/blockchain/blocks/':
+            return answer(path, params)
+        response = Response(content_type=codec.JSON_LINES_CONTENT_TYPE)
+        blocks = peer.iter_blocks(int(params['from']), int(params['limit']))
+        response.iter_lines = lambda: (json.dumps(x.to_json()).encode() for x in blocks)
+        return response
+    blockchain = Blockchain()
+    node = make_node(blockchain, {'http://a': json_lines})
+    assert node.consensus()
+    assert blockchain.last_block.hash == peer.last_block.hash
+
+
+def test_side_branch_blocks_are_not_downloaded_again():
+    ours, theirs = mined(3), Blockchain()
+    theirs.replace_chain_from(1, list(ours.chain[1:2]))
+    Miner(theirs).mine(WALLET, WALLET)
+    # their block 2 is kept on our side branch, the peer then extends that branch
+    assert not ours.replace_chain_from(2, list(theirs.chain[2:]))
+    for _ in range(2):
+        Miner(theirs).mine(WALLET, WALLET)
+    answer = serve(theirs)
+    asked = []
+
+    def recording(path, params):
+        if path == '/blockchain/blocks/':
+            asked.append((int(params['from']), int(params['limit'])))
+        return answer(path, params)
+    node = make_node(ours, {'http://a': recording})
+    assert node.consensus()
+    assert ours.last_block.hash == theirs.last_block.hash
+    assert asked == [(3, 2)]
@@ -0,0 +1,167 @@
+import copy
+
+from coin.blockchain import Blockchain
+from coin.config import Config
+from coin.domain import Block, InputInfo, Transaction
+from coin.miner import Miner
+from coin.transactionbuilder import NewTransactionViewModel
+from coin.utxo import UtxoSet
+
+WALLET_1, KEY_1 = Config.TEST_WALLET_1['public_key'], Config.TEST_WALLET_1['private_key']
+WALLET_2 = Config.TEST_WALLET_2['public_key']
+
+
+def mined(blocks: int) -> Blockchain:
+    blockchain = Blockchain()
+    miner = Miner(blockchain)
+    for _ in range(blocks):
+        miner.mine(WALLET_1, WALLET_1)
+    return blockchain
+
+
+def pay(tx: Transaction, index: int, amount: int, input_amount: int = None) -> Transaction:
+    # pays `amount` to wallet 2 from output `index` of `tx`, the change going back to wallet 1
+    output = tx.outputs[index]
+    input_ = InputInfo(tx.hash, index, output.amount if input_amount is None else input_amount, output.address)
+    input_.signature = input_.sign(KEY_1)
+    return NewTransactionViewModel([input_], amount, WALLET_2, WALLET_1).build()
+
+
+def reward(block: Block) -> Transaction:
+    return next(x for x in block.transactions if x.type == Transaction.REWARD)
+
+
+def snapshot(utxos: UtxoSet, outpoints):
+    return {x: utxos.get(*x) and (utxos.get(*x).address, utxos.get(*x).amount) for x in outpoints}
+
+
+def test_apply_and_undo_block():
+    blockchain = mined(2)
+    payment = pay(reward(blockchain.chain[1]), 0, 100)
+    assert blockchain.add_new_transaction(payment)
+    block = Miner(blockchain).mine(WALLET_1, WALLET_1)
+    assert payment.hash in [x.hash for x in block.transactions]
+
+    utxos = UtxoSet.from_blocks(list(blockchain.chain[:-1]))
+    outpoints = [(tx.hash, i) for x in blockchain.chain for tx in x.transactions for i in range(len(tx.outputs))]
+    before = snapshot(utxos, outpoints)
+    undo = utxos.apply_block(block)
+    assert undo == [((payment.inputs[0].tx_hash, 0), reward(blockchain.chain[1]).outputs[0])]
+    assert (payment.inputs[0].tx_hash, 0) not in utxos and (payment.hash, 0) in utxos
+    assert snapshot(utxos, outpoints) == snapshot(blockchain.utxos, outpoints)
+    utxos.undo_block(block, undo)
+    assert snapshot(utxos, outpoints) == before
+
+
+def test_undo_block_spending_its_own_outputs():
+    blockchain = mined(1)
+    first = pay(reward(blockchain.chain[1]), 0, 100)
+    second = pay(first, 1, 50)
+    block = Block(2, [first, second], 0.0, blockchain.last_block.hash)
+    utxos = UtxoSet.from_blocks(list(blockchain.chain))
+    count = len(utxos)
+    undo = utxos.apply_block(block)
+    assert (first.hash, 1) not in utxos and (second.hash, 0) in utxos
+    utxos.undo_block(block, undo)
+    assert len(utxos) == count and (first.hash, 1) not in utxos
+    assert utxos.get(first.inputs[0].tx_hash, 0).amount == Config.MINING_REWARD
+
+
+def test_check_transaction():
+    blockchain = mined(1)
+    source = reward(blockchain.chain[1])
+    assert blockchain.check_transaction(pay(source, 0, 100))
+    assert not blockchain.check_transaction(pay(source, 0, 100, input_amount=Config.MINING_REWARD - 1))
+    missing = copy.deepcopy(source)
+    missing.hash = 'ab' * 32
+    assert not blockchain.check_transaction(pay(missing, 0, 100))
+
+    assert blockchain.add_new_transaction(pay(source, 0, 100))
+    Miner(blockchain).mine(WALLET_1, WALLET_1)
+    # the output is spent now
+    assert not blockchain.check_transaction(pay(source, 0, 200))
+
+
+def test_block_spending_an_output_twice_is_rejected():
+    blockchain = mined(1)
+    source = reward(blockchain.chain[1])
+    template = Miner(blockchain).generate_block(WALLET_1, WALLET_1)
+    block = Block(template.index, [pay(source, 0, 100), pay(source, 0, 200)] + template.transactions,
+                  template.timestamp, template.previous_hash)
+    proof = Miner(blockchain).proof_of_work(block)
+    assert not blockchain.check_block(block, proof)
+
+
+def test_mined_block_evicts_conflicting_pool_transactions():
+    blockchain = mined(1)
+    source = reward(blockchain.chain[1])
+    mined_tx, conflict = pay(source, 0, 100), pay(source, 0, 200)
+    assert blockchain.add_new_transaction(conflict)
+    # the conflict reached another node first, which mined it in a block
+    other = Blockchain()
+    other.replace_chain_from(1, list(blockchain.chain[1:]))
+    assert other.add_new_transaction(mined_tx)
+    block = Miner(other).mine(WALLET_1, WALLET_1)
+
+    assert blockchain.add_block(block, block.hash)
+    assert len(blockchain.mempool) == 0
+    assert blockchain.utxos.get(mined_tx.hash, 0).amount == 100
+
+
+def test_address_index_and_balances():
+    blockchain = mined(2)
+    payment = pay(reward(blockchain.chain[1]), 0, 100)
+    assert blockchain.add_new_transaction(payment)
+    Miner(blockchain).mine(WALLET_1, WALLET_1)
+    utxos = blockchain.utxos
+    assert utxos.outputs_for_address(WALLET_2) == {(payment.hash, 0): 100}
+    assert utxos.balance(WALLET_2) == 100
+    outputs = [x for block in blockchain.chain for tx in block.transactions for x in tx.outputs]
+    assert utxos.balance(WALLET_1) == sum([x.amount for x in outputs if x.address == WALLET_1]) - Config.MINING_REWARD
+    assert sum(utxos.outputs_for_address(WALLET_1).values()) == utxos.balance(WALLET_1)
+
+    # an address whose last output is spent leaves the index
+    utxos.apply_transaction(pay(payment, 0, 0, input_amount=100))
+    assert (payment.hash, 0) not in utxos.outputs_for_address(WALLET_2)
+    assert utxos.balance('nobody') == 0 and utxos.outputs_for_address('nobody') == {}
+
+
+def test_pending_outputs():
+    blockchain = mined(1)
+    source = reward(blockchain.chain[1])
+    first = pay(source, 0, 100)
+    second = pay(first, 1, 50)
+    assert blockchain.add_new_transaction(first) and blockchain.add_new_transaction(second)
+    pending = blockchain.database.get_pending_utxos()
+    assert pending.is_spent((source.hash, 0)) and pending.is_spent((first.hash, 1))
+    assert pending.balance_delta(WALLET_2) == 150
+    assert pending.balance_delta(WALLET_1) == -152
+    assert blockchain.get_balance_for_address(WALLET_2) == 150
+    assert blockchain.get_balance_for_address(WALLET_1) == blockchain.utxos.balance(WALLET_1) - 152
+
+    # confirmed outputs not spent in the pool and the pool outputs not spent by another pool transaction
+    unspent = {(x['transaction'], x['index']): x['amount']
+               for x in blockchain.get_unspent_transactions_for_address(WALLET_2)}
+    assert unspent == {(first.hash, 0): 100, (second.hash, 0): 50}
+    unspent = {(x['transaction'], x['index']) for x in blockchain.get_unspent_transactions_for_address(WALLET_1)}
+    assert (second.hash, 1) in unspent and not unspent & {(source.hash, 0), (first.hash, 1)}
+
+    blockchain.database.remove_unconfirmed_transaction(second.hash)
+    assert not pending.is_spent((first.hash, 1))
+    assert blockchain.get_balance_for_address(WALLET_2) == 100
+    blockchain.database.remove_unconfirmed_transaction(first.hash)
+    assert pending.balance_delta(WALLET_1) == 0 and pending.balance_delta(WALLET_2) == 0
+
+
+def test_pending_outputs_follow_a_mined_block():
+    blockchain = mined(1)
+    first = pay(reward(blockchain.chain[1]), 0, 100)
+    second = pay(first, 1, 50)
+    assert blockchain.add_new_transaction(first) and blockchain.add_new_transaction(second)
+    balance = blockchain.get_balance_for_address(WALLET_2)
+    # only `first` can be mined, its outputs move from the pool to the chain
+    block = Miner(blockchain).mine(WALLET_1, WALLET_1)
+    assert [x.hash for x in block.transactions][:1] == [first.hash]
+    assert blockchain.get_balance_for_address(WALLET_2) == balance
+    assert blockchain.utxos.balance(WALLET_2) == 100
+    assert blockchain.database.get_pending_utxos().balance_delta(WALLET_2) == 50
@@ -0,0 +1,103 @@
+import copy
+
+import pytest
+
+from coin import difficulty
+from coin.blockchain import Blockchain
+from coin.config import Config
+from coin.domain import Block, InputInfo, Transaction
+from coin.miner import Miner
+from coin.transactionbuilder import NewTransactionViewModel
+from coin.validation import ChainValidator, InvalidChainError
+
+WALLET_1, KEY_1 = Config.TEST_WALLET_1['public_key'], Config.TEST_WALLET_1['private_key']
+WALLET_2 = Config.TEST_WALLET_2['public_key']
+
+
+def paying_chain(blocks: int) -> Blockchain:
+    # every block after the first one holds a payment spending the reward of the block before
+    blockchain = Blockchain()
+    miner = Miner(blockchain)
+    miner.mine(WALLET_1, WALLET_1)
+    for _ in range(blocks - 1):
+        source = next(x for x in blockchain.last_block.transactions if x.type == Transaction.REWARD)
+        input_ = InputInfo(source.hash, 0, source.outputs[0].amount, WALLET_1)
+        input_.signature = input_.sign(KEY_1)
+        assert blockchain.add_new_transaction(NewTransactionViewModel([input_], 100, WALLET_2, WALLET_1).build())
+        miner.mine(WALLET_1, WALLET_1)
+    return blockchain
+
+
+def remine(block: Block):
+    # the first blocks all use Config.INITIAL_TARGET
+    block.nonce = 0
+    while not difficulty.meets_target(block.compute_hash(), Config.INITIAL_TARGET):
+        block.nonce += 1
+    block.hash = block.compute_hash()
+
+
+def with_bad_signature(chain, height: int):
+    # the chain with the payment of block `height` signed for another output, the blocks re-mined
+    chain = copy.deepcopy(list(chain))
+    tx = next(x for x in chain[height].transactions if x.type == Transaction.REGULAR)
+    other = next(x for x in chain[height + 1].transactions if x.type == Transaction.REGULAR)
+    tx.inputs[0].signature = other.inputs[0].signature
+    tx.hash = tx.compute_hash()
+    previous_hash = chain[height - 1].hash
+    for position in range(height, len(chain)):
+        block = chain[position]
+        chain[position] = Block(block.index, block.transactions, block.timestamp, previous_hash)
+        remine(chain[position])
+        previous_hash = chain[position].hash
+    return chain
+
+
+def validator_for(blockchain: Blockchain) -> ChainValidator:
+    return ChainValidator(blockchain.genesis.hash, blockchain.target_schedule(1))
+
+
+def test_valid_chain():
+    chain = paying_chain(4).chain
+    validator = validator_for(Blockchain())
+    for block in chain[1:]:
+        validator.add(block)
+    validator.finish()
+    assert validator.height == len(chain) and validator.previous_hash == chain[-1].hash
+
+
+def test_first_invalid_block_is_reported():
+    chain = list(paying_chain(3).chain)
+    validator = validator_for(Blockchain())
+    validator.add(chain[1])
+    with pytest.raises(InvalidChainError) as error:
+        validator.add(chain[3])
+    assert error.value.height == 2 and 'previous hash' in error.value.reason
+
+    block = copy.deepcopy(chain[2])
+    block.timestamp += 1
+    with pytest.raises(InvalidChainError) as error:
+        validator.add(block)
+    assert error.value.height == 2 and 'hash' in error.value.reason
+    # a refused block leaves the validator where it was
+    validator.add(chain[2])
+    assert validator.height == 3
+
+
+def test_signatures_are_checked_by_window(monkeypatch):
+    chain = with_bad_signature(paying_chain(5).chain, 2)
+    # the cheap checks pass, the signature is only verified with its window
+    validator = validator_for(Blockchain())
+    for block in chain[1:]:
+        validator.add(block)
+    with pytest.raises(InvalidChainError) as error:
+        validator.finish()
+    assert error.value.height == 2 and 'signature' in error.value.reason
+
+    monkeypatch.setattr(Config, 'VERIFY_CHUNK', 1)
+    monkeypatch.setattr(Config, 'VERIFY_WORKERS', 1)
+    validator = validator_for(Blockchain())
+    # a window of 4 inputs, full once the block holding the fourth payment is added
+    with pytest.raises(InvalidChainError) as error:
+        for block in chain[1:]:
+            validator.add(block)
+    assert error.value.height == 2 and validator.height == 6